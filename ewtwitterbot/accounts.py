@@ -0,0 +1,153 @@
+import json
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+import requests
+
+from ewtwitterbot import mastodon_bot, twitter_bot
+from ewtwitterbot.state import StateStore
+
+# Settings each platform's accounts need in the accounts file.
+REQUIRED_SETTINGS = {
+    "twitter": [
+        "consumer_key",
+        "consumer_secret",
+        "access_token",
+        "access_token_secret",
+    ],
+    "mastodon": ["api_base_url", "access_token"],
+}
+ACCOUNT_NAME = re.compile(r"^[\w.@-]+$")
+
+
+class AccountConfigurationError(Exception):
+    pass
+
+
+class Account:
+    """
+    One bot account from the accounts file. Every account keeps its own since-id,
+    ledger, retry queue, caches and rate limit budget, under its name, in the
+    state store shared by all of them. The client is only created on the first
+    cycle, so an instance that is down only holds up its own accounts.
+    """
+
+    def __init__(self, platform: str, name: str, settings: Dict[str, Any]) -> None:
+        """
+        :param platform: str, 'twitter' or 'mastodon'
+        :param name: str name of the account, unique for the platform.
+        :param settings: dict of credentials, plus optional `concurrency` and, on
+            Mastodon, `dismiss`.
+        """
+        if platform not in REQUIRED_SETTINGS:
+            raise AccountConfigurationError(f"Unknown platform {platform!r}.")
+        if not ACCOUNT_NAME.match(name):
+            raise AccountConfigurationError(f"Invalid account name {name!r}.")
+        missing = [key for key in REQUIRED_SETTINGS[platform] if not settings.get(key)]
+        if missing:
+            raise AccountConfigurationError(
+                f"{platform} account {name} is missing {', '.join(missing)}."
+            )
+        self.platform = platform
+        self.name = name
+        self.settings = settings
+        self.api: Any = None
+
+    @property
+    def key(self) -> str:
+        """
+        :return: str naming the account across platforms, e.g. 'mastodon-ewbot'
+        """
+        return f"{self.platform}-{self.name}"
+
+    def connect(self, session: Optional[requests.Session] = None) -> Any:
+        """
+        Create the account's client the first time it is needed.
+
+        :param session: Optional requests.Session shared by every account's client.
+        :return: tweepy.API or Mastodon
+        """
+        if self.api is None:
+            if self.platform == "twitter":
+                self.api = twitter_bot.get_credentials(
+                    self.settings["consumer_key"],
+                    self.settings["consumer_secret"],
+                    self.settings["access_token"],
+                    self.settings["access_token_secret"],
+                    account=self.name,
+                    session=session,
+                )
+            else:
+                self.api = mastodon_bot.get_credentials(
+                    self.settings["api_base_url"],
+                    self.settings["access_token"],
+                    account=self.name,
+                    session=session,
+                )
+        return self.api
+
+    def respond(
+        self, store: StateStore, session: Optional[requests.Session] = None
+    ) -> int:
+        """
+        Run one polling cycle for the account.
+
+        :param store: The shared StateStore.
+        :param session: Optional requests.Session shared by every account's client.
+        :return: int number of mentions found.
+        """
+        api = self.connect(session)
+        concurrency = int(self.settings.get("concurrency", 1))
+        if self.platform == "twitter":
+            return twitter_bot.respond_to_tweets(
+                None,
+                store=store,
+                api=api,
+                concurrency=concurrency,
+                account=self.name,
+            )
+        return mastodon_bot.respond_to_toots(
+            None,
+            store=store,
+            api=api,
+            dismiss=self.settings.get("dismiss"),
+            concurrency=concurrency,
+            account=self.name,
+        )
+
+
+def load_accounts(filename: str) -> List[Account]:
+    """
+    Read the accounts file, a JSON object whose `accounts` list holds an object
+    per account with its `platform`, `name` and settings.
+
+    :param filename: str path to the accounts file.
+    :return: list of Account
+    """
+    with open(filename) as f:
+        try:
+            entries = json.load(f)["accounts"]
+        except (ValueError, KeyError, TypeError) as e:
+            raise AccountConfigurationError(f"Can't read {filename}: {e!r}")
+    accounts = []
+    keys = set()
+    for entry in entries:
+        settings = dict(entry)
+        account = Account(
+            str(settings.pop("platform", "")), str(settings.pop("name", "")), settings
+        )
+        if account.key in keys:
+            raise AccountConfigurationError(f"{account.key} is configured twice.")
+        keys.add(account.key)
+        accounts.append(account)
+    return accounts
+
+
+def get_accounts_filename() -> Optional[str]:
+    """
+    Fetch the path to the accounts file from `EWBOT_ACCOUNTS`.
+
+    :return: str or None if there is no accounts file.
+    """
+    return os.environ.get("EWBOT_ACCOUNTS", default=None)
@@ -0,0 +1,97 @@
+import signal
+import threading
+from typing import Callable, Optional
+
+from loguru import logger
+
+
+class AdaptiveInterval:
+    """
+    Polling interval that shrinks while mentions keep arriving and backs off
+    while the bot is idle.
+    """
+
+    def __init__(
+        self,
+        minimum: float = 5,
+        maximum: float = 300,
+        initial: float = 60,
+        shrink: float = 0.5,
+        grow: float = 1.5,
+    ) -> None:
+        """
+        :param minimum: Shortest interval in seconds.
+        :param maximum: Longest interval in seconds.
+        :param initial: Interval in seconds before the first cycle.
+        :param shrink: Factor applied to the interval after a cycle that found mentions.
+        :param grow: Factor applied to the interval after an idle cycle.
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.shrink = shrink
+        self.grow = grow
+        self.current = min(max(initial, minimum), maximum)
+
+    def update(self, handled: int) -> float:
+        """
+        Given how many mentions the last cycle handled, compute the next interval.
+
+        :param handled: int number of mentions found in the last cycle.
+        :return: float seconds to wait before the next cycle.
+        """
+        factor = self.shrink if handled > 0 else self.grow
+        self.current = min(max(self.current * factor, self.minimum), self.maximum)
+        return self.current
+
+
+def install_signal_handlers(stop_event: threading.Event) -> None:
+    """
+    Set the stop event on SIGTERM or SIGINT so the serve loop can finish its
+    current cycle, checkpoint, and exit.
+
+    :param stop_event: threading.Event that `serve` watches.
+    """
+
+    def handle_signal(signum, frame):
+        logger.info(f"Received signal {signum}, shutting down after this cycle...")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+
+def serve(
+    cycle: Callable[[], int],
+    interval: Optional[AdaptiveInterval] = None,
+    stop_event: Optional[threading.Event] = None,
+    on_shutdown: Optional[Callable[[], None]] = None,
+) -> None:
+    """
+    Run `cycle` repeatedly in this process until the stop event is set, sleeping
+    for an adaptive interval between cycles. An exception in one cycle is logged
+    and does not stop the loop.
+
+    :param cycle: Callable that runs one polling cycle and returns the number of mentions found.
+    :param interval: Optional AdaptiveInterval, defaults to one with default bounds.
+    :param stop_event: Optional threading.Event. Signal handlers are installed for it if not supplied.
+    :param on_shutdown: Optional callable run once the loop exits, e.g. to checkpoint state.
+    """
+    if interval is None:
+        interval = AdaptiveInterval()
+    if stop_event is None:  # pragma: nocover
+        stop_event = threading.Event()
+        install_signal_handlers(stop_event)
+    try:
+        while not stop_event.is_set():
+            try:
+                handled = cycle()
+            except Exception as e:
+                logger.exception(f"Polling cycle failed: {e}")
+                handled = 0
+            wait = interval.update(handled)
+            logger.debug(f"Next poll in {wait:.1f} seconds.")
+            stop_event.wait(wait)
+    finally:
+        if on_shutdown is not None:
+            on_shutdown()
+        logger.info("Stopped serving.")
@@ -0,0 +1,93 @@
+import copy
+import os
+import time
+from typing import Any, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    """
+    The time budget for replying to one mention, started when the mention is picked
+    up and shared by every stage of the reply: fetching the quote, rendering the
+    image, uploading it and posting. Each network call gets whatever is left of the
+    budget as its timeout, so one stuck request can't hold up the whole cycle.
+    """
+
+    def __init__(self, budget: float, now: Optional[float] = None) -> None:
+        """
+        :param budget: Seconds allowed for the whole reply.
+        :param now: Optional monotonic timestamp, mostly for testing.
+        """
+        now = time.monotonic() if now is None else now
+        self.budget = budget
+        self.expires_at = now + budget
+
+    def remaining(self, now: Optional[float] = None) -> float:
+        """
+        :param now: Optional monotonic timestamp, mostly for testing.
+        :return: float seconds left, never below zero.
+        """
+        now = time.monotonic() if now is None else now
+        return max(self.expires_at - now, 0.0)
+
+    def timeout(self, stage: str, now: Optional[float] = None) -> float:
+        """
+        Fetch the timeout for the next stage of the reply, giving up if the budget
+        has already run out.
+
+        :param stage: str name of the stage, used in the error.
+        :param now: Optional monotonic timestamp, mostly for testing.
+        :return: float seconds left.
+        """
+        remaining = self.remaining(now)
+        if remaining <= 0:
+            raise DeadlineExceeded(
+                f"No time left for {stage} out of a {self.budget:g}s budget."
+            )
+        return remaining
+
+
+def get_reply_budget() -> float:
+    """
+    Fetch the number of seconds allowed for each reply from `EWBOT_REPLY_BUDGET`.
+
+    :return: float
+    """
+    return float(os.environ.get("EWBOT_REPLY_BUDGET", default="60"))
+
+
+def with_timeout(
+    client: T, attribute: str, deadline: Optional[Deadline], stage: str
+) -> T:
+    """
+    Make a shallow copy of an API client whose requests time out when the deadline
+    does. The copy shares the original's session and credentials, so concurrent
+    replies can each have their own timeout without interfering. The deadline is
+    kept on the copy, see `deadline_of`, so waits for rate limit budget are
+    bounded by it too.
+
+    :param client: API client, e.g. tweepy.API or Mastodon.
+    :param attribute: str name of the client's timeout attribute.
+    :param deadline: Optional Deadline, the client is returned as is if None.
+    :param stage: str name of the stage, used in the error if there is no time left.
+    :return: the bounded client.
+    """
+    if deadline is None:
+        return client
+    bounded = copy.copy(client)
+    setattr(bounded, attribute, deadline.timeout(stage))
+    setattr(bounded, "ewbot_deadline", deadline)
+    return bounded
+
+
+def deadline_of(client: Any) -> Optional[Deadline]:
+    """
+    :param client: API client, e.g. tweepy.API or Mastodon.
+    :return: the Deadline the client was bounded by with `with_timeout`, or None.
+    """
+    return vars(client).get("ewbot_deadline")
@@ -0,0 +1,244 @@
+import base64
+import hashlib
+import os
+import time
+from array import array
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+from loguru import logger
+
+from ewtwitterbot.state import StateStore
+
+T = TypeVar("T")
+
+
+class SlidingWindowSketch:
+    """
+    Approximate per-key event counts over a sliding time window, in a fixed amount
+    of memory however many keys there are.
+
+    The window is split into `slices`, each holding a count-min sketch of `depth`
+    rows of `width` 16-bit counters. A count is the sum over the slices still in the
+    window of the smallest counter the key hashes to. Collisions can only make a
+    count too high, never too low.
+    """
+
+    def __init__(
+        self,
+        window: float = 3600,
+        slices: int = 6,
+        width: int = 2048,
+        depth: int = 4,
+    ) -> None:
+        """
+        :param window: Length of the window in seconds.
+        :param slices: Number of slices the window is split into.
+        :param width: Number of counters per row.
+        :param depth: Number of rows, each with its own hash.
+        """
+        self.slice_length = window / slices
+        self.width = width
+        self.depth = depth
+        self.counters = [array("H", bytes(2 * width * depth)) for _ in range(slices)]
+        self.epochs = [-1] * slices
+
+    def _indexes(self, key: str) -> List[int]:
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=4 * self.depth)
+        hashes = memoryview(digest.digest()).cast("I")
+        return [
+            row * self.width + hashes[row] % self.width for row in range(self.depth)
+        ]
+
+    def _slice(self, now: float) -> array:
+        epoch = int(now // self.slice_length)
+        position = epoch % len(self.counters)
+        if self.epochs[position] != epoch:
+            self.counters[position] = array("H", bytes(2 * self.width * self.depth))
+            self.epochs[position] = epoch
+        return self.counters[position]
+
+    def add(self, key: str, now: Optional[float] = None) -> None:
+        """
+        Count one event for a key.
+
+        :param key: str
+        :param now: Optional timestamp, mostly for testing.
+        """
+        now = time.time() if now is None else now
+        counters = self._slice(now)
+        for index in self._indexes(key):
+            if counters[index] < 0xFFFF:
+                counters[index] += 1
+
+    def estimate(self, key: str, now: Optional[float] = None) -> int:
+        """
+        Estimate the number of events for a key within the window.
+
+        :param key: str
+        :param now: Optional timestamp, mostly for testing.
+        :return: int
+        """
+        now = time.time() if now is None else now
+        oldest = int(now // self.slice_length) - len(self.counters) + 1
+        live = [
+            counters
+            for counters, epoch in zip(self.counters, self.epochs)
+            if epoch >= oldest
+        ]
+        return min(
+            sum(counters[index] for counters in live) for index in self._indexes(key)
+        )
+
+    def save(
+        self, store: StateStore, namespace: str, now: Optional[float] = None
+    ) -> None:
+        """
+        Write the current slice to the state store's cache, to expire when it drops
+        out of the window.
+
+        :param store: The StateStore to write to.
+        :param namespace: str cache namespace, e.g. 'fairness:twitter:default'
+        :param now: Optional timestamp, mostly for testing.
+        """
+        now = time.time() if now is None else now
+        epoch = int(now // self.slice_length)
+        store.cache_set(
+            namespace,
+            str(epoch),
+            base64.b64encode(self._slice(now).tobytes()).decode("ascii"),
+            (epoch + len(self.counters)) * self.slice_length,
+        )
+
+    def load(
+        self, store: StateStore, namespace: str, now: Optional[float] = None
+    ) -> None:
+        """
+        Read back the slices still in the window that were saved to the state store,
+        e.g. by an earlier run of the bot.
+
+        :param store: The StateStore to read from.
+        :param namespace: str cache namespace, e.g. 'fairness:twitter:default'
+        :param now: Optional timestamp, mostly for testing.
+        """
+        now = time.time() if now is None else now
+        current = int(now // self.slice_length)
+        for epoch in range(current - len(self.counters) + 1, current + 1):
+            value = store.cache_get(namespace, str(epoch), now=now)
+            if value is None:
+                continue
+            counters = array("H", base64.b64decode(value))
+            if len(counters) == self.width * self.depth:
+                self.counters[epoch % len(self.counters)] = counters
+                self.epochs[epoch % len(self.counters)] = epoch
+
+
+class FairScheduler:
+    """
+    Orders a cycle's mentions so that no single author can crowd out everyone
+    else. Mentions are queued per author and served round-robin, one from each
+    author in turn, and an author who has already had `quota` replies within the
+    sliding window is throttled until their count drops.
+
+    With a state store the counts are read back from it on the first cycle and
+    saved to it after every cycle, so the quota also holds across runs of the bot
+    that each handle a single cycle, e.g. from cron.
+    """
+
+    def __init__(
+        self,
+        quota: int = 5,
+        sketch: Optional[SlidingWindowSketch] = None,
+        store: Optional[StateStore] = None,
+        namespace: str = "fairness:default",
+    ) -> None:
+        """
+        :param quota: int number of replies an author gets per window.
+        :param sketch: Optional SlidingWindowSketch holding the per-author counts.
+        :param store: Optional StateStore to keep the counts in between runs.
+        :param namespace: str cache namespace for the counts in the store.
+        """
+        self.quota = quota
+        self.sketch = sketch if sketch is not None else SlidingWindowSketch()
+        self.store = store
+        self.namespace = namespace
+        self.loaded = False
+
+    def order(
+        self,
+        items: List[T],
+        author_of: Callable[[T], str],
+        now: Optional[float] = None,
+    ) -> Tuple[List[T], List[T]]:
+        """
+        Split a cycle's mentions into those to serve, in round-robin order across
+        authors, and those throttled because their author is over quota. Served
+        mentions count towards their author's quota.
+
+        :param items: list of mentions, oldest first.
+        :param author_of: Callable returning the author of a mention.
+        :param now: Optional timestamp, mostly for testing.
+        :return: tuple of the list to serve and the list throttled.
+        """
+        if self.store is not None and not self.loaded:
+            self.sketch.load(self.store, self.namespace, now)
+            self.loaded = True
+        queues: Dict[str, List[T]] = OrderedDict()
+        for item in items:
+            queues.setdefault(str(author_of(item)).lower(), []).append(item)
+        served: List[T] = []
+        throttled: List[T] = []
+        while queues:
+            for author in list(queues):
+                item = queues[author].pop(0)
+                if not queues[author]:
+                    del queues[author]
+                if self.sketch.estimate(author, now) >= self.quota:
+                    logger.info(f"Throttling mention from {author}, who is over quota.")
+                    throttled.append(item)
+                else:
+                    self.sketch.add(author, now)
+                    served.append(item)
+        if self.store is not None and served:
+            self.sketch.save(self.store, self.namespace, now)
+        return served, throttled
+
+
+def get_quota() -> Tuple[int, float]:
+    """
+    Fetch the per-author reply quota and its window in seconds from the environment.
+
+    :return: tuple of quota and window.
+    """
+    return (
+        int(os.environ.get("EWBOT_USER_QUOTA", default="5")),
+        float(os.environ.get("EWBOT_USER_QUOTA_WINDOW", default="3600")),
+    )
+
+
+_schedulers: Dict[Tuple[str, str, Optional[StateStore]], FairScheduler] = {}
+
+
+def get_fair_scheduler(
+    platform: str, account: str = "default", store: Optional[StateStore] = None
+) -> FairScheduler:
+    """
+    Fetch the scheduler for a platform, account and store, creating it the first
+    time it is asked for so a long-running process keeps its counts between cycles.
+    Each store gets a scheduler of its own, so counts always go to the store passed.
+
+    :param platform: str, e.g. 'twitter'
+    :param account: str name of the account.
+    :param store: Optional StateStore to keep the counts in between runs.
+    :return: FairScheduler
+    """
+    key = (platform, account, store)
+    if key not in _schedulers:
+        quota, window = get_quota()
+        _schedulers[key] = FairScheduler(
+            quota,
+            SlidingWindowSketch(window=window),
+            store,
+            f"fairness:{platform}:{account}",
+        )
+    return _schedulers[key]
@@ -0,0 +1,167 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Deque, Dict, Optional
+
+import requests
+from loguru import logger
+
+from ewtwitterbot.metrics import get_metrics
+
+
+class LatencyTracker:
+    """
+    Keeps the latencies of the most recent requests to estimate percentiles from.
+    """
+
+    def __init__(self, size: int = 200, min_samples: int = 20) -> None:
+        """
+        :param size: int number of recent latencies kept.
+        :param min_samples: int number of latencies needed before estimating.
+        """
+        self.samples: Deque[float] = deque(maxlen=size)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        """
+        :param seconds: float latency of a request.
+        """
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        """
+        :param fraction: float, e.g. 0.95 for the 95th percentile.
+        :return: float seconds, or None if there are too few samples yet.
+        """
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def _discard(future: Future) -> None:
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+class HedgedRequests:
+    """
+    Sends idempotent requests with a backup. If a request hasn't answered within
+    the observed p95 latency, an identical second request is sent and whichever
+    answers first is used, so one slow connection doesn't hold up a reply.
+
+    The loser is cancelled if it hasn't started yet. A request already on the
+    wire can't be interrupted, so its response is closed when it arrives to hand
+    the connection back to the pool. Hedges are capped at `max_hedge_rate` of all
+    requests so a slow backend doesn't get twice the load. The backup only gets
+    what is left of the original request's timeout, so hedging never makes the
+    caller wait longer than it asked to.
+    """
+
+    def __init__(
+        self,
+        max_hedge_rate: float = 0.05,
+        tracker: Optional[LatencyTracker] = None,
+        max_workers: int = 8,
+    ) -> None:
+        """
+        :param max_hedge_rate: float largest share of requests that may be hedged.
+        :param tracker: Optional LatencyTracker to take the p95 from.
+        :param max_workers: int number of threads sending requests.
+        """
+        self.max_hedge_rate = max_hedge_rate
+        self.tracker = tracker if tracker is not None else LatencyTracker()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="hedge"
+        )
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.hedges_issued = 0
+        self.hedges_won = 0
+
+    def _may_hedge(self) -> bool:
+        with self.lock:
+            if self.hedges_issued + 1 > self.max_hedge_rate * self.requests:
+                return False
+            self.hedges_issued += 1
+        get_metrics().inc("ewbot_hedges_issued_total")
+        return True
+
+    def send(
+        self, request: Callable[[float], requests.Response], timeout: float
+    ) -> requests.Response:
+        """
+        Send a request, hedging it if it is slower than usual.
+
+        :param request: Callable sending the request with the given timeout in
+            seconds and returning the response.
+        :param timeout: float seconds the caller is willing to wait.
+        :return: the first successful response.
+        """
+        with self.lock:
+            self.requests += 1
+        started = time.monotonic()
+        primary = self.executor.submit(request, timeout)
+        delay = self.tracker.percentile(0.95)
+        if (
+            delay is None
+            or wait([primary], timeout=delay).done
+            or timeout - (time.monotonic() - started) <= 0
+            or not self._may_hedge()
+        ):
+            response = primary.result()
+            self.tracker.record(time.monotonic() - started)
+            return response
+        logger.debug(f"No response after {delay:.3f}s, sending a hedged request.")
+        hedge = self.executor.submit(request, timeout - (time.monotonic() - started))
+        done, _ = wait([primary, hedge], return_when=FIRST_COMPLETED)
+        winner, loser = (primary, hedge) if primary in done else (hedge, primary)
+        if winner.exception() is not None:
+            # The first to answer failed, so wait on the other one instead.
+            winner, loser = loser, winner
+        else:
+            loser.cancel()
+            loser.add_done_callback(_discard)
+        response = winner.result()
+        self.tracker.record(time.monotonic() - started)
+        if winner is hedge:
+            with self.lock:
+                self.hedges_won += 1
+            get_metrics().inc("ewbot_hedges_won_total")
+        return response
+
+    @property
+    def metrics(self) -> Dict[str, int]:
+        """
+        :return: dict of requests sent, hedges issued and hedges that answered first.
+        """
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "hedges_issued": self.hedges_issued,
+                "hedges_won": self.hedges_won,
+            }
+
+
+_hedger: Optional[HedgedRequests] = None
+
+
+def get_hedger() -> Optional[HedgedRequests]:
+    """
+    Fetch the hedger for quoteservice requests, if `EWBOT_HEDGE_QUOTES` sets the
+    largest share of requests that may be hedged, e.g. 0.05.
+
+    :return: HedgedRequests, or None if hedging is off.
+    """
+    global _hedger
+    rate = float(os.environ.get("EWBOT_HEDGE_QUOTES", default="0"))
+    if rate <= 0:
+        return None
+    if _hedger is None:
+        _hedger = HedgedRequests(max_hedge_rate=rate)
+    return _hedger
@@ -1,17 +1,41 @@
+import io
+import os
+import tempfile
 import textwrap
-from typing import Any, Dict, Optional
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Dict, Iterator, Optional
 
-from PIL import Image, ImageDraw, ImageFont
+from ewtwitterbot.tracing import span
+
+# Pillow is only imported once an image is rendered, so that a cycle with no
+# mentions to reply to doesn't pay for loading it.
+if TYPE_CHECKING:  # pragma: nocover
+    from PIL import Image, ImageFont
 
 # With thanks and apologies to Apoorv Tyagi: https://auth0.com/blog/how-to-make-a-twitter-bot-in-python-using-tweepy/
 
 
+@lru_cache(maxsize=8)
+def load_font(font_path: Optional[str], size: int) -> "ImageFont.FreeTypeFont":
+    """
+    Load a font from the `fonts` directory, keeping it around for later images.
+
+    :param font_path: Relative path from `fonts` to the ttf font file.
+    :param size: int font size.
+    :return: An instance of PIL.ImageFont.FreeTypeFont
+    """
+    from PIL import ImageFont
+
+    return ImageFont.truetype(f"ewtwitterbot/fonts/{font_path}", size)
+
+
 def get_quote_image(
     quote_text: str,
     font_path: Optional[str] = "Raleway/Raleway-Regular.ttf",
-    bgcolor: Optional[tuple] = (126, 47, 139),
-    txtcolor: Optional[tuple] = (255, 255, 255),
-    filename: Optional[str] = "quote_image.png",
+    bgcolor: tuple = (126, 47, 139),
+    txtcolor: tuple = (255, 255, 255),
+    filename: str = "quote_image.png",
 ) -> None:
     """
     Given a quote as text, generate an image with the text on it.
@@ -23,15 +47,63 @@ def get_quote_image(
     :param filename: Filename for generated image.
     :return: str representation of path to generated image.
     """
-    image = Image.new("RGB", (800, 400), color=bgcolor)
-    font = ImageFont.truetype(f"ewtwitterbot/fonts/{font_path}", 40)
-    text_start_height = 100
-    draw_text_on_image(image, quote_text, font, txtcolor, text_start_height)
-    image.save(filename)
+    with open(filename, "wb") as f:
+        f.write(render_quote_image(quote_text, font_path, bgcolor, txtcolor))
+
+
+@lru_cache(maxsize=8)
+def render_quote_image(
+    quote_text: str, font_path: Optional[str], bgcolor: tuple, txtcolor: tuple
+) -> bytes:
+    """
+    Render a quote image as png. The last few images are kept, so replying with the
+    same text again, e.g. when the last quote is reused under load, doesn't render
+    it again.
+
+    :param quote_text: The quote text.
+    :param font_path: Relative path from `fonts` to the ttf font file.
+    :param bgcolor: Tuple representation of RGB color to use on background.
+    :param txtcolor: Tuple representation of RGB color to use for text.
+    :return: bytes of the png image.
+    """
+    from PIL import Image
+
+    with span("render"):
+        image = Image.new("RGB", (800, 400), color=bgcolor)
+        font = load_font(font_path, 40)
+        text_start_height = 100
+        draw_text_on_image(image, quote_text, font, txtcolor, text_start_height)
+    with span("encode"):
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+
+@contextmanager
+def temporary_image_file(prefix: str = "quote_image_") -> Iterator[str]:
+    """
+    Reserve a uniquely named png file to render a quote image to, so replies in
+    flight at the same time, from any account or process, never overwrite each
+    other's image. The file is removed afterwards.
+
+    :param prefix: str start of the file name, e.g. 'quote_image_1234_'
+    :return: str path to the file.
+    """
+    handle, filename = tempfile.mkstemp(prefix=prefix, suffix=".png")
+    os.close(handle)
+    try:
+        yield filename
+    finally:
+        if os.path.exists(filename):
+            os.remove(filename)
 
 
 def draw_text_on_image(
-    image: Image, text: str, font: ImageFont, text_color: tuple, text_start_height: int
+    image: "Image.Image",
+    text: str,
+    font: "ImageFont.FreeTypeFont",
+    text_color: tuple,
+    text_start_height: int,
 ) -> None:
     """
     Given an image, draw the fed text onto it.
@@ -43,6 +115,8 @@ def draw_text_on_image(
     :param text_start_height: int representing the starting height of the text.
     :return: None since it transforms the image in place.
     """
+    from PIL import ImageDraw
+
     draw = ImageDraw.Draw(image)
     image_width, image_height = image.size
     y_text = text_start_height
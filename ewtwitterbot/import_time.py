@@ -0,0 +1,111 @@
+import argparse
+import subprocess
+import sys
+from typing import Dict, List, Optional, Set
+
+# Entry points run by cron, and the modules they should only import once there
+# is something to reply to.
+ENTRY_POINTS = ["ewtwitterbot.twitter_bot", "ewtwitterbot.mastodon_bot"]
+DEFERRED = ["PIL"]
+
+
+def measure_imports(module: str, python: str = sys.executable) -> Dict[str, float]:
+    """
+    Import a module in a fresh interpreter with `-X importtime` and collect the
+    cumulative import time of every module it loaded.
+
+    :param module: str dotted name of the module to import.
+    :param python: str path to the interpreter.
+    :return: dict of module name to cumulative import time in milliseconds.
+    """
+    return _import_times(f"import {module}", python)
+
+
+def startup_modules(python: str = sys.executable) -> Set[str]:
+    """
+    The modules the interpreter imports before running any code, such as `site`,
+    which no entry point can avoid.
+
+    :param python: str path to the interpreter.
+    :return: set of module names.
+    """
+    return set(_import_times("pass", python))
+
+
+def _import_times(code: str, python: str) -> Dict[str, float]:
+    result = subprocess.run(
+        [python, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    timings: Dict[str, float] = {}
+    for line in result.stderr.splitlines():
+        # Lines look like "import time: <self us> | <cumulative us> | <module>".
+        fields = line.split("|")
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            timings[fields[2].strip()] = int(fields[1]) / 1000
+    return timings
+
+
+def check_budget(
+    modules: List[str], budget_ms: float, repeat: int = 5, top: int = 5
+) -> bool:
+    """
+    Report how long each entry point takes to import, best of `repeat` runs, and
+    check it against the budget and that the deferred modules aren't imported.
+    Modules loaded by the interpreter at startup are left out of the slowest imports.
+
+    :param modules: list of dotted module names.
+    :param budget_ms: float most milliseconds an import may take.
+    :param repeat: int number of runs to take the fastest of.
+    :param top: int number of the slowest imports to list for each entry point.
+    :return: bool, True if every entry point is within budget.
+    """
+    ok = True
+    startup = startup_modules()
+    for module in modules:
+        runs = [measure_imports(module) for _ in range(repeat)]
+        best = min(runs, key=lambda timings: timings[module])
+        print(f"{module}: {best[module]:.1f}ms (budget {budget_ms:g}ms)")
+        slowest = sorted(
+            (
+                name
+                for name in best
+                if name != module and "." not in name and name not in startup
+            ),
+            key=lambda name: best[name],
+            reverse=True,
+        )
+        for name in slowest[:top]:
+            print(f"    {name}: {best[name]:.1f}ms")
+        if best[module] > budget_ms:
+            print(f"{module} is over budget.")
+            ok = False
+        for name in DEFERRED:
+            if name in best:
+                print(f"{module} imports {name} at startup.")
+                ok = False
+    return ok
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """
+    Command line entry point for the startup benchmark, exiting non-zero when an
+    entry point is over budget.
+
+    :param argv: Optional list of arguments, defaults to sys.argv.
+    """
+    parser = argparse.ArgumentParser(
+        description="Measure how long the bot entry points take to import."
+    )
+    parser.add_argument("modules", nargs="*", default=ENTRY_POINTS)
+    parser.add_argument("--budget-ms", type=float, default=250)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+    if not check_budget(args.modules, args.budget_ms, args.repeat):
+        sys.exit(1)
+
+
+if __name__ == "__main__":  # pragma: nocover
+    main()
@@ -0,0 +1,94 @@
+import bisect
+import heapq
+import weakref
+from array import array
+from typing import Dict, Set, Tuple, Union
+
+from ewtwitterbot.state import StateStore
+
+
+class ReplyLedger:
+    """
+    Record of the mention ids we have already handled on a platform, checked before
+    doing any work on a mention so we never spend a render, an upload and an API
+    call just to find out we already replied.
+
+    Ids are kept in a sorted array of 64-bit integers (8 bytes per id) for
+    O(log n) lookups, with a small set of recent additions that is merged into
+    the array once it grows past `merge_threshold`. The state store is the
+    durable backing copy.
+    """
+
+    def __init__(
+        self,
+        store: StateStore,
+        platform: str,
+        account: str = "default",
+        merge_threshold: int = 1024,
+    ) -> None:
+        """
+        :param store: The StateStore holding the replied ids.
+        :param platform: str, e.g. 'twitter'
+        :param account: str name of the account.
+        :param merge_threshold: Number of recent additions to buffer before merging.
+        """
+        self.store = store
+        self.platform = platform
+        self.account = account
+        self.merge_threshold = merge_threshold
+        self.ids = array("q", store.replied_ids(platform, account))
+        self.recent: Set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self.ids) + len(self.recent)
+
+    def __contains__(self, mention_id: Union[int, str]) -> bool:
+        mention_id = int(mention_id)
+        if mention_id in self.recent:
+            return True
+        index = bisect.bisect_left(self.ids, mention_id)
+        return index < len(self.ids) and self.ids[index] == mention_id
+
+    def add(self, mention_id: Union[int, str]) -> None:
+        """
+        Record a mention as handled, both in memory and in the state store.
+
+        :param mention_id: int
+        """
+        mention_id = int(mention_id)
+        if mention_id in self:
+            return
+        self.store.mark_replied(self.platform, mention_id, self.account)
+        self.recent.add(mention_id)
+        if len(self.recent) >= self.merge_threshold:
+            self.merge()
+
+    def merge(self) -> None:
+        """
+        Fold the recent additions into the sorted array.
+        """
+        self.ids = array("q", heapq.merge(self.ids, sorted(self.recent)))
+        self.recent.clear()
+
+
+_ledgers: "weakref.WeakKeyDictionary[StateStore, Dict[Tuple[str, str], ReplyLedger]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_ledger(
+    store: StateStore, platform: str, account: str = "default"
+) -> ReplyLedger:
+    """
+    Fetch the ledger for a platform and account, loading it from the store only the
+    first time it is asked for, so a long-running process keeps it warm between cycles.
+
+    :param store: The StateStore holding the replied ids.
+    :param platform: str, e.g. 'twitter'
+    :param account: str name of the account.
+    :return: ReplyLedger
+    """
+    ledgers = _ledgers.setdefault(store, {})
+    if (platform, account) not in ledgers:
+        ledgers[(platform, account)] = ReplyLedger(store, platform, account)
+    return ledgers[(platform, account)]
@@ -0,0 +1,178 @@
+import json
+import os
+import time
+from datetime import datetime
+from enum import IntEnum
+from typing import Any, Callable, List, Optional, Tuple, TypeVar
+
+from ewtwitterbot.media_cache import MEDIA_LIFETIMES
+from ewtwitterbot.state import StateStore
+
+T = TypeVar("T")
+
+
+class LoadLevel(IntEnum):
+    """
+    How far replies are degraded to keep up with the backlog. Each level also
+    applies everything the levels below it do.
+    """
+
+    NORMAL = 0
+    # Reuse the last reply to the same kind of request, so its image and media id
+    # are already cached.
+    REUSE = 1
+    # Reply with the quote and citation as text, without an image.
+    TEXT_ONLY = 2
+    # Drop the oldest mentions.
+    SHED = 3
+
+
+class LoadShedder:
+    """
+    Picks a LoadLevel for a cycle from the number of mentions waiting and the age of
+    the oldest one, so the bot degrades gracefully instead of letting latency grow
+    for everyone during a spike. Without any thresholds every cycle is NORMAL.
+    """
+
+    def __init__(
+        self,
+        reuse_depth: Optional[int] = None,
+        text_only_depth: Optional[int] = None,
+        shed_depth: Optional[int] = None,
+        max_age: Optional[float] = None,
+    ) -> None:
+        """
+        :param reuse_depth: Optional int number of waiting mentions at which quotes are reused.
+        :param text_only_depth: Optional int number of waiting mentions at which replies are text only.
+        :param shed_depth: Optional int number of waiting mentions kept once mentions are being dropped.
+            The number of waiting mentions is not taken into account for a level
+            whose depth is None.
+        :param max_age: Optional seconds after which a mention is dropped. A quarter and
+            half of it are the ages at which quotes are reused and replies are text only.
+            Mention age is not taken into account if it is None.
+        """
+        self.reuse_depth = reuse_depth
+        self.text_only_depth = text_only_depth
+        self.shed_depth = shed_depth
+        self.max_age = max_age
+
+    def level(self, depth: int, oldest_age: float) -> LoadLevel:
+        """
+        :param depth: int number of mentions waiting.
+        :param oldest_age: Seconds since the oldest waiting mention was posted.
+        :return: LoadLevel
+        """
+        age = 0.0 if self.max_age is None else oldest_age / self.max_age
+        if (self.shed_depth is not None and depth > self.shed_depth) or age >= 1:
+            return LoadLevel.SHED
+        if (
+            self.text_only_depth is not None and depth >= self.text_only_depth
+        ) or age >= 1 / 2:
+            return LoadLevel.TEXT_ONLY
+        if (self.reuse_depth is not None and depth >= self.reuse_depth) or age >= 1 / 4:
+            return LoadLevel.REUSE
+        return LoadLevel.NORMAL
+
+    def shed(
+        self, items: List[T], age_of: Callable[[T], float]
+    ) -> Tuple[List[T], List[T]]:
+        """
+        Drop mentions older than `max_age`, if set, then the oldest of the rest until
+        no more than `shed_depth`, if set, are left.
+
+        :param items: list of mentions, in the order they will be served.
+        :param age_of: Callable returning the age of a mention in seconds.
+        :return: tuple of the list kept, in the same order, and the list dropped.
+        """
+        max_age = float("inf") if self.max_age is None else self.max_age
+        fresh = [item for item in items if age_of(item) < max_age]
+        dropped = [item for item in items if age_of(item) >= max_age]
+        if self.shed_depth is not None and len(fresh) > self.shed_depth:
+            by_age = sorted(fresh, key=age_of, reverse=True)
+            dropped.extend(by_age[: len(fresh) - self.shed_depth])
+        dropped_ids = {id(item) for item in dropped}
+        return [item for item in fresh if id(item) not in dropped_ids], dropped
+
+
+def get_load_shedder() -> LoadShedder:
+    """
+    Create a LoadShedder from the thresholds in the environment. The optional
+    `EWBOT_LOAD_THRESHOLDS` holds the reuse, text only and shed depths separated by
+    commas, and the optional `EWBOT_MAX_MENTION_AGE` the age in seconds after which
+    mentions are dropped. Replies are never degraded unless one of them is set.
+
+    :return: LoadShedder
+    """
+    thresholds = os.environ.get("EWBOT_LOAD_THRESHOLDS", default=None)
+    reuse: Optional[int] = None
+    text_only: Optional[int] = None
+    shed: Optional[int] = None
+    if thresholds is not None:
+        reuse, text_only, shed = (int(value) for value in thresholds.split(","))
+    max_age = os.environ.get("EWBOT_MAX_MENTION_AGE", default=None)
+    return LoadShedder(
+        reuse, text_only, shed, float(max_age) if max_age is not None else None
+    )
+
+
+def mention_age(created_at: Any, now: Optional[float] = None) -> float:
+    """
+    Seconds since a mention was posted, or 0 if that isn't known.
+
+    :param created_at: datetime the mention was posted.
+    :param now: Optional timestamp, mostly for testing.
+    :return: float
+    """
+    if not isinstance(created_at, datetime):
+        return 0.0
+    now = time.time() if now is None else now
+    return max(now - created_at.timestamp(), 0.0)
+
+
+def remember_reply(
+    store: StateStore,
+    platform: str,
+    kind: str,
+    text_to_use: str,
+    link_to_quote: Optional[str],
+    account: str = "default",
+) -> None:
+    """
+    Keep the last reply sent for each kind of request, so it can be reused under
+    load while its image and media are still cached.
+
+    :param store: The StateStore.
+    :param platform: str, e.g. 'twitter'
+    :param kind: str kind of request replied to, see `request_kind`.
+    :param text_to_use: str text rendered onto the image.
+    :param link_to_quote: str citation url.
+    :param account: str name of the account.
+    """
+    lifetime = MEDIA_LIFETIMES.get(platform) or 60 * 60
+    store.cache_set(
+        f"replies:{platform}:{account}",
+        kind,
+        json.dumps([text_to_use, link_to_quote]),
+        time.time() + lifetime,
+    )
+
+
+def recent_reply(
+    store: StateStore, platform: str, kind: str, account: str = "default"
+) -> Optional[Tuple[str, Optional[str]]]:
+    """
+    Fetch the last reply sent for the kind of request, if it is recent enough to
+    reuse. A request for a quote is only ever answered with a quote, and one for a
+    sentence with a sentence.
+
+    :param store: The StateStore.
+    :param platform: str, e.g. 'twitter'
+    :param kind: str kind of request, see `request_kind`.
+    :param account: str name of the account.
+    :return: tuple of text and citation url, or None.
+    """
+    value = store.cache_get(f"replies:{platform}:{account}", kind)
+    if value is None:
+        return None
+    text_to_use, link_to_quote = json.loads(value)
+    return text_to_use, link_to_quote
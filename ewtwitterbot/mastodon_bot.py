@@ -1,11 +1,61 @@
+import argparse
+import asyncio
 import os
-from typing import Any, Optional, Union
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
+import requests
 from loguru import logger
-from mastodon import Mastodon, MastodonError
+from mastodon import Mastodon, MastodonAPIError, MastodonError, StreamListener
+from requests.exceptions import RequestException, Timeout
 
-from ewtwitterbot.imagery import get_quote_image
-from ewtwitterbot.status_processing import process_request
+from ewtwitterbot.daemon import AdaptiveInterval, install_signal_handlers, serve
+from ewtwitterbot.deadline import (
+    Deadline,
+    DeadlineExceeded,
+    deadline_of,
+    get_reply_budget,
+    with_timeout,
+)
+from ewtwitterbot.fairness import get_fair_scheduler
+from ewtwitterbot.imagery import get_quote_image, temporary_image_file
+from ewtwitterbot.ledger import ReplyLedger, get_ledger
+from ewtwitterbot.load_shedding import (
+    LoadLevel,
+    get_load_shedder,
+    mention_age,
+    recent_reply,
+    remember_reply,
+)
+from ewtwitterbot.metrics import exported_metrics, get_metrics
+from ewtwitterbot.profiling import MODES, CycleProfiler, get_profiler, profiled
+from ewtwitterbot.rate_limit import (
+    DEFAULT_LIMITS,
+    account_of,
+    get_rate_limiter,
+    set_account,
+)
+from ewtwitterbot.retry_queue import RetryQueue
+from ewtwitterbot.run_lock import acquire_run_lock
+from ewtwitterbot.state import StateStore
+from ewtwitterbot.status_processing import (
+    format_text_reply,
+    process_request,
+    request_kind,
+)
+from ewtwitterbot.tracing import configure_logging, span, trace_mention
+from ewtwitterbot.work_queue import WorkQueue, get_worker_name
+
+# Reply stage each API call is traced and timed as, by endpoint. Other calls
+# are traced under their own name.
+STAGES = {
+    "notifications": "mention_fetch",
+    "fetch_previous": "mention_fetch",
+    "media_post": "upload",
+    "media_update": "upload",
+    "status_post": "post",
+}
 
 
 class MastodonConfigurationError(Exception):
@@ -16,6 +66,33 @@ class MastodonMediaError(Exception):
     pass
 
 
+class StopStreaming(Exception):
+    pass
+
+
+def get_credentials(
+    api_base_url: str,
+    access_token: str,
+    account: str = "default",
+    session: Optional[requests.Session] = None,
+) -> Mastodon:
+    """
+    Create a client for one account. The account name is kept on the client so its
+    calls are paced against that account's rate limits.
+
+    :param api_base_url: str url of the instance.
+    :param access_token: str access token, or path to the file holding it.
+    :param account: str name of the account.
+    :param session: Optional requests.Session to share between accounts' clients.
+    :return: Mastodon
+    """
+    api = Mastodon(
+        access_token=access_token, api_base_url=api_base_url, session=session
+    )
+    set_account(api, account)
+    return api
+
+
 def get_credentials_from_environ() -> Mastodon:
     """
     Use environment variables and local files to retrieve Mastodon API instance.
@@ -31,108 +108,1124 @@ def get_credentials_from_environ() -> Mastodon:
     )
     if client_secret is None or user_secret is None or api_base_url is None:
         raise MastodonConfigurationError
-    return Mastodon(access_token=str(user_secret), api_base_url=str(api_base_url))
+    return get_credentials(str(api_base_url), str(user_secret))
+
+
+def call_api(api: Mastodon, endpoint: str, *args: Any, **kwargs: Any) -> Any:
+    """
+    Call a Mastodon method once it fits in the client's account's rate limit budget,
+    then update the budget from the rate limit the instance reported. Instances limit
+    all of an account's calls together, with a separate, tighter limit on uploads.
+    A client bounded by a deadline gives up rather than wait past it.
+
+    :param api: Mastodon
+    :param endpoint: str name of the Mastodon method, e.g. 'status_post'
+    :return: whatever the method returns.
+    """
+    limiter = get_rate_limiter()
+    account = account_of(api)
+    deadline = deadline_of(api)
+    if ("mastodon", endpoint) in DEFAULT_LIMITS:
+        limiter.wait("mastodon", endpoint, account, deadline)
+    limiter.wait("mastodon", "all", account, deadline)
+    try:
+        with span(STAGES.get(endpoint, endpoint), platform="mastodon"):
+            return getattr(api, endpoint)(*args, **kwargs)
+    finally:
+        limiter.update(
+            "mastodon",
+            "all",
+            getattr(api, "ratelimit_remaining", None),
+            getattr(api, "ratelimit_reset", None),
+            getattr(api, "ratelimit_limit", None),
+            account,
+        )
 
 
-def get_last_toot_id(filename: str) -> int:
+def post_media(api: Mastodon, img_filename: str, alt_text: str) -> Dict[str, Any]:
     """
-    Given a filename, fetch the latest toot id, if any.
+    Upload an image with its alt text and return the media dict the server created.
+    The server may still be processing it, in which case its `url` is empty.
 
-    :param filename: str
-    :return: int
+    :param api: Mastodon
+    :param img_filename: str
+    :param alt_text: str
+    :return: media dict
     """
-    if os.path.exists(filename):
-        with open(filename, "r") as f:
-            last_id = int(f.read().strip())
-            logger.debug(f"Fetched last id as {last_id}...")
-        return last_id
-    logger.debug("No saved toot id so returning 1 as error code.")
-    return 1
+    response = call_api(
+        api, "media_post", media_file=img_filename, description=alt_text
+    )
+    if response["type"] != "image":
+        raise MastodonMediaError
+    return response
 
 
-def save_last_toot_id(last_id: int, filename: str) -> None:
+def media_ready(media: Dict[str, Any]) -> bool:
     """
-    Given an id and a filename, save the id to a file.
+    Check whether the server has finished processing an uploaded attachment.
 
-    :param last_id: int
-    :param filename: str
+    :param media: media dict
+    :return: bool
+    """
+    return media.get("url") is not None
+
+
+def wait_for_media(
+    api: Mastodon,
+    media: Dict[str, Any],
+    poll_interval: float = 1,
+    timeout: float = 30,
+    deadline: Optional[Deadline] = None,
+) -> Dict[str, Any]:
+    """
+    Block until the server has finished processing an uploaded attachment.
+
+    Mastodon.py has no endpoint for fetching a media attachment, so its state is
+    read back with an empty `media_update`.
+
+    :param api: Mastodon
+    :param media: media dict returned by `post_media`.
+    :param poll_interval: Seconds between checks.
+    :param timeout: Seconds to wait before giving up.
+    :param deadline: Optional Deadline of the reply, which can end the wait sooner.
+    :return: the processed media dict.
     """
-    with open(filename, "w") as f:
-        f.write(str(last_id))
-    logger.debug(f"Saved {last_id} to {filename}!")
+    give_up_at = time.monotonic() + timeout
+    if deadline is not None:
+        give_up_at = min(give_up_at, deadline.expires_at)
+    while not media_ready(media):
+        if time.monotonic() >= give_up_at:
+            raise MastodonMediaError(f"Media {media['id']} is still processing.")
+        time.sleep(poll_interval)
+        media = call_api(
+            with_timeout(api, "request_timeout", deadline, "media processing"),
+            "media_update",
+            media["id"],
+        )
+    return media
 
 
 def upload_image_and_description(
-    api: Mastodon, img_filename: str, alt_text: str
+    api: Mastodon,
+    img_filename: str,
+    alt_text: str,
+    deadline: Optional[Deadline] = None,
 ) -> str:
     """
     Upload an image via the supplied api wrapper and alt text and retrieve the media id
-    created for it as a str.
+    created for it as a str, once the server has finished processing it.
 
     :param api: Mastodon
     :param img_filename: str
     :param alt_text: str
+    :param deadline: Optional Deadline bounding the upload and processing.
     :return: str
     """
-    response = api.media_post(media_file=img_filename, description=alt_text)
-    if response["type"] != "image":
-        raise MastodonMediaError
-    return response["id"]
+    media = post_media(
+        with_timeout(api, "request_timeout", deadline, "upload"), img_filename, alt_text
+    )
+    return wait_for_media(api, media, deadline=deadline)["id"]
+
 
+def is_duplicate(error: MastodonError) -> bool:
+    """
+    Check whether the instance turned a reply down as a duplicate of one already
+    posted, e.g. by an earlier try whose response was lost to a timeout. Mastodon
+    answers those with 422 Unprocessable Entity.
 
-def respond_to_toots(filename: Optional[str] = "last_toot.txt") -> None:
+    :param error: MastodonError raised by the post.
+    :return: bool
     """
-    Given the filename of the stored toot id respond to mastodon mentions.
+    return isinstance(error, MastodonAPIError) and error.args[1:2] == (422,)
+
 
-    :param filename: str
+def post_status(api: Mastodon, in_reply_to_id: int, status: str, **kwargs: Any) -> bool:
+    """
+    Post a reply to the mentioning status. The post carries an idempotency key
+    derived from the status replied to, so if a try times out after the instance
+    took it, the retry returns the reply already posted instead of a second one.
+
+    :param api: Mastodon
+    :param in_reply_to_id: id of the status to reply to.
+    :param status: str text of the reply.
+    :param kwargs: Extra arguments for `status_post`, e.g. media_ids.
+    :return: False if the post failed, e.g. timed out, and should be retried, else
+        True, including when it had already been posted.
     """
     try:
-        api = get_credentials_from_environ()
-    except MastodonConfigurationError:  # pragma: nocover
-        logger.error("Mastodon is not configured correctly.")
-        return
-    last_id = get_last_toot_id(filename)
+        call_api(
+            api,
+            "status_post",
+            in_reply_to_id=in_reply_to_id,
+            visibility="public",
+            status=status,
+            idempotency_key=f"ewbot-reply-{in_reply_to_id}",
+            **kwargs,
+        )
+    except MastodonError as e:
+        if not is_duplicate(e):
+            logger.error(f"Error while posting to Mastodon: {e}")
+            return False
+        logger.info(f"Already replied to {in_reply_to_id}")
+    return True
 
-    mentions = api.notifications(mentions_only=True, since_id=last_id)
 
-    if len(mentions) == 0:  # pragma: nocover
-        logger.debug("No new mentions on Mastodon! Exiting...")
-        return
+def post_reply(
+    api: Mastodon,
+    in_reply_to_id: int,
+    acct: str,
+    media_id: str,
+    link_to_quote: Optional[str],
+) -> bool:
+    """
+    Reply to the mentioning status with an uploaded image.
 
-    text_to_use: Optional[str]
-    logger.info("Found notifications on Mastodon...")
-    for mention in reversed(mentions):
-        if mention["type"] == "mention":
-            logger.info("Someone mentioned me on Mastodon...")
-            logger.debug(
-                f"Mention id is {mention['id']} and it looks like this {mention}"
-            )
-            logger.info(str(mention["id"]) + " - " + mention["status"]["content"])
-            new_id = mention["id"]
-            text_to_use, link_to_quote = process_request(
-                mention["status"]["content"], "Mastodon"
+    :param api: Mastodon
+    :param in_reply_to_id: id of the status to reply to.
+    :param acct: str account name of the user who mentioned us.
+    :param media_id: str id of the uploaded image.
+    :param link_to_quote: str citation url to include in the reply.
+    :return: False if the reply should be retried, else True.
+    """
+    return post_status(
+        api,
+        in_reply_to_id,
+        f"@{acct} Here you go. Peaceful journeys. {link_to_quote}",
+        media_ids=[media_id],
+    )
+
+
+def post_text_reply(
+    api: Mastodon,
+    in_reply_to_id: int,
+    acct: str,
+    text_to_use: str,
+    link_to_quote: Optional[str],
+) -> bool:
+    """
+    Reply to the mentioning status with the quote or sentence as text, to shed load.
+
+    :param api: Mastodon
+    :param in_reply_to_id: id of the status to reply to.
+    :param acct: str account name of the user who mentioned us.
+    :param text_to_use: str text that would have been rendered onto the image.
+    :param link_to_quote: str citation url to include in the reply.
+    :return: False if the reply should be retried, else True.
+    """
+    return post_status(
+        api,
+        in_reply_to_id,
+        format_text_reply(f"@{acct}", text_to_use, link_to_quote, 500),
+    )
+
+
+def reply_to_mention(
+    api: Mastodon,
+    in_reply_to_id: int,
+    acct: str,
+    text_to_use: str,
+    link_to_quote: Optional[str],
+    text_only: bool = False,
+    deadline: Optional[Deadline] = None,
+) -> bool:
+    """
+    Render the quote image, upload it, and reply to the mentioning status with it.
+
+    :param api: Mastodon
+    :param in_reply_to_id: id of the status to reply to.
+    :param acct: str account name of the user who mentioned us.
+    :param text_to_use: str text to render onto the image.
+    :param link_to_quote: str citation url to include in the reply.
+    :param text_only: bool, reply with the text itself instead of an image, to shed load.
+    :param deadline: Optional Deadline bounding the upload and post.
+    :return: False if the media upload failed or the deadline ran out and the reply
+        should be retried, else True.
+    """
+    try:
+        if text_only:
+            return post_text_reply(
+                with_timeout(api, "request_timeout", deadline, "post"),
+                in_reply_to_id,
+                acct,
+                text_to_use,
+                link_to_quote,
             )
-            if text_to_use is not None:
-                logger.debug("Generating image for requested quote/sentence...")
-                get_quote_image(text_to_use, filename="mastodon_quote_image.png")
+        if deadline is not None:
+            deadline.timeout("render")
+        logger.debug("Generating image for requested quote/sentence...")
+        with temporary_image_file(
+            f"mastodon_quote_image_{in_reply_to_id}_"
+        ) as image_filename:
+            get_quote_image(text_to_use, filename=image_filename)
+            try:
                 media_id = upload_image_and_description(
                     api=api,
-                    img_filename="mastodon_quote_image.png",
+                    img_filename=image_filename,
                     alt_text=text_to_use,
+                    deadline=deadline,
                 )
-                if media_id is None:  # pragma: nocover
-                    return
+            except (MastodonError, MastodonMediaError) as e:
+                logger.error(f"Error uploading media to Mastodon: {e}")
+                return False
+        if media_id is None:  # pragma: nocover
+            return False
+        return post_reply(
+            with_timeout(api, "request_timeout", deadline, "post"),
+            in_reply_to_id,
+            acct,
+            media_id,
+            link_to_quote,
+        )
+    except DeadlineExceeded as e:
+        logger.warning(f"Ran out of time replying to {in_reply_to_id}. {e}")
+        return False
+
+
+async def reply_to_mentions_async(
+    api: Mastodon,
+    payloads: List[Dict[str, Any]],
+    concurrency: int = 4,
+    poll_interval: float = 1,
+    timeout: float = 30,
+    text_only: bool = False,
+    deadlines: Optional[List[Optional[Deadline]]] = None,
+) -> List[bool]:
+    """
+    Reply to several mentions at once. The images are rendered and uploaded
+    concurrently, their processing state is polled without holding up the other
+    replies, and each status is posted as soon as its own attachment is ready. At
+    most `concurrency` requests are made to the instance at any one time.
+
+    :param api: Mastodon
+    :param payloads: list of dicts of `reply_to_mention` arguments.
+    :param concurrency: int maximum number of requests in flight to the instance.
+    :param poll_interval: Seconds between checks on an attachment still processing.
+    :param timeout: Seconds to wait for an attachment to be processed.
+    :param text_only: bool, reply with the text itself instead of images, to shed load.
+    :param deadlines: Optional list of each reply's Deadline, in the same order as `payloads`.
+    :return: list of bools in the same order as `payloads`, False where the reply should be retried.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(func: Callable[..., Any], *args: Any) -> Any:
+        async with semaphore:
+            return await asyncio.to_thread(func, *args)
+
+    async def reply(payload: Dict[str, Any], deadline: Optional[Deadline]) -> bool:
+        def bounded(stage: str) -> Mastodon:
+            return with_timeout(api, "request_timeout", deadline, stage)
+
+        with trace_mention("mastodon", payload["in_reply_to_id"], account_of(api)):
+            try:
+                if text_only:
+                    return await call(
+                        post_text_reply,
+                        bounded("post"),
+                        payload["in_reply_to_id"],
+                        payload["acct"],
+                        payload["text_to_use"],
+                        payload["link_to_quote"],
+                    )
+                if deadline is not None:
+                    deadline.timeout("render")
+                with temporary_image_file(
+                    f"mastodon_quote_image_{payload['in_reply_to_id']}_"
+                ) as image_filename:
+                    await asyncio.to_thread(
+                        get_quote_image, payload["text_to_use"], filename=image_filename
+                    )
+                    media = await call(
+                        post_media,
+                        bounded("upload"),
+                        image_filename,
+                        payload["text_to_use"],
+                    )
+                give_up_at = time.monotonic() + timeout
+                if deadline is not None:
+                    give_up_at = min(give_up_at, deadline.expires_at)
+                while not media_ready(media):
+                    if time.monotonic() >= give_up_at:
+                        raise MastodonMediaError(
+                            f"Media {media['id']} is still processing."
+                        )
+                    await asyncio.sleep(poll_interval)
+                    media = await call(
+                        call_api,
+                        bounded("media processing"),
+                        "media_update",
+                        media["id"],
+                    )
+                return await call(
+                    post_reply,
+                    bounded("post"),
+                    payload["in_reply_to_id"],
+                    payload["acct"],
+                    media["id"],
+                    payload["link_to_quote"],
+                )
+            except Exception as e:
+                logger.error(f"Error replying to {payload['in_reply_to_id']}: {e}")
+                return False
+
+    if deadlines is None:
+        deadlines = [None] * len(payloads)
+    return await asyncio.gather(
+        *(reply(payload, deadline) for payload, deadline in zip(payloads, deadlines))
+    )
+
+
+def retry_failed_replies(api: Mastodon, queue: RetryQueue) -> None:
+    """
+    Attempt any queued replies whose backoff has elapsed. Replies that ran out of
+    time before their quote was fetched fetch it first.
+
+    :param api: Mastodon
+    :param queue: The RetryQueue holding failed replies.
+    """
+    for item in queue.due():
+        with trace_mention(
+            "mastodon", item["payload"]["in_reply_to_id"], queue.account
+        ):
+            logger.info(f"Retrying reply to {item['mention_id']}...")
+            deadline = Deadline(get_reply_budget())
+            payload = dict(item["payload"])
+            request = payload.pop("request", None)
+            if request is not None:
                 try:
-                    api.status_post(
-                        in_reply_to_id=mention["status"]["id"],
-                        media_ids=[media_id],
-                        visibility="public",
-                        status=f"@{mention['status']['account']['acct']} Here you go. Peaceful journeys. {link_to_quote}",  # noqa: E501
+                    text_to_use, link_to_quote = process_request(
+                        request, "Mastodon", deadline=deadline
+                    )
+                except (DeadlineExceeded, Timeout) as e:
+                    logger.warning(f"Ran out of time fetching a quote again. {e}")
+                    queue.record_failure(item["mention_id"])
+                    continue
+                if text_to_use is None:
+                    queue.remove(item["mention_id"])
+                    continue
+                payload.update(text_to_use=text_to_use, link_to_quote=link_to_quote)
+            if reply_to_mention(api, deadline=deadline, **payload):
+                queue.remove(item["mention_id"])
+            else:
+                queue.record_failure(item["mention_id"])
+
+
+def iter_notifications(
+    api: Mastodon,
+    since_id: int,
+    limit: Optional[int] = None,
+    page_size: int = 40,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Lazily page through mention notifications newer than `since_id`, oldest-first.
+    Each page is requested with `min_id` so the server returns the notifications
+    right after the ones we have seen, and the next newer page is only fetched
+    with `fetch_previous` once the current one has been consumed.
+
+    :param api: Mastodon
+    :param since_id: int id of the last notification already handled.
+    :param limit: Optional int maximum number of notifications to yield.
+    :param page_size: int number of notifications to request per page.
+    :return: iterator of notification dicts.
+    """
+    yielded = 0
+    page = call_api(
+        api, "notifications", mentions_only=True, min_id=since_id, limit=page_size
+    )
+    while page:
+        logger.debug(f"Fetched a page of {len(page)} notifications.")
+        for notification in sorted(page, key=lambda n: n["id"]):
+            if limit is not None and yielded >= limit:
+                logger.info(f"Reached {limit} mentions, leaving the rest for later.")
+                return
+            yield notification
+            yielded += 1
+        page = call_api(api, "fetch_previous", page)
+
+
+def bootstrap_since_id(
+    api: Mastodon, store: StateStore, account: str = "default"
+) -> int:
+    """
+    Start a fresh store from the newest mention notification instead of paging up
+    from the oldest one, which on an account with a history would flood old
+    threads with replies.
+
+    :param api: Mastodon
+    :param store: The StateStore to seed.
+    :param account: str name of the account.
+    :return: int the since-id stored.
+    """
+    page = call_api(api, "notifications", mentions_only=True, limit=1)
+    since_id = page[0]["id"] if page else 1
+    logger.info(f"No since-id stored yet, starting after notification {since_id}.")
+    store.set_since_id("mastodon", since_id, account)
+    return since_id
+
+
+def dismiss_enabled() -> bool:
+    """
+    Check the environment to see whether handled notifications should be dismissed.
+
+    :return: bool
+    """
+    return os.environ.get("MASTODON_DISMISS_NOTIFICATIONS", default="").lower() in (
+        "1",
+        "true",
+        "yes",
+    )
+
+
+class NotificationDismisser:
+    """
+    Collects handled notification ids and dismisses them on the server in batches,
+    so the notifications list we poll stays small. A batch is only dismissed after
+    the state store has been committed, so a crash can never lose a notification
+    that was dismissed but not yet recorded as handled.
+    """
+
+    def __init__(self, api: Mastodon, store: StateStore, batch_size: int = 20) -> None:
+        """
+        :param api: Mastodon
+        :param store: The StateStore to commit before dismissing.
+        :param batch_size: Number of ids to collect before dismissing them.
+        """
+        self.api = api
+        self.store = store
+        self.batch_size = batch_size
+        self.pending: List[int] = []
+
+    def add(self, notification_id: int) -> None:
+        """
+        Queue a notification for dismissal, dismissing the batch if it is full.
+
+        :param notification_id: int
+        """
+        self.pending.append(notification_id)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Commit the state store and dismiss every pending notification.
+        """
+        if not self.pending:
+            return
+        self.store.commit()
+        for notification_id in self.pending:
+            try:
+                call_api(self.api, "notifications_dismiss", notification_id)
+            except MastodonError as e:
+                logger.error(f"Could not dismiss notification {notification_id}: {e}")
+        logger.debug(f"Dismissed {len(self.pending)} notifications.")
+        self.pending = []
+
+
+def prepare_reply(
+    mention: Dict[str, Any],
+    ledger: ReplyLedger,
+    store: Optional[StateStore] = None,
+    level: LoadLevel = LoadLevel.NORMAL,
+    deadline: Optional[Deadline] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Work out the reply to a mention notification, if it is new and asks for a
+    quote or sentence. Under load the last reply to the same kind of request is
+    reused instead of fetching a new quote.
+
+    If the deadline runs out while fetching the quote, the reply is returned with
+    no text and the mention's content as `request`, so it can be queued and the
+    quote fetched when it is retried.
+
+    :param mention: notification dict of type mention.
+    :param ledger: The ReplyLedger of handled mentions.
+    :param store: Optional StateStore keeping the last reply for reuse under load.
+    :param level: LoadLevel of the current cycle.
+    :param deadline: Optional Deadline bounding the quote fetch.
+    :return: dict of `reply_to_mention` arguments, or None if there is nothing to reply.
+    """
+    logger.info("Someone mentioned me on Mastodon...")
+    logger.debug("Mention {} looks like this {}", mention["id"], mention)
+    logger.info("Mention {}: {}", mention["id"], mention["status"]["content"])
+    if mention["id"] in ledger:
+        logger.info(f"Already replied to {mention['id']}")
+        return None
+    content = mention["status"]["content"]
+    reused = None
+    text_to_use: Optional[str] = None
+    link_to_quote: Optional[str] = None
+    kind = request_kind(content)
+    if store is not None and level >= LoadLevel.REUSE and kind is not None:
+        reused = recent_reply(store, "mastodon", kind, ledger.account)
+    if reused is not None:
+        text_to_use, link_to_quote = reused
+    else:
+        try:
+            text_to_use, link_to_quote = process_request(
+                content, "Mastodon", deadline=deadline
+            )
+        except (DeadlineExceeded, Timeout) as e:
+            logger.warning(f"Ran out of time fetching a quote for {mention['id']}. {e}")
+            return {
+                "in_reply_to_id": mention["status"]["id"],
+                "acct": mention["status"]["account"]["acct"],
+                "text_to_use": None,
+                "link_to_quote": None,
+                "request": content,
+            }
+        if text_to_use is not None and store is not None and kind is not None:
+            remember_reply(
+                store, "mastodon", kind, text_to_use, link_to_quote, ledger.account
+            )
+    if text_to_use is None:
+        return None
+    return {
+        "in_reply_to_id": mention["status"]["id"],
+        "acct": mention["status"]["account"]["acct"],
+        "text_to_use": text_to_use,
+        "link_to_quote": link_to_quote,
+    }
+
+
+def handle_notification(
+    api: Mastodon,
+    mention: Dict[str, Any],
+    store: StateStore,
+    ledger: ReplyLedger,
+    queue: RetryQueue,
+    advance_since_id: bool = True,
+    level: LoadLevel = LoadLevel.NORMAL,
+) -> None:
+    """
+    Handle a single notification: reply to it if it is a new mention asking for a
+    quote or sentence, then record it as handled and advance the since-id. The
+    reply has `EWBOT_REPLY_BUDGET` seconds from start to finish, and is queued for
+    retry if it runs out.
+
+    :param api: Mastodon
+    :param mention: notification dict.
+    :param store: The StateStore.
+    :param ledger: The ReplyLedger of handled mentions.
+    :param queue: The RetryQueue for failed replies.
+    :param advance_since_id: False when notifications are handled out of order and
+        the caller advances the since-id once the whole batch is done.
+    :param level: LoadLevel of the current cycle.
+    """
+    if mention["type"] != "mention":
+        return
+    with trace_mention("mastodon", mention["status"]["id"], queue.account):
+        deadline = Deadline(get_reply_budget())
+        payload = prepare_reply(mention, ledger, store, level, deadline)
+        if payload is not None and (
+            payload["text_to_use"] is None
+            or not reply_to_mention(
+                api,
+                text_only=level >= LoadLevel.TEXT_ONLY,
+                deadline=deadline,
+                **payload,
+            )
+        ):
+            queue.push(mention["id"], payload)
+        ledger.add(mention["id"])
+        if advance_since_id:
+            store.set_since_id("mastodon", mention["id"], queue.account)
+        store.maybe_commit()
+
+
+def handle_notifications_concurrently(
+    api: Mastodon,
+    mentions: List[Dict[str, Any]],
+    store: StateStore,
+    ledger: ReplyLedger,
+    queue: RetryQueue,
+    concurrency: int = 4,
+    level: LoadLevel = LoadLevel.NORMAL,
+) -> None:
+    """
+    Handle a batch of notifications with their replies in flight concurrently. The
+    mentions are only recorded as handled, and the since-id advanced, once every
+    reply in the batch has finished.
+
+    :param api: Mastodon
+    :param mentions: list of notification dicts.
+    :param store: The StateStore.
+    :param ledger: The ReplyLedger of handled mentions.
+    :param queue: The RetryQueue for failed replies.
+    :param concurrency: int maximum number of requests in flight to the instance.
+    :param level: LoadLevel of the current cycle.
+    """
+    mentions = [mention for mention in mentions if mention["type"] == "mention"]
+    replies: List[Tuple[int, Dict[str, Any]]] = []
+    deadlines: List[Optional[Deadline]] = []
+    for mention in mentions:
+        with trace_mention("mastodon", mention["status"]["id"], queue.account):
+            deadline = Deadline(get_reply_budget())
+            payload = prepare_reply(mention, ledger, store, level, deadline)
+            if payload is None:
+                continue
+            if payload["text_to_use"] is None:
+                queue.push(mention["id"], payload)
+                continue
+            replies.append((mention["id"], payload))
+            deadlines.append(deadline)
+    results = asyncio.run(
+        reply_to_mentions_async(
+            api,
+            [payload for _, payload in replies],
+            concurrency=concurrency,
+            text_only=level >= LoadLevel.TEXT_ONLY,
+            deadlines=deadlines,
+        )
+    )
+    for (mention_id, payload), replied in zip(replies, results):
+        if not replied:
+            queue.push(mention_id, payload)
+    for mention in mentions:
+        ledger.add(mention["id"])
+        store.set_since_id("mastodon", mention["id"], queue.account)
+    store.maybe_commit()
+
+
+def respond_to_toots(
+    filename: Optional[str] = "last_toot.txt",
+    store: Optional[StateStore] = None,
+    api: Optional[Mastodon] = None,
+    max_mentions: Optional[int] = 100,
+    dismiss: Optional[bool] = None,
+    concurrency: int = 1,
+    account: str = "default",
+) -> int:
+    """
+    Respond to mastodon mentions, keeping track of progress in the state store. On
+    a fresh store the first cycle only records the newest notification to start from.
+
+    :param filename: str path to a legacy last toot id file to migrate into the state store.
+    :param store: An optional StateStore. One is opened from the environment if not supplied.
+    :param api: An optional Mastodon client. One is created from the environment if not supplied.
+    :param max_mentions: Optional int cap on the notifications handled in this cycle.
+    :param dismiss: Whether to dismiss handled notifications. Defaults to `dismiss_enabled()`.
+    :param concurrency: int number of requests to have in flight at once. Above 1 the
+        cycle's replies are sent concurrently and checkpointed together at the end.
+    :param account: str name of the account, which keeps its own since-id, ledger,
+        retry queue and caches in the store.
+    :return: int number of notifications found.
+    """
+    if api is None:
+        try:
+            api = get_credentials_from_environ()
+        except MastodonConfigurationError:  # pragma: nocover
+            logger.error("Mastodon is not configured correctly.")
+            return 0
+    owns_store = store is None
+    if store is None:  # pragma: nocover
+        store = StateStore()
+    if dismiss is None:
+        dismiss = dismiss_enabled()
+    dismisser = NotificationDismisser(api, store) if dismiss else None
+    try:
+        store.migrate_since_id_file("mastodon", filename, account)
+        last_id = store.get_since_id("mastodon", account)
+        queue = RetryQueue(store, "mastodon", account)
+        ledger = get_ledger(store, "mastodon", account)
+        retry_failed_replies(api, queue)
+        if last_id is None:
+            bootstrap_since_id(api, store, account)
+            return 0
+
+        mentions = list(iter_notifications(api, last_id, limit=max_mentions))
+        if not mentions:  # pragma: nocover
+            logger.debug("No new mentions on Mastodon! Exiting...")
+            return 0
+        logger.info("Found notifications on Mastodon...")
+        get_metrics().inc("ewbot_mentions_total", len(mentions), platform="mastodon")
+        served, throttled = get_fair_scheduler("mastodon", account, store).order(
+            mentions, lambda mention: mention["account"]["acct"]
+        )
+        for mention in throttled:
+            ledger.add(mention["id"])
+        now = time.time()
+        shedder = get_load_shedder()
+        level = shedder.level(
+            len(served),
+            max(
+                (mention_age(mention.get("created_at"), now) for mention in served),
+                default=0,
+            ),
+        )
+        if level >= LoadLevel.SHED:
+            served, dropped = shedder.shed(
+                served, lambda mention: mention_age(mention.get("created_at"), now)
+            )
+            for mention in dropped:
+                logger.warning(f"Dropping mention {mention['id']} to shed load.")
+                ledger.add(mention["id"])
+        if level > LoadLevel.NORMAL:
+            logger.warning(
+                f"{len(served)} mentions waiting, replying in {level.name} mode."
+            )
+        if concurrency > 1:
+            handle_notifications_concurrently(
+                api, served, store, ledger, queue, concurrency, level
+            )
+        else:
+            for mention in served:
+                handle_notification(
+                    api,
+                    mention,
+                    store,
+                    ledger,
+                    queue,
+                    advance_since_id=False,
+                    level=level,
+                )
+        store.set_since_id("mastodon", mentions[-1]["id"], account)
+        if dismisser is not None:
+            for mention in mentions:
+                dismisser.add(mention["id"])
+        return len(mentions)
+    finally:
+        if dismisser is not None:
+            dismisser.flush()
+        if owns_store:  # pragma: nocover
+            store.close()
+        else:
+            store.commit()
+
+
+def serve_toots(
+    filename: Optional[str] = "last_toot.txt",
+    interval: Optional[AdaptiveInterval] = None,
+    concurrency: int = 1,
+    profiler: Optional[CycleProfiler] = None,
+) -> None:
+    """
+    Keep one process alive that polls for mentions on an adaptive interval, reusing
+    the API client, state store and warm caches between cycles.
+
+    :param filename: str path to a legacy last toot id file to migrate into the state store.
+    :param interval: Optional AdaptiveInterval controlling the polling rate.
+    :param concurrency: int number of requests to have in flight at once.
+    :param profiler: Optional CycleProfiler to profile every cycle with.
+    """
+    try:
+        api = get_credentials_from_environ()
+    except MastodonConfigurationError:  # pragma: nocover
+        logger.error("Mastodon is not configured correctly.")
+        return
+    store = StateStore()
+    serve(
+        profiled(
+            lambda: respond_to_toots(
+                filename, store=store, api=api, concurrency=concurrency
+            ),
+            profiler,
+        ),
+        interval=interval,
+        on_shutdown=store.close,
+    )
+
+
+class MentionListener(StreamListener):
+    """
+    Stream listener that hands every notification to `on_mention` as it arrives.
+    `on_connect` is called once, on the first heartbeat or event of a connection,
+    so we can backfill anything that arrived while we were disconnected. The
+    stream is abandoned at the next heartbeat or event once `stop_event` is set.
+    """
+
+    def __init__(
+        self,
+        on_mention: Callable[[Dict[str, Any]], None],
+        on_connect: Callable[[], Any],
+        stop_event: threading.Event,
+    ) -> None:
+        super().__init__()
+        self.on_mention = on_mention
+        self.on_connect = on_connect
+        self.stop_event = stop_event
+        self.connected = False
+
+    def _check(self) -> None:
+        if self.stop_event.is_set():
+            raise StopStreaming
+        if not self.connected:
+            self.connected = True
+            self.on_connect()
+
+    def handle_heartbeat(self) -> None:
+        self._check()
+
+    def on_notification(self, notification: Dict[str, Any]) -> None:
+        self._check()
+        self.on_mention(notification)
+
+
+def stream_toots(
+    api: Mastodon,
+    store: StateStore,
+    stop_event: threading.Event,
+    min_backoff: float = 1,
+    max_backoff: float = 300,
+    timeout: float = 60,
+) -> None:
+    """
+    Handle mentions as they are pushed over the user streaming API instead of polling.
+    Every time the stream (re)connects we backfill through the since-id, so nothing
+    that arrived while we were disconnected is missed. Failed connections are
+    retried with exponential backoff.
+
+    :param api: Mastodon
+    :param store: The StateStore.
+    :param stop_event: threading.Event that ends streaming when set.
+    :param min_backoff: Seconds to wait before reconnecting after a clean disconnect.
+    :param max_backoff: Longest wait in seconds between reconnection attempts.
+    :param timeout: Seconds without any data, heartbeats included, before the connection is considered dead.
+    """
+    queue = RetryQueue(store, "mastodon")
+    ledger = get_ledger(store, "mastodon")
+
+    def on_mention(notification: Dict[str, Any]) -> None:
+        handle_notification(api, notification, store, ledger, queue)
+        store.commit()
+
+    def on_connect() -> None:
+        logger.info(
+            "Connected to the Mastodon stream, catching up on missed mentions..."
+        )
+        respond_to_toots(None, store=store, api=api)
+
+    failures = 0
+    while not stop_event.is_set():
+        listener = MentionListener(on_mention, on_connect, stop_event)
+        try:
+            api.stream_user(listener, timeout=timeout)
+            logger.info("Mastodon stream closed by the server.")
+            failures = 0
+        except StopStreaming:
+            break
+        except (MastodonError, RequestException) as e:
+            failures += 1
+            logger.error(f"Mastodon stream failed ({failures} in a row): {e}")
+        wait = min(min_backoff * 2**failures, max_backoff)
+        logger.debug(f"Reconnecting to the Mastodon stream in {wait:.1f} seconds.")
+        stop_event.wait(wait)
+    logger.info("Stopped streaming.")
+
+
+def queued_notification(notification: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Keep the parts of a mention notification a worker needs to reply to it, as
+    something that can be stored as JSON.
+
+    :param notification: notification dict of type mention.
+    :return: dict
+    """
+    return {
+        "id": notification["id"],
+        "type": notification["type"],
+        "account": {"acct": notification["account"]["acct"]},
+        "status": {
+            "id": notification["status"]["id"],
+            "content": notification["status"]["content"],
+            "account": {"acct": notification["status"]["account"]["acct"]},
+        },
+    }
+
+
+def enqueue_notifications(
+    api: Mastodon,
+    store: StateStore,
+    max_mentions: Optional[int] = 100,
+    dismiss: Optional[bool] = None,
+) -> int:
+    """
+    Fetcher side of the work queue mode: retry failed replies, then queue any new
+    mentions for the workers, and advance the since-id past those they have done.
+    Queued notifications are dismissed if `MASTODON_DISMISS_NOTIFICATIONS` is set.
+    On a fresh store the first pass only records the newest notification to start from.
+
+    :param api: Mastodon
+    :param store: The StateStore shared with the workers.
+    :param max_mentions: Optional int cap on the notifications fetched in this pass.
+    :param dismiss: Optional bool overriding `MASTODON_DISMISS_NOTIFICATIONS`.
+    :return: int number of notifications queued.
+    """
+    work = WorkQueue(store, "mastodon")
+    retry_failed_replies(api, RetryQueue(store, "mastodon"))
+    cursor = work.cursor()
+    if cursor is None:
+        bootstrap_since_id(api, store)
+        return 0
+    mentions = list(iter_notifications(api, cursor, limit=max_mentions))
+    if mentions:
+        work.enqueue(
+            [(mention["id"], queued_notification(mention)) for mention in mentions]
+        )
+        if dismiss_enabled() if dismiss is None else dismiss:
+            dismisser = NotificationDismisser(api, store)
+            for mention in mentions:
+                dismisser.add(mention["id"])
+            dismisser.flush()
+    work.checkpoint()
+    return len(mentions)
+
+
+def work_on_notifications(
+    api: Mastodon, store: StateStore, worker: str, batch_size: int = 5
+) -> int:
+    """
+    Worker side of the work queue mode: claim a batch of queued mentions, reply to
+    them, and ack each one once it is handled. A mention is looked up in the state
+    store before replying, since another worker may have replied to it after this
+    process's ledger was loaded, e.g. before its lease ran out.
+
+    :param api: Mastodon
+    :param store: The StateStore shared with the fetcher.
+    :param worker: str name of this worker.
+    :param batch_size: int most mentions to claim at once.
+    :return: int number of mentions handled.
+    """
+    work = WorkQueue(store, "mastodon")
+    queue = RetryQueue(store, "mastodon")
+    ledger = get_ledger(store, "mastodon")
+    items = work.claim(worker, batch_size)
+    for item in items:
+        if store.has_replied("mastodon", item["mention_id"], ledger.account):
+            logger.info(f"Already replied to {item['mention_id']}")
+        else:
+            handle_notification(
+                api, item["payload"], store, ledger, queue, advance_since_id=False
+            )
+        work.ack(worker, item["mention_id"])
+    work.checkpoint()
+    return len(items)
+
+
+def fetch_toots(profiler: Optional[CycleProfiler] = None) -> None:
+    """
+    Queue new mentions for the workers once, using credentials and state from the
+    environment.
+
+    :param profiler: Optional CycleProfiler to profile the pass with.
+    """
+    try:
+        api = get_credentials_from_environ()
+    except MastodonConfigurationError:  # pragma: nocover
+        logger.error("Mastodon is not configured correctly.")
+        return
+    with StateStore(shared=True) as store:
+        profiled(lambda: enqueue_notifications(api, store), profiler)()
+
+
+def work_toots(
+    interval: Optional[AdaptiveInterval] = None,
+    batch_size: int = 5,
+    profiler: Optional[CycleProfiler] = None,
+) -> None:
+    """
+    Keep a worker process replying to queued mentions until SIGTERM or SIGINT.
+    Any number of workers can run at once on the host holding the state store.
+
+    :param interval: Optional AdaptiveInterval controlling how often the queue is checked.
+    :param batch_size: int most mentions to claim at once.
+    :param profiler: Optional CycleProfiler to profile every cycle with.
+    """
+    try:
+        api = get_credentials_from_environ()
+    except MastodonConfigurationError:  # pragma: nocover
+        logger.error("Mastodon is not configured correctly.")
+        return
+    store = StateStore(shared=True)
+    worker = get_worker_name()
+    serve(
+        profiled(
+            lambda: work_on_notifications(api, store, worker, batch_size), profiler
+        ),
+        interval=interval,
+        on_shutdown=store.close,
+    )
+
+
+def stream_toots_forever() -> None:
+    """
+    Stream mentions until SIGTERM or SIGINT, using credentials and state from the environment.
+    """
+    try:
+        api = get_credentials_from_environ()
+    except MastodonConfigurationError:  # pragma: nocover
+        logger.error("Mastodon is not configured correctly.")
+        return
+    stop_event = threading.Event()
+    install_signal_handlers(stop_event)
+    with StateStore() as store:
+        stream_toots(api, store, stop_event)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """
+    Command line entry point. Runs a single pass by default, `serve` to keep polling,
+    or `stream` to handle mentions as they are pushed by the streaming API. In
+    work queue mode, `fetch` queues new mentions once and `work` runs a worker
+    replying to them.
+
+    Exits straight away if another Mastodon run is still going, unless it is a worker.
+    Metrics are exported while it runs, see `exported_metrics`. Polling cycles
+    are profiled with `--profile` or `EWBOT_PROFILE`, see `get_profiler`.
+
+    :param argv: Optional list of arguments, defaults to sys.argv.
+    """
+    parser = argparse.ArgumentParser(description="Respond to mentions on Mastodon.")
+    parser.add_argument(
+        "mode",
+        nargs="?",
+        choices=["once", "serve", "stream", "fetch", "work"],
+        default="once",
+    )
+    parser.add_argument("--min-interval", type=float, default=5)
+    parser.add_argument("--max-interval", type=float, default=300)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--profile", action="append", choices=MODES)
+    args = parser.parse_args(argv)
+    profiler = get_profiler(args.profile, "mastodon")
+    try:
+        with exported_metrics(daemon=args.mode in ("serve", "stream", "work")):
+            if args.mode == "work":
+                work_toots(
+                    AdaptiveInterval(
+                        minimum=args.min_interval, maximum=args.max_interval
+                    ),
+                    profiler=profiler,
+                )
+                return
+            lock = acquire_run_lock("mastodon")
+            if lock is None:
+                return
+            try:
+                if args.mode == "stream":
+                    stream_toots_forever()
+                elif args.mode == "fetch":
+                    fetch_toots(profiler)
+                elif args.mode == "serve":
+                    serve_toots(
+                        interval=AdaptiveInterval(
+                            minimum=args.min_interval, maximum=args.max_interval
+                        ),
+                        concurrency=args.concurrency,
+                        profiler=profiler,
                     )
-                except MastodonError as e:  # pragma: nocover
-                    logger.error(f"Error while posting to Mastodon: {e}")
-            save_last_toot_id(new_id, filename)
+                else:
+                    profiled(
+                        lambda: respond_to_toots(
+                            "last_toot.txt", concurrency=args.concurrency
+                        ),
+                        profiler,
+                    )()
+            finally:
+                lock.release()
+    finally:
+        if profiler is not None:
+            profiler.close()
 
 
-if __name__ == "__main__":
-    respond_to_toots("last_toot.txt")  # pragma: nocover
+if __name__ == "__main__":  # pragma: nocover
+    configure_logging()
+    main()
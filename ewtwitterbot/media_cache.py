@@ -0,0 +1,95 @@
+import hashlib
+import time
+from typing import Optional
+
+from loguru import logger
+
+from ewtwitterbot.state import StateStore
+
+# How long an uploaded media id can be attached to new posts, in seconds. Twitter
+# media ids expire 24 hours after upload, so we stop reusing them an hour early.
+# A Mastodon attachment can only ever belong to the one status it was posted with,
+# so it is never reused.
+MEDIA_LIFETIMES = {
+    "twitter": 23 * 60 * 60,
+    "mastodon": 0,
+}
+
+
+def content_hash(filename: str) -> str:
+    """
+    Hash the contents of a rendered image.
+
+    :param filename: str path to the image.
+    :return: str hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaCache:
+    """
+    Maps the content hash of a rendered image to the media id it was uploaded as,
+    so sending the same image again within the platform's media lifetime skips the
+    upload. Entries live in the state store's cache table, namespaced by platform
+    and account.
+    """
+
+    def __init__(
+        self,
+        store: StateStore,
+        platform: str,
+        account: str = "default",
+        lifetime: Optional[float] = None,
+    ) -> None:
+        """
+        :param store: The StateStore holding the cache.
+        :param platform: str, e.g. 'twitter'
+        :param account: str name of the account.
+        :param lifetime: Optional seconds to keep an entry, defaults to the platform's media lifetime.
+        """
+        self.store = store
+        self.namespace = f"media:{platform}:{account}"
+        self.lifetime = (
+            MEDIA_LIFETIMES.get(platform, 0) if lifetime is None else lifetime
+        )
+
+    def get(self, digest: str, now: Optional[float] = None) -> Optional[str]:
+        """
+        Look up the media id for an image, if it is still usable.
+
+        :param digest: str content hash of the image.
+        :param now: Optional timestamp, mostly for testing.
+        :return: str media id or None.
+        """
+        if self.lifetime <= 0:
+            return None
+        media_id = self.store.cache_get(self.namespace, digest, now=now)
+        if media_id is not None:
+            logger.debug(f"Reusing media {media_id} for image {digest[:12]}.")
+        return media_id
+
+    def put(self, digest: str, media_id: str, now: Optional[float] = None) -> None:
+        """
+        Remember the media id an image was uploaded as.
+
+        :param digest: str content hash of the image.
+        :param media_id: str media id returned by the platform.
+        :param now: Optional timestamp, mostly for testing.
+        """
+        if self.lifetime <= 0:
+            return
+        now = time.time() if now is None else now
+        self.store.cache_set(self.namespace, digest, str(media_id), now + self.lifetime)
+
+    def invalidate(self, digest: str) -> None:
+        """
+        Forget the media id for an image, e.g. because the platform turned it down,
+        so the next reply with it uploads it again.
+
+        :param digest: str content hash of the image.
+        """
+        self.store.cache_delete(self.namespace, digest)
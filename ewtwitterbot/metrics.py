@@ -0,0 +1,232 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+
+from loguru import logger
+
+# http.server is only imported when metrics are served, to keep startup cheap.
+if TYPE_CHECKING:  # pragma: nocover
+    from http.server import ThreadingHTTPServer
+
+# Upper bounds in seconds of the latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets, as Prometheus expects them.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS) -> None:
+        """
+        :param buckets: tuple of bucket upper bounds in seconds, in increasing order.
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        """
+        :param seconds: float latency to record.
+        """
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """
+        :return: list of tuples of bucket bound, ending with +Inf, and the number of
+            observations at or below it.
+        """
+        bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+        total = 0
+        result = []
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class Metrics:
+    """
+    Counters and per-stage latency histograms for the whole process, rendered in
+    the Prometheus text format. Safe to share between threads.
+
+    Each stage of a reply (mention fetch, quote fetch, render, encode, upload,
+    post and checkpoint) is timed into `ewbot_stage_seconds` and counted by
+    outcome in `ewbot_stage_total`.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS) -> None:
+        """
+        :param buckets: tuple of histogram bucket upper bounds in seconds.
+        """
+        self.buckets = buckets
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Labels, Histogram] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, amount: float = 1, **labels: str) -> None:
+        """
+        :param name: str name of the counter, e.g. 'ewbot_mentions_total'
+        :param amount: Amount to add.
+        :param labels: str label values.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, stage: str, seconds: float, **labels: str) -> None:
+        """
+        :param stage: str name of the stage, e.g. 'render'
+        :param seconds: float time the stage took.
+        :param labels: str label values.
+        """
+        key = tuple(sorted(dict(labels, stage=stage).items()))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self.buckets)
+            self.histograms[key].observe(seconds)
+
+    @contextmanager
+    def time(self, stage: str, **labels: str) -> Iterator[None]:
+        """
+        Time the block as a stage, counting it as an error if it raises.
+
+        :param stage: str name of the stage, e.g. 'render'
+        :param labels: str label values.
+        """
+        started = time.monotonic()
+        outcome = "error"
+        try:
+            yield
+            outcome = "ok"
+        finally:
+            self.observe(stage, time.monotonic() - started, **labels)
+            self.inc("ewbot_stage_total", 1, stage=stage, outcome=outcome, **labels)
+
+    def render(self) -> str:
+        """
+        :return: str of every metric in the Prometheus text exposition format.
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (labels, histogram.cumulative(), histogram.sum, histogram.count)
+                for labels, histogram in self.histograms.items()
+            )
+        lines = []
+        if histograms:
+            lines.append("# HELP ewbot_stage_seconds Time taken by each reply stage.")
+            lines.append("# TYPE ewbot_stage_seconds histogram")
+        for labels, buckets, total, count in histograms:
+            for bound, cumulative in buckets:
+                bucket_labels = _format_labels(labels + (("le", bound),))
+                lines.append(f"ewbot_stage_seconds_bucket{bucket_labels} {cumulative}")
+            lines.append(f"ewbot_stage_seconds_sum{_format_labels(labels)} {total:g}")
+            lines.append(f"ewbot_stage_seconds_count{_format_labels(labels)} {count}")
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{_format_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+_metrics: Optional[Metrics] = None
+
+
+def get_metrics() -> Metrics:
+    """
+    Fetch the metrics shared by everything in this process.
+
+    :return: Metrics
+    """
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> "ThreadingHTTPServer":
+    """
+    Serve the metrics at `/metrics` from a background thread.
+
+    :param port: int port to listen on, 0 to pick a free one.
+    :param host: str address to listen on, local only by default.
+    :return: the running ThreadingHTTPServer, to shut down once done.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = get_metrics().render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+def write_metrics(filename: str) -> None:
+    """
+    Write the metrics to a file, replacing it in one go so a collector reading it
+    never sees half of it.
+
+    :param filename: str path to the file.
+    """
+    partial = f"{filename}.tmp"
+    with open(partial, "w") as f:
+        f.write(get_metrics().render())
+    os.replace(partial, filename)
+
+
+@contextmanager
+def exported_metrics(daemon: bool) -> Iterator[None]:
+    """
+    Export the metrics for the duration of a run. Long-running modes serve them on
+    `EWBOT_METRICS_PORT`, and one-shot runs write them to `EWBOT_METRICS_FILE` on
+    the way out. Neither happens unless the variable is set.
+
+    :param daemon: bool, True for modes that keep running, e.g. serve.
+    """
+    port = os.environ.get("EWBOT_METRICS_PORT", default=None)
+    filename = os.environ.get("EWBOT_METRICS_FILE", default=None)
+    server = start_metrics_server(int(port)) if daemon and port else None
+    try:
+        yield
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        if not daemon and filename:
+            write_metrics(filename)
@@ -0,0 +1,255 @@
+import io
+import os
+import sys
+import threading
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from typing import Any, Callable, Iterator, List, Optional, Tuple, TypeVar
+
+from loguru import logger
+
+T = TypeVar("T")
+
+MODES = ["cprofile", "tracemalloc", "sample"]
+
+
+def collapse_stack(frame: Any, thread_name: str) -> str:
+    """
+    Collapse a stack into one line of the format flame graph tools read, root
+    first, e.g. 'MainThread;twitter_bot.py:main;imagery.py:get_quote_image'
+
+    :param frame: the innermost frame of the stack.
+    :param thread_name: str name of the thread it belongs to.
+    :return: str
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join([thread_name] + names[::-1])
+
+
+class WallClockSampler:
+    """
+    Samples the stack of every thread at a fixed interval, whether it is running
+    or waiting, so time spent blocked on the network shows up alongside time
+    spent rendering or logging.
+    """
+
+    def __init__(self, interval: float = 0.005) -> None:
+        """
+        :param interval: Seconds between samples.
+        """
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != me:
+                    self.stacks[
+                        collapse_stack(frame, names.get(thread_id, str(thread_id)))
+                    ] += 1
+            self.samples += 1
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self._run, name="sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def collapsed(self) -> str:
+        """
+        :return: str of the collapsed stacks with their sample counts, one per line.
+        """
+        return "".join(
+            f"{stack} {count}\n" for stack, count in sorted(self.stacks.items())
+        )
+
+    def top(self, limit: int) -> List[Tuple[str, int]]:
+        """
+        :param limit: int number of frames to list.
+        :return: list of tuples of innermost frame and samples spent in it, most first.
+        """
+        leaves: Counter = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return leaves.most_common(limit)
+
+
+class CycleProfiler:
+    """
+    Profiles polling cycles on request: `cprofile` dumps a `.prof` file per cycle
+    and logs the slowest functions, `tracemalloc` logs the top allocators and what
+    changed since the previous cycle, and `sample` writes the collapsed stacks of a
+    wall-clock sampler for a flame graph and logs where the threads spent their time.
+    """
+
+    def __init__(
+        self,
+        modes: List[str],
+        name: str = "cycle",
+        directory: str = ".",
+        top: int = 20,
+        interval: float = 0.005,
+    ) -> None:
+        """
+        :param modes: list of modes to profile with, from MODES.
+        :param name: str name for the output files, e.g. 'twitter'
+        :param directory: str directory to write the output files to.
+        :param top: int number of entries in each summary.
+        :param interval: Seconds between samples in sample mode.
+        """
+        unknown = set(modes) - set(MODES)
+        if unknown:
+            raise ValueError(f"Unknown profiling modes: {', '.join(sorted(unknown))}")
+        self.modes = modes
+        self.name = name
+        self.directory = directory
+        self.top = top
+        self.interval = interval
+        self.cycles = 0
+        self.snapshot: Any = None
+        self.started_tracemalloc = False
+
+    @contextmanager
+    def _cprofile(self, prefix: str) -> Iterator[None]:
+        import cProfile
+        import pstats
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(f"{prefix}.prof")
+            summary = io.StringIO()
+            pstats.Stats(profile, stream=summary).sort_stats("cumulative").print_stats(
+                self.top
+            )
+            logger.info(f"Profile written to {prefix}.prof\n{summary.getvalue()}")
+
+    @contextmanager
+    def _tracemalloc(self) -> Iterator[None]:
+        import tracemalloc
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            self.started_tracemalloc = True
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, tracemalloc.__file__)]
+            )
+            top = snapshot.statistics("lineno")[: self.top]
+            report = ["Top allocations:"] + [str(stat) for stat in top]
+            if self.snapshot is not None:
+                report.append("Changes since the last cycle:")
+                report.extend(
+                    str(stat)
+                    for stat in snapshot.compare_to(self.snapshot, "lineno")[: self.top]
+                )
+            self.snapshot = snapshot
+            logger.info("\n".join(report))
+
+    @contextmanager
+    def _sample(self, prefix: str) -> Iterator[None]:
+        sampler = WallClockSampler(self.interval)
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            with open(f"{prefix}.collapsed", "w") as f:
+                f.write(sampler.collapsed())
+            report = [f"{sampler.samples} samples written to {prefix}.collapsed"]
+            report.extend(
+                f"{count:6d} {frame}" for frame, count in sampler.top(self.top)
+            )
+            logger.info("\n".join(report))
+
+    def run(self, cycle: Callable[[], T]) -> T:
+        """
+        Run one cycle under every profiling mode.
+
+        :param cycle: Callable running the cycle.
+        :return: whatever the cycle returns.
+        """
+        self.cycles += 1
+        prefix = os.path.join(
+            self.directory, f"ewbot-{self.name}-{os.getpid()}-{self.cycles}"
+        )
+        with ExitStack() as stack:
+            if "sample" in self.modes:
+                stack.enter_context(self._sample(prefix))
+            if "tracemalloc" in self.modes:
+                stack.enter_context(self._tracemalloc())
+            if "cprofile" in self.modes:
+                stack.enter_context(self._cprofile(prefix))
+            return cycle()
+
+    def close(self) -> None:
+        """
+        Stop tracing allocations, if this profiler started it.
+        """
+        if self.started_tracemalloc:
+            import tracemalloc
+
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+
+def get_profiler(
+    modes: Optional[List[str]] = None, name: str = "cycle"
+) -> Optional[CycleProfiler]:
+    """
+    Create a profiler for the modes asked for on the command line, or else in
+    `EWBOT_PROFILE` as a comma separated list. Output goes to `EWBOT_PROFILE_DIR`
+    (default the working directory), and `EWBOT_PROFILE_TOP` sets the length of
+    each summary (default 20).
+
+    :param modes: Optional list of modes from the command line.
+    :param name: str name for the output files, e.g. 'twitter'
+    :return: CycleProfiler, or None if profiling is off.
+    """
+    if not modes:
+        modes = [
+            mode.strip()
+            for mode in os.environ.get("EWBOT_PROFILE", default="").split(",")
+            if mode.strip()
+        ]
+    if not modes:
+        return None
+    return CycleProfiler(
+        modes,
+        name=name,
+        directory=os.environ.get("EWBOT_PROFILE_DIR", default="."),
+        top=int(os.environ.get("EWBOT_PROFILE_TOP", default="20")),
+    )
+
+
+def profiled(
+    cycle: Callable[[], T], profiler: Optional[CycleProfiler]
+) -> Callable[[], T]:
+    """
+    Wrap a cycle so every run of it is profiled. Without a profiler the cycle is
+    returned as is, so profiling costs nothing while it is off.
+
+    :param cycle: Callable running one cycle.
+    :param profiler: Optional CycleProfiler.
+    :return: Callable
+    """
+    if profiler is None:
+        return cycle
+    return lambda: profiler.run(cycle)
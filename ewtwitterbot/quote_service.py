@@ -5,11 +5,33 @@ from typing import Any, Dict, List, Optional, Union
 import requests
 from loguru import logger
 
+from ewtwitterbot.hedging import get_hedger
+from ewtwitterbot.tracing import span
+
 
 class QuoteServiceImproperlyConfigured(Exception):
     pass
 
 
+# Seconds to wait for the quoteservice when the caller has no deadline of its own.
+DEFAULT_TIMEOUT = 10
+
+_session: Optional[requests.Session] = None
+
+
+def get_session() -> requests.Session:
+    """
+    Fetch the shared HTTP session used for every quoteservice request, so that
+    connections are pooled and reused across calls and across platforms.
+
+    :return: requests.Session
+    """
+    global _session
+    if _session is None:
+        _session = requests.Session()
+    return _session
+
+
 def make_headers() -> Dict[str, str]:
     qs_token = os.environ.get("QS_TOKEN", default=None)
     if qs_token is None:
@@ -17,48 +39,79 @@ def make_headers() -> Dict[str, str]:
     return {"Authorization": f"Token {qs_token}"}
 
 
-def get_random_quote(character: Optional[str] = None) -> Union[Dict[str, Any], int]:
+def send_request(url: str, timeout: Optional[float] = None) -> requests.Response:
+    """
+    Send a GET request to the quoteservice, hedging it if that is turned on.
+
+    :param url: str
+    :param timeout: Optional seconds to wait for the response, defaults to DEFAULT_TIMEOUT.
+    :return: requests.Response
+    """
+    headers = make_headers()
+    timeout = DEFAULT_TIMEOUT if timeout is None else timeout
+    hedger = get_hedger()
+    with span("quote_fetch"):
+        if hedger is None:
+            return get_session().get(url, headers=headers, timeout=timeout)
+        return hedger.send(
+            lambda remaining: get_session().get(
+                url, headers=headers, timeout=remaining
+            ),
+            timeout,
+        )
+
+
+def get_random_quote(
+    character: Optional[str] = None, timeout: Optional[float] = None
+) -> Union[Dict[str, Any], int]:
     """
     Fetch a quote from the quoteservice backend.
 
     :param character: An optional string representing a specific character, e.g. 'nix'
+    :param timeout: Optional seconds to wait for the response, defaults to DEFAULT_TIMEOUT.
     :return: A dict representation of the quote object, or an int representing an error code.
     """
     hostname = "https://quoteservice.andrlik.org/api/"
     url = f"{hostname}groups/ew/get_random_quote/"
     if character is not None:
         url = f"{hostname}sources/ew-{character.lower()}/get_random_quote/"
-    r = requests.get(url, headers=make_headers())
+    r = send_request(url, timeout)
     if r.status_code != 200:
         return r.status_code
     return r.json()
 
 
-def generate_sentence(character: Optional[str] = None) -> Union[str, int]:
+def generate_sentence(
+    character: Optional[str] = None, timeout: Optional[float] = None
+) -> Union[str, int]:
     """
     Request a generated sentence via markov chain from the quoteservice.
 
     :param character: An optional string representing a character, e.g. 'nix'
+    :param timeout: Optional seconds to wait for the response, defaults to DEFAULT_TIMEOUT.
     :return: str representing the sentence or an int representing an error code.
     """
     hostname = "https://quoteservice.andrlik.org/api/"
     url = f"{hostname}groups/ew/generate_sentence/"
     if character is not None:
         url = f"{hostname}sources/ew-{character.lower()}/generate_sentence/"
-    r = requests.get(url, headers=make_headers())
+    r = send_request(url, timeout)
     if r.status_code != 200:
         return r.status_code
     return r.json()["sentence"]
 
 
-def list_characters() -> Union[List[Dict[str, str]], int]:
+def list_characters(
+    timeout: Optional[float] = None,
+) -> Union[List[Dict[str, str]], int]:
     """
     Fetch a list of valid characters from the quote server.
 
+    :param timeout: Optional seconds to wait for the response, defaults to DEFAULT_TIMEOUT.
     :return: Either a list of dict representations of the characters and their slugs, or an int error code.
     """
     url = "https://quoteservice.andrlik.org/api/sources/"
-    r = requests.get(url, headers=make_headers())
+    r = send_request(url, timeout)
     if r.status_code != 200:
         return r.status_code
     return [
@@ -66,13 +119,16 @@ def list_characters() -> Union[List[Dict[str, str]], int]:
     ]
 
 
-def fetch_and_select_random_character() -> Optional[Dict[str, Any]]:
+def fetch_and_select_random_character(
+    timeout: Optional[float] = None,
+) -> Optional[Dict[str, Any]]:
     """
     Fetch a list of characters and return a random one as a dict of name and slug.
     We separate this function to help with unit testing.
+    :param timeout: Optional seconds to wait for the response, defaults to DEFAULT_TIMEOUT.
     :return: dict object
     """
-    character_result = list_characters()
+    character_result = list_characters(timeout)
     if type(character_result) == int:
         logger.error(
             f"The QuoteService responded to a character request with error {character_result}"
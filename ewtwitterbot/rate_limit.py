@@ -0,0 +1,257 @@
+import threading
+import time
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from loguru import logger
+
+from ewtwitterbot.deadline import Deadline, DeadlineExceeded
+
+# Published limits per endpoint as (requests, window in seconds), used until the
+# first response tells us the real budget. Mastodon limits every endpoint of an
+# account together, apart from media uploads. An endpoint without an entry of its
+# own gets its platform's "all" limits, which for Twitter are the 15 requests per
+# 15 minutes most endpoints are held to.
+DEFAULT_LIMITS: Dict[Tuple[str, str], Tuple[int, float]] = {
+    ("twitter", "all"): (15, 15 * 60),
+    ("twitter", "mentions_timeline"): (75, 15 * 60),
+    ("twitter", "media_upload"): (415, 15 * 60),
+    ("twitter", "create_media_metadata"): (415, 15 * 60),
+    ("twitter", "update_status"): (300, 3 * 60 * 60),
+    ("mastodon", "all"): (300, 5 * 60),
+    ("mastodon", "media_post"): (30, 30 * 60),
+}
+
+
+class TokenBucket:
+    """
+    Token bucket for one endpoint. Tokens refill at a steady rate up to `capacity`,
+    and each call takes one, waiting for it if the bucket is empty. Once a response
+    reports how much of the window's budget is left, the refill rate is set to
+    spread what remains evenly over the time left in the window.
+    """
+
+    def __init__(
+        self,
+        limit: int,
+        window: float,
+        capacity: Optional[float] = None,
+        now: Optional[float] = None,
+    ) -> None:
+        """
+        :param limit: int number of calls allowed per window.
+        :param window: Length of the window in seconds.
+        :param capacity: Optional largest burst, defaults to a tenth of the limit.
+        :param now: Optional monotonic timestamp, mostly for testing.
+        """
+        self.limit = limit
+        self.window = window
+        self.default_rate = limit / window
+        self.rate = self.default_rate
+        self.capacity = max(1.0, limit / 10 if capacity is None else capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic() if now is None else now
+        self.reset_at: Optional[float] = None
+
+    def _refill(self, now: float) -> None:
+        if self.reset_at is not None and now >= self.reset_at:
+            self.rate = self.default_rate
+            self.reset_at = None
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now: Optional[float] = None) -> float:
+        """
+        Take a token, going into debt if there is none left.
+
+        :param now: Optional monotonic timestamp, mostly for testing.
+        :return: float seconds to wait before making the call.
+        """
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def seed(
+        self,
+        remaining: int,
+        reset_in: float,
+        limit: Optional[int] = None,
+        now: Optional[float] = None,
+    ) -> None:
+        """
+        Align the bucket with the budget reported by the platform.
+
+        :param remaining: int calls left in the current window.
+        :param reset_in: Seconds until the window resets.
+        :param limit: Optional int calls allowed per window.
+        :param now: Optional monotonic timestamp, mostly for testing.
+        """
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if limit is not None and limit > 0:
+            self.limit = limit
+            self.default_rate = limit / self.window
+        reset_in = max(reset_in, 1.0)
+        self.reset_at = now + reset_in
+        self.rate = max(remaining, 1) / reset_in
+        self.tokens = min(self.tokens, remaining)
+
+
+class RateLimiter:
+    """
+    Schedules calls to the platform APIs with a token bucket per platform, account
+    and endpoint, so a burst of mentions is paced within the budget instead of
+    running into rate limit errors. Safe to share between threads.
+    """
+
+    def __init__(self) -> None:
+        self.buckets: Dict[Tuple[str, str, str], TokenBucket] = {}
+        self.lock = threading.Lock()
+
+    def bucket(
+        self, platform: str, endpoint: str, account: str = "default"
+    ) -> TokenBucket:
+        """
+        Fetch the bucket for an endpoint, creating it from the published limits, or
+        the platform's limits for any endpoint if it has none of its own.
+
+        :param platform: str, e.g. 'twitter'
+        :param endpoint: str, e.g. 'update_status'
+        :param account: str name of the account.
+        :return: TokenBucket
+        """
+        key = (platform, account, endpoint)
+        with self.lock:
+            if key not in self.buckets:
+                limit, window = DEFAULT_LIMITS.get(
+                    (platform, endpoint), DEFAULT_LIMITS[(platform, "all")]
+                )
+                self.buckets[key] = TokenBucket(limit, window)
+            return self.buckets[key]
+
+    def wait(
+        self,
+        platform: str,
+        endpoint: str,
+        account: str = "default",
+        deadline: Optional[Deadline] = None,
+    ) -> float:
+        """
+        Block until a call to the endpoint fits in the budget. If that would take
+        longer than the deadline has left, give up straight away instead and hand
+        the token back.
+
+        :param platform: str, e.g. 'twitter'
+        :param endpoint: str, e.g. 'update_status'
+        :param account: str name of the account.
+        :param deadline: Optional Deadline of the reply making the call.
+        :return: float seconds waited.
+        """
+        bucket = self.bucket(platform, endpoint, account)
+        with self.lock:
+            delay = bucket.reserve()
+            if deadline is not None and delay >= deadline.remaining():
+                bucket.tokens += 1
+                raise DeadlineExceeded(
+                    f"The {platform} {endpoint} budget frees up in {delay:.1f}s, "
+                    f"after the {deadline.budget:g}s budget runs out."
+                )
+        if delay > 0:
+            logger.info(f"Waiting {delay:.1f}s for the {platform} {endpoint} budget.")
+            time.sleep(delay)
+        return delay
+
+    def update(
+        self,
+        platform: str,
+        endpoint: str,
+        remaining: Any,
+        reset_at: Any,
+        limit: Any = None,
+        account: str = "default",
+    ) -> None:
+        """
+        Seed an endpoint's bucket from the rate limit a response reported.
+
+        :param platform: str, e.g. 'twitter'
+        :param endpoint: str, e.g. 'update_status'
+        :param remaining: calls left in the window.
+        :param reset_at: epoch timestamp at which the window resets.
+        :param limit: Optional calls allowed per window.
+        :param account: str name of the account.
+        """
+        if not isinstance(remaining, (int, float, str)) or not isinstance(
+            reset_at, (int, float, str)
+        ):
+            return
+        try:
+            remaining = int(remaining)
+            reset_in = float(reset_at) - time.time()
+            limit = int(limit) if limit is not None else None
+        except (TypeError, ValueError):
+            return
+        bucket = self.bucket(platform, endpoint, account)
+        with self.lock:
+            bucket.seed(remaining, reset_in, limit)
+
+    def update_from_headers(
+        self,
+        platform: str,
+        endpoint: str,
+        headers: Optional[Mapping[str, str]],
+        account: str = "default",
+    ) -> None:
+        """
+        Seed an endpoint's bucket from `x-rate-limit-*` response headers, if present.
+
+        :param platform: str, e.g. 'twitter'
+        :param endpoint: str, e.g. 'update_status'
+        :param headers: Mapping of response headers.
+        :param account: str name of the account.
+        """
+        if not headers or "x-rate-limit-remaining" not in headers:
+            return
+        self.update(
+            platform,
+            endpoint,
+            headers.get("x-rate-limit-remaining"),
+            headers.get("x-rate-limit-reset"),
+            headers.get("x-rate-limit-limit"),
+            account,
+        )
+
+
+def set_account(client: Any, account: str) -> None:
+    """
+    Record which account an API client was created for, so its calls are paced
+    against that account's budget. Copies of the client keep the account.
+
+    :param client: API client, e.g. tweepy.API or Mastodon.
+    :param account: str name of the account.
+    """
+    client.ewbot_account = account
+
+
+def account_of(client: Any) -> str:
+    """
+    :param client: API client, e.g. tweepy.API or Mastodon.
+    :return: str name of the account the client was created for, or 'default'.
+    """
+    return vars(client).get("ewbot_account", "default")
+
+
+_rate_limiter: Optional[RateLimiter] = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    """
+    Fetch the rate limiter shared by every platform in this process.
+
+    :return: RateLimiter
+    """
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter()
+    return _rate_limiter
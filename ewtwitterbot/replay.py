@@ -0,0 +1,721 @@
+import argparse
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http import HTTPStatus
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from ewtwitterbot import mastodon_bot, quote_service, twitter_bot
+from ewtwitterbot.state import StateStore
+from ewtwitterbot.status_processing import process_request
+from ewtwitterbot.tracing import configure_logging
+
+PLATFORMS = ["twitter", "mastodon"]
+QUOTE_SERVICE = "https://quoteservice.andrlik.org/"
+FAKE_MASTODON = "https://mastodon.replay.invalid"
+
+# Seconds each kind of request to the fake platforms takes before speed-up.
+# Quoteservice requests take as long as they did when they were recorded.
+DELAYS = {"mention_fetch": 0.25, "upload": 0.5, "post": 0.25, "other": 0.05}
+
+TWITTER_TIME = "%a %b %d %H:%M:%S +0000 %Y"
+
+
+class ReplayStalled(Exception):
+    pass
+
+
+def load_fixture(filename: str) -> List[Dict[str, Any]]:
+    """
+    Read a fixture file written by `record_fixture`, one JSON entry per line.
+
+    :param filename: str path to the fixture.
+    :return: list of dict entries.
+    """
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def latest_mentions(api: Any, limit: int) -> List[Any]:
+    """
+    Page back from the newest Twitter mention until `limit` have been fetched.
+
+    :param api: An instance of an authenticated tweepy.API
+    :param limit: int most mentions to fetch.
+    :return: list of the most recent tweepy Status mentions, oldest-first.
+    """
+    mentions: List[Any] = []
+    max_id = None
+    while len(mentions) < limit:
+        page = twitter_bot.call_api(
+            api,
+            "mentions_timeline",
+            max_id=max_id,
+            count=min(limit - len(mentions), 200),
+            tweet_mode="extended",
+        )
+        if len(page) == 0:
+            break
+        mentions.extend(page)
+        max_id = min(mention.id for mention in page) - 1
+    return sorted(mentions[:limit], key=lambda mention: mention.id)
+
+
+def latest_notifications(api: Any, limit: int) -> List[Dict[str, Any]]:
+    """
+    Page back from the newest Mastodon mention until `limit` have been fetched.
+
+    :param api: Mastodon
+    :param limit: int most notifications to fetch.
+    :return: list of the most recent mention notification dicts, oldest-first.
+    """
+    notifications: List[Dict[str, Any]] = []
+    page = mastodon_bot.call_api(
+        api, "notifications", mentions_only=True, limit=min(limit, 40)
+    )
+    while page:
+        notifications.extend(page)
+        if len(notifications) >= limit:
+            break
+        page = mastodon_bot.call_api(api, "fetch_next", page)
+    return sorted(notifications[:limit], key=lambda notification: notification["id"])
+
+
+def record_fixture(filename: str, clients: Dict[str, Any], limit: int = 100) -> int:
+    """
+    Capture the latest mentions from each platform, and the quoteservice responses
+    to their requests, into a fixture for `replay`. Nothing is posted, and the
+    since-id in the state store is left alone.
+
+    Each mention is written with `at`, the seconds after the first mention it was
+    posted, which sets when it arrives during the replay.
+
+    :param filename: str path to write the fixture to.
+    :param clients: dict of platform name to its authenticated client.
+    :param limit: int most mentions to record per platform.
+    :return: int number of mentions recorded.
+    """
+    mentions: List[Tuple[str, Any, float, str]] = []
+    for platform, api in clients.items():
+        if platform == "twitter":
+            for mention in latest_mentions(api, limit):
+                mentions.append(
+                    (
+                        platform,
+                        mention._json,
+                        mention.created_at.timestamp(),
+                        twitter_bot.get_full_text(mention),
+                    )
+                )
+        else:
+            for notification in latest_notifications(api, limit):
+                mentions.append(
+                    (
+                        platform,
+                        notification,
+                        notification["created_at"].timestamp(),
+                        notification["status"]["content"],
+                    )
+                )
+    quotes = []
+
+    def record_quote(response: requests.Response, *args: Any, **kwargs: Any) -> None:
+        quotes.append(
+            {
+                "kind": "quote",
+                "path": urlsplit(response.url).path,
+                "status": response.status_code,
+                "latency": response.elapsed.total_seconds(),
+                "body": response.json() if response.status_code == 200 else None,
+            }
+        )
+
+    session = quote_service.get_session()
+    session.hooks["response"].append(record_quote)
+    try:
+        for platform, _, _, text in mentions:
+            process_request(text, platform.title())
+    finally:
+        session.hooks["response"].remove(record_quote)
+    start = min((posted for _, _, posted, _ in mentions), default=0)
+    with open(filename, "w") as f:
+        for platform, payload, posted, _ in mentions:
+            entry = {
+                "kind": "mention",
+                "platform": platform,
+                "at": posted - start,
+                "payload": payload,
+            }
+            f.write(json.dumps(entry, default=str) + "\n")
+        for quote in quotes:
+            f.write(json.dumps(quote) + "\n")
+    return len(mentions)
+
+
+class FakeServices(BaseAdapter):
+    """
+    Requests transport adapter standing in for one platform's API and for the
+    quoteservice, serving a fixture instead of the network. Each recorded mention
+    turns up in the mentions timeline or notifications once its time has come,
+    and every reply posted to it is timed from then.
+
+    The fake platform reports a rate limit budget large enough that pacing never
+    holds up the replay, so the results measure the bot itself.
+    """
+
+    def __init__(
+        self,
+        entries: List[Dict[str, Any]],
+        platform: str,
+        speedup: float = 1.0,
+        delays: Optional[Dict[str, float]] = None,
+    ) -> None:
+        """
+        :param entries: list of fixture entries.
+        :param platform: str, 'twitter' or 'mastodon'
+        :param speedup: How many times faster than recorded mentions arrive and
+            requests take.
+        :param delays: Optional dict overriding DELAYS.
+        """
+        super().__init__()
+        self.platform = platform
+        self.speedup = speedup
+        self.delays = dict(DELAYS, **(delays or {}))
+        self.mentions = sorted(
+            (
+                entry
+                for entry in entries
+                if entry["kind"] == "mention" and entry["platform"] == platform
+            ),
+            key=lambda entry: entry["at"],
+        )
+        self.quotes: Dict[str, List[Dict[str, Any]]] = {}
+        for entry in entries:
+            if entry["kind"] == "quote":
+                self.quotes.setdefault(entry["path"], []).append(entry)
+        self.quote_turns: Counter = Counter()
+        self.started: Optional[float] = None
+        self.delivered: Dict[str, float] = {}
+        self.replied: set = set()
+        self.latencies: List[float] = []
+        self.last_id = 0
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
+        """
+        Start the clock. No mention arrives before this.
+        """
+        self.started = time.time()
+
+    def arrival(self, entry: Dict[str, Any]) -> float:
+        """
+        :param entry: fixture entry of a mention.
+        :return: float epoch timestamp at which it arrives.
+        """
+        return (self.started or 0) + entry["at"] / self.speedup
+
+    def target(self, entry: Dict[str, Any]) -> str:
+        """
+        :param entry: fixture entry of a mention.
+        :return: str id of the post a reply to the mention answers.
+        """
+        if self.platform == "twitter":
+            return str(entry["payload"]["id"])
+        return str(entry["payload"]["status"]["id"])
+
+    def all_arrived(self) -> bool:
+        """
+        :return: bool, True once every mention is in the timeline or notifications.
+        """
+        return bool(self.mentions) and self.arrival(self.mentions[-1]) <= time.time()
+
+    def newest_id(self) -> int:
+        """
+        :return: int id of the last mention, which the since-id reaches once the bot
+            has handled every mention.
+        """
+        return int(self.mentions[-1]["payload"]["id"]) if self.mentions else 0
+
+    def done(self) -> bool:
+        """
+        :return: bool, True once every mention has been fetched by the bot.
+        """
+        with self.lock:
+            return len(self.delivered) == len(self.mentions)
+
+    def arrived(self) -> List[Tuple[str, float, Dict[str, Any]]]:
+        """
+        Fetch the mentions that have arrived so far, oldest first, with the time
+        they were posted set to when they arrived.
+
+        :return: list of tuples of reply target, arrival time and mention payload.
+        """
+        if self.started is None:
+            return []
+        now = time.time()
+        mentions = []
+        for entry in self.mentions:
+            arrival = self.arrival(entry)
+            if arrival > now:
+                break
+            payload = dict(entry["payload"])
+            posted = datetime.fromtimestamp(arrival, timezone.utc)
+            if self.platform == "twitter":
+                payload["created_at"] = posted.strftime(TWITTER_TIME)
+            else:
+                payload["created_at"] = posted.isoformat()
+                payload["status"] = dict(
+                    payload["status"], created_at=posted.isoformat()
+                )
+            mentions.append((self.target(entry), arrival, payload))
+        return mentions
+
+    def deliver(
+        self, mentions: List[Tuple[str, float, Dict[str, Any]]]
+    ) -> List[Dict[str, Any]]:
+        """
+        Note mentions as fetched by the bot.
+
+        :param mentions: list of tuples from `arrived`.
+        :return: list of their payloads.
+        """
+        with self.lock:
+            for target, arrival, _ in mentions:
+                self.delivered.setdefault(target, arrival)
+        return [payload for _, _, payload in mentions]
+
+    def reply(self, target: Any) -> None:
+        """
+        Time the first reply to a mention.
+
+        :param target: id of the post replied to.
+        """
+        with self.lock:
+            arrival = self.delivered.get(str(target))
+            if arrival is not None and str(target) not in self.replied:
+                self.replied.add(str(target))
+                self.latencies.append(time.time() - arrival)
+
+    def next_id(self) -> int:
+        with self.lock:
+            self.last_id += 1
+            return self.last_id
+
+    def stage(self, method: str, path: str) -> str:
+        """
+        :param method: str HTTP method.
+        :param path: str path of the request.
+        :return: str kind of request, a key of DELAYS.
+        """
+        if method == "GET" and ("mentions_timeline" in path or "notifications" in path):
+            return "mention_fetch"
+        if "/media" in path:
+            return "upload"
+        if method == "POST" and "statuses" in path:
+            return "post"
+        return "other"
+
+    def twitter(
+        self, method: str, path: str, params: Dict[str, str]
+    ) -> Tuple[int, Any, Dict[str, str]]:
+        if path == "/1.1/statuses/mentions_timeline.json":
+            since_id = int(params.get("since_id", 0))
+            max_id = int(params["max_id"]) if "max_id" in params else None
+            page = [
+                mention
+                for mention in self.arrived()
+                if mention[2]["id"] > since_id
+                and (max_id is None or mention[2]["id"] <= max_id)
+            ]
+            return 200, self.deliver(page[::-1][: int(params.get("count", 20))]), {}
+        if path == "/1.1/media/upload.json":
+            media_id = self.next_id()
+            return 200, {"media_id": media_id, "media_id_string": str(media_id)}, {}
+        if path == "/1.1/media/metadata/create.json":
+            return 200, {}, {}
+        if path == "/1.1/statuses/update.json":
+            self.reply(params.get("in_reply_to_status_id"))
+            status_id = self.next_id()
+            return (
+                200,
+                {
+                    "id": status_id,
+                    "id_str": str(status_id),
+                    "created_at": datetime.now(timezone.utc).strftime(TWITTER_TIME),
+                    "text": params.get("status", ""),
+                    "in_reply_to_status_id": params.get("in_reply_to_status_id"),
+                    "user": {"id": 1, "screen_name": "ewbot"},
+                },
+                {},
+            )
+        return 404, {"errors": [{"code": 34, "message": "Page not found"}]}, {}
+
+    def mastodon(
+        self, method: str, path: str, params: Dict[str, str]
+    ) -> Tuple[int, Any, Dict[str, str]]:
+        if path.rstrip("/") == "/api/v1/instance":
+            return 200, {"uri": "mastodon.replay.invalid", "version": "3.5.3"}, {}
+        if path == "/api/v1/notifications" and method == "GET":
+            min_id = int(params.get("min_id", params.get("since_id", 0)))
+            page = self.deliver(
+                [
+                    notification
+                    for notification in self.arrived()
+                    if int(notification[2]["id"]) > min_id
+                ][: int(params.get("limit", 20))]
+            )
+            headers = {}
+            if page:
+                newest = max(int(notification["id"]) for notification in page)
+                headers[
+                    "Link"
+                ] = f'<{FAKE_MASTODON}/api/v1/notifications?min_id={newest}>; rel="prev"'
+            return 200, page[::-1], headers
+        if path.startswith("/api/v1/notifications"):
+            return 200, {}, {}
+        if path in ("/api/v1/media", "/api/v2/media") or path.startswith(
+            "/api/v1/media/"
+        ):
+            media_id = path.rsplit("/", 1)[-1] if method == "PUT" else self.next_id()
+            return (
+                200,
+                {
+                    "id": str(media_id),
+                    "type": "image",
+                    "url": f"{FAKE_MASTODON}/media/{media_id}.png",
+                },
+                {},
+            )
+        if path == "/api/v1/statuses" and method == "POST":
+            self.reply(params.get("in_reply_to_id"))
+            return (
+                200,
+                {
+                    "id": str(self.next_id()),
+                    "created_at": datetime.now(timezone.utc).isoformat(),
+                    "content": params.get("status", ""),
+                    "in_reply_to_id": params.get("in_reply_to_id"),
+                    "account": {"id": "1", "acct": "ewbot"},
+                    "media_attachments": [],
+                },
+                {},
+            )
+        return 404, {"error": "Record not found"}, {}
+
+    def quote(self, path: str) -> Tuple[int, Any, float]:
+        """
+        Take turns serving the responses recorded for a quoteservice path, or for
+        the same endpoint of another source, since markov requests pick a random
+        character.
+
+        :param path: str path of the request.
+        :return: tuple of status code, body and recorded latency.
+        """
+        recorded = self.quotes.get(path)
+        if recorded is None:
+            endpoint = path.rstrip("/").rsplit("/", 1)[-1]
+            recorded = [
+                quote
+                for other, quotes in sorted(self.quotes.items())
+                if other.rstrip("/").rsplit("/", 1)[-1] == endpoint
+                for quote in quotes
+            ]
+        if not recorded:
+            return 404, {"detail": "Not found."}, 0.0
+        with self.lock:
+            turn = self.quote_turns[path]
+            self.quote_turns[path] += 1
+        quote = recorded[turn % len(recorded)]
+        return quote["status"], quote["body"], quote["latency"]
+
+    def send(
+        self,
+        request: requests.PreparedRequest,
+        stream: bool = False,
+        timeout: Any = None,
+        verify: Any = True,
+        cert: Any = None,
+        proxies: Any = None,
+    ) -> requests.Response:
+        url = urlsplit(str(request.url))
+        method = str(request.method)
+        if url.netloc == urlsplit(QUOTE_SERVICE).netloc:
+            status, body, delay = self.quote(url.path)
+            time.sleep(delay / self.speedup)
+            return self.respond(request, status, body)
+        params = dict(parse_qsl(url.query))
+        content_type = str(request.headers.get("Content-Type", ""))
+        if content_type.startswith("application/x-www-form-urlencoded"):
+            form = request.body
+            params.update(
+                parse_qsl(form.decode() if isinstance(form, bytes) else str(form))
+            )
+        time.sleep(self.delays[self.stage(method, url.path)] / self.speedup)
+        if self.platform == "twitter":
+            status, body, headers = self.twitter(method, url.path, params)
+        else:
+            status, body, headers = self.mastodon(method, url.path, params)
+        reset = int(time.time()) + 900
+        headers.update(
+            {
+                "x-rate-limit-limit": "1000000",
+                "x-rate-limit-remaining": "1000000",
+                "x-rate-limit-reset": str(reset),
+                "X-RateLimit-Limit": "1000000",
+                "X-RateLimit-Remaining": "1000000",
+                "X-RateLimit-Reset": datetime.fromtimestamp(
+                    reset, timezone.utc
+                ).isoformat(),
+            }
+        )
+        return self.respond(request, status, body, headers)
+
+    def respond(
+        self,
+        request: requests.PreparedRequest,
+        status: int,
+        body: Any,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> requests.Response:
+        response = requests.Response()
+        response.status_code = status
+        response.reason = HTTPStatus(status).phrase
+        response.headers = CaseInsensitiveDict(
+            {"Content-Type": "application/json; charset=utf-8", **(headers or {})}
+        )
+        response._content = json.dumps(body).encode("utf-8")
+        response.encoding = "utf-8"
+        response.url = str(request.url)
+        response.request = request
+        return response
+
+    def close(self) -> None:
+        pass
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    :param values: list of floats.
+    :param p: percentile wanted, e.g. 95.
+    :return: float nearest-rank percentile, 0 if there are no values.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)), 1) - 1]
+
+
+class ReplayReport:
+    """
+    What a replay measured: how many mentions were handled how fast, and the
+    latency from each mention arriving to the reply being posted.
+    """
+
+    def __init__(
+        self,
+        platform: str,
+        mentions: int,
+        latencies: List[float],
+        elapsed: float,
+        cycles: int,
+    ) -> None:
+        """
+        :param platform: str, e.g. 'twitter'
+        :param mentions: int number of mentions the bot fetched.
+        :param latencies: list of float seconds from mention to reply.
+        :param elapsed: float seconds the replay took.
+        :param cycles: int number of polling cycles run.
+        """
+        self.platform = platform
+        self.mentions = mentions
+        self.latencies = latencies
+        self.elapsed = elapsed
+        self.cycles = cycles
+
+    @property
+    def throughput(self) -> float:
+        """
+        :return: float mentions handled per second.
+        """
+        return self.mentions / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        """
+        :return: str report for the command line.
+        """
+        p50, p95, p99 = (percentile(self.latencies, p) for p in (50, 95, 99))
+        return (
+            f"{self.platform}: {self.mentions} mentions, {len(self.latencies)} replies "
+            f"in {self.elapsed:.2f}s over {self.cycles} cycles "
+            f"({self.throughput:.2f} mentions/sec)\n"
+            f"reply latency p50 {p50:.3f}s, p95 {p95:.3f}s, p99 {p99:.3f}s"
+        )
+
+
+def connect(platform: str, session: requests.Session) -> Any:
+    """
+    :param platform: str, 'twitter' or 'mastodon'
+    :param session: requests.Session to send the client's requests through.
+    :return: a client for the fake platform.
+    """
+    if platform == "twitter":
+        return twitter_bot.get_credentials(
+            "replay", "replay", "replay", "replay", account="replay", session=session
+        )
+    return mastodon_bot.get_credentials(
+        FAKE_MASTODON, "replay", account="replay", session=session
+    )
+
+
+def respond(platform: str, api: Any, store: StateStore, concurrency: int) -> int:
+    """
+    Run one polling cycle of the bot for the platform.
+
+    :param platform: str, 'twitter' or 'mastodon'
+    :param api: client for the fake platform.
+    :param store: The StateStore of the replay.
+    :param concurrency: int number of replies to have in flight at once.
+    :return: int number of mentions found.
+    """
+    if platform == "twitter":
+        return twitter_bot.respond_to_tweets(
+            None, store=store, api=api, concurrency=concurrency, account="replay"
+        )
+    return mastodon_bot.respond_to_toots(
+        None,
+        store=store,
+        api=api,
+        dismiss=False,
+        concurrency=concurrency,
+        account="replay",
+    )
+
+
+def replay(
+    entries: List[Dict[str, Any]],
+    platform: str,
+    speedup: float = 1.0,
+    concurrency: int = 1,
+    interval: float = 5.0,
+    delays: Optional[Dict[str, float]] = None,
+    max_idle_cycles: int = 10,
+) -> ReplayReport:
+    """
+    Replay a fixture's mentions for one platform through `respond_to_tweets` or
+    `respond_to_toots`, polling every `interval` seconds like `serve` does, until
+    every mention has been handled. The bot runs with a scratch state store, seeded
+    to start before the fixture's first mention, against fake services in this
+    process. Once every mention has arrived, the replay gives up if the bot goes
+    `max_idle_cycles` cycles in a row without moving its since-id.
+
+    :param entries: list of fixture entries.
+    :param platform: str, 'twitter' or 'mastodon'
+    :param speedup: How many times faster than recorded to run.
+    :param concurrency: int number of replies to have in flight at once.
+    :param interval: Seconds between polling cycles, before speed-up.
+    :param delays: Optional dict overriding DELAYS.
+    :param max_idle_cycles: int cycles without progress before giving up.
+    :return: ReplayReport
+    :raises ReplayStalled: if the bot stops handling mentions before the last one.
+    """
+    services = FakeServices(entries, platform, speedup, delays)
+    session = requests.Session()
+    session.mount("https://", services)
+    quotes = quote_service.get_session()
+    quotes.mount(QUOTE_SERVICE, services)
+    cycles = 0
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            with StateStore(os.path.join(directory, "state.sqlite3")) as store:
+                store.set_since_id(platform, 1, "replay")
+                api = connect(platform, session)
+                services.start()
+                idle = 0
+                since_id = store.get_since_id(platform, "replay") or 0
+                while True:
+                    respond(platform, api, store, concurrency)
+                    cycles += 1
+                    previous, since_id = since_id, (
+                        store.get_since_id(platform, "replay") or 0
+                    )
+                    if services.done() and since_id >= services.newest_id():
+                        break
+                    if services.all_arrived() and since_id == previous:
+                        idle += 1
+                        if idle >= max_idle_cycles:
+                            raise ReplayStalled(
+                                f"No progress past mention {since_id} in {idle} "
+                                f"cycles, {len(services.delivered)} of "
+                                f"{len(services.mentions)} mentions fetched."
+                            )
+                    else:
+                        idle = 0
+                    time.sleep(interval / speedup)
+    finally:
+        quotes.adapters.pop(QUOTE_SERVICE, None)
+    return ReplayReport(
+        platform,
+        len(services.delivered),
+        services.latencies,
+        time.time() - (services.started or 0),
+        cycles,
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """
+    Command line entry point. `record` captures mentions and quoteservice
+    responses into a fixture, using credentials from the environment, and `run`
+    replays one platform's mentions from it and reports the throughput and
+    reply latency.
+
+    :param argv: Optional list of arguments, defaults to sys.argv.
+    """
+    parser = argparse.ArgumentParser(
+        description="Record mentions into a fixture, or replay them offline."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    record = commands.add_parser("record")
+    record.add_argument("fixture")
+    record.add_argument("--platform", action="append", choices=PLATFORMS)
+    record.add_argument("--limit", type=int, default=100)
+    run = commands.add_parser("run")
+    run.add_argument("fixture")
+    run.add_argument("--platform", choices=PLATFORMS, default="twitter")
+    run.add_argument("--speedup", type=float, default=1.0)
+    run.add_argument("--concurrency", type=int, default=1)
+    run.add_argument("--interval", type=float, default=5.0)
+    args = parser.parse_args(argv)
+    if args.command == "record":
+        clients = {
+            platform: twitter_bot.get_credentials_from_environ()
+            if platform == "twitter"
+            else mastodon_bot.get_credentials_from_environ()
+            for platform in args.platform or PLATFORMS
+        }
+        count = record_fixture(args.fixture, clients, args.limit)
+        print(f"Recorded {count} mentions to {args.fixture}")
+    else:
+        report = replay(
+            load_fixture(args.fixture),
+            args.platform,
+            speedup=args.speedup,
+            concurrency=args.concurrency,
+            interval=args.interval,
+        )
+        print(report.summary())
+
+
+if __name__ == "__main__":  # pragma: nocover
+    configure_logging()
+    main()
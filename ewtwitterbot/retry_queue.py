@@ -0,0 +1,121 @@
+import time
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+from ewtwitterbot.state import StateStore
+
+
+class RetryQueue:
+    """
+    A persistent queue of replies that failed and should be attempted again in a
+    later cycle. Each item is retried with exponential backoff until it either
+    succeeds or runs out of attempts. Items live in the state store so they
+    survive restarts.
+    """
+
+    def __init__(
+        self,
+        store: StateStore,
+        platform: str,
+        account: str = "default",
+        base_delay: float = 60,
+        max_delay: float = 3600,
+        max_attempts: int = 5,
+    ) -> None:
+        """
+        :param store: The StateStore holding the queue.
+        :param platform: str, e.g. 'twitter'
+        :param account: str name of the account.
+        :param base_delay: Seconds to wait before the first retry.
+        :param max_delay: Upper bound in seconds on the wait between retries.
+        :param max_attempts: Number of failed attempts after which an item is dropped.
+        """
+        self.store = store
+        self.platform = platform
+        self.account = account
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+
+    def backoff(self, attempts: int) -> float:
+        """
+        Given the number of attempts made so far, return the delay before the next one.
+
+        :param attempts: int
+        :return: float number of seconds.
+        """
+        return min(self.base_delay * 2 ** max(attempts - 1, 0), self.max_delay)
+
+    def __len__(self) -> int:
+        return len(self.store.retry_items(self.platform, self.account))
+
+    def __contains__(self, mention_id: Any) -> bool:
+        return self.store.retry_get(self.platform, mention_id, self.account) is not None
+
+    def push(
+        self, mention_id: Any, payload: Dict[str, Any], now: Optional[float] = None
+    ) -> None:
+        """
+        Add a failed reply to the queue, counting the failure as its first attempt.
+
+        :param mention_id: The id of the mention we failed to reply to.
+        :param payload: dict of everything needed to attempt the reply again.
+        :param now: Optional timestamp, mostly for testing.
+        """
+        now = time.time() if now is None else now
+        self.store.retry_put(
+            self.platform, mention_id, 1, now + self.backoff(1), payload, self.account
+        )
+        self.store.commit()
+        logger.info(f"Queued reply to {mention_id} for retry.")
+
+    def due(self, now: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Return the items whose backoff has elapsed, oldest scheduled first.
+
+        :param now: Optional timestamp, mostly for testing.
+        :return: list of queue items.
+        """
+        now = time.time() if now is None else now
+        return self.store.retry_items(self.platform, self.account, due_by=now)
+
+    def remove(self, mention_id: Any) -> None:
+        """
+        Remove an item from the queue, e.g. after a successful retry.
+
+        :param mention_id: The id of the mention.
+        """
+        self.store.retry_delete(self.platform, mention_id, self.account)
+        self.store.commit()
+
+    def record_failure(self, mention_id: Any, now: Optional[float] = None) -> bool:
+        """
+        Record another failed attempt for an item and reschedule it, or drop it if it
+        has used up its attempts.
+
+        :param mention_id: The id of the mention.
+        :param now: Optional timestamp, mostly for testing.
+        :return: True if the item will be retried, False if it was dropped.
+        """
+        now = time.time() if now is None else now
+        item = self.store.retry_get(self.platform, mention_id, self.account)
+        if item is None:
+            return False
+        attempts = item["attempts"] + 1
+        if attempts >= self.max_attempts:
+            logger.error(
+                f"Giving up on reply to {mention_id} after {attempts} attempts."
+            )
+            self.remove(mention_id)
+            return False
+        self.store.retry_put(
+            self.platform,
+            mention_id,
+            attempts,
+            now + self.backoff(attempts),
+            item["payload"],
+            self.account,
+        )
+        self.store.commit()
+        return True
@@ -0,0 +1,159 @@
+import json
+import os
+import socket
+import time
+from typing import Any, Dict, Optional
+
+from loguru import logger
+
+from ewtwitterbot.state import get_state_filename
+
+try:
+    import fcntl
+except ImportError:  # pragma: nocover
+    fcntl = None  # type: ignore
+
+
+class RunLock:
+    """
+    Keeps two runs for the same platform from overlapping, e.g. when a cron run
+    takes longer than the cron interval. The holder's pid, host and start time are
+    written to the lock file so a run that finds it held can say by whom.
+
+    Where fcntl is available the lock is an advisory `flock`, which the kernel
+    drops as soon as the holder exits, crashes included, so it never goes stale.
+    A holder that has kept it for longer than `stale_after` is reported as stuck
+    but left alone, as it may still be working. Elsewhere the lock is a lease file
+    created exclusively, which is broken once it is older than `stale_after`.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        wait: float = 0,
+        poll_interval: float = 0.5,
+        stale_after: float = 60 * 60,
+    ) -> None:
+        """
+        :param filename: str path to the lock file.
+        :param wait: Seconds to wait for the lock before giving up.
+        :param poll_interval: Seconds between attempts while waiting.
+        :param stale_after: Seconds after which a held lock is considered stale.
+        """
+        self.filename = filename
+        self.wait = wait
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.fd: Optional[int] = None
+
+    def holder(self) -> Optional[Dict[str, Any]]:
+        """
+        Read who holds the lock.
+
+        :return: dict of pid, host and started, or None if nobody has written it.
+        """
+        try:
+            with open(self.filename) as f:
+                return json.loads(f.read() or "null")
+        except (OSError, ValueError):
+            return None
+
+    def _record_holder(self, fd: int) -> None:
+        os.ftruncate(fd, 0)
+        os.write(
+            fd,
+            json.dumps(
+                {
+                    "pid": os.getpid(),
+                    "host": socket.gethostname(),
+                    "started": time.time(),
+                }
+            ).encode("utf-8"),
+        )
+
+    def _stale(self) -> bool:
+        holder = self.holder()
+        started = holder.get("started", 0) if holder else 0
+        return time.time() - started > self.stale_after
+
+    def _try_acquire(self) -> bool:
+        if fcntl is not None:
+            fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+        else:
+            try:
+                fd = os.open(self.filename, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                if not self._stale():
+                    return False
+                logger.warning(f"Breaking stale lock {self.filename}: {self.holder()}")
+                os.remove(self.filename)
+                return self._try_acquire()
+        self._record_holder(fd)
+        self.fd = fd
+        return True
+
+    def acquire(self) -> bool:
+        """
+        Take the lock, waiting up to `wait` seconds for it.
+
+        :return: bool, True if the lock was taken.
+        """
+        give_up_at = time.monotonic() + self.wait
+        while not self._try_acquire():
+            if time.monotonic() >= give_up_at:
+                holder = self.holder()
+                if fcntl is not None and self._stale():
+                    logger.error(f"{self.filename} has been held too long: {holder}")
+                else:
+                    logger.info(f"{self.filename} is held: {holder}")
+                return False
+            time.sleep(self.poll_interval)
+        return True
+
+    def release(self) -> None:
+        """
+        Release the lock, if it is held.
+        """
+        if self.fd is None:
+            return
+        if fcntl is None:
+            os.remove(self.filename)
+        else:
+            os.ftruncate(self.fd, 0)
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+
+def get_lock_filename(platform: str) -> str:
+    """
+    Put a platform's lock file next to the state database.
+
+    :param platform: str, e.g. 'twitter'
+    :return: str
+    """
+    directory = os.path.dirname(os.path.abspath(get_state_filename()))
+    return os.path.join(directory, f"ewbot_{platform}.lock")
+
+
+def acquire_run_lock(platform: str) -> Optional[RunLock]:
+    """
+    Take the run lock for a platform, waiting `EWBOT_LOCK_WAIT` seconds (default 0)
+    if another run holds it.
+
+    :param platform: str, e.g. 'twitter'
+    :return: the held RunLock, or None if another run still holds it.
+    """
+    lock = RunLock(
+        get_lock_filename(platform),
+        wait=float(os.environ.get("EWBOT_LOCK_WAIT", default="0")),
+    )
+    if not lock.acquire():
+        logger.warning(f"Another {platform} run is still going, skipping this one.")
+        return None
+    return lock
@@ -0,0 +1,204 @@
+import argparse
+import asyncio
+import functools
+import signal
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import requests
+from loguru import logger
+
+from ewtwitterbot import mastodon_bot, twitter_bot
+from ewtwitterbot.accounts import get_accounts_filename, load_accounts
+from ewtwitterbot.daemon import AdaptiveInterval
+from ewtwitterbot.metrics import exported_metrics
+from ewtwitterbot.run_lock import acquire_run_lock
+from ewtwitterbot.state import StateStore
+from ewtwitterbot.tracing import configure_logging
+
+
+async def run_platform(
+    name: str,
+    cycle: Callable[[], int],
+    interval: AdaptiveInterval,
+    stop_event: asyncio.Event,
+    executor: Optional[Executor] = None,
+) -> None:
+    """
+    Poll one platform until the stop event is set. The blocking cycle runs in the
+    executor so other platforms keep going while it waits on the network, and a
+    failing cycle only backs off this platform.
+
+    :param name: str name of the platform or account, used in logs.
+    :param cycle: Callable that runs one polling cycle and returns the number of mentions found.
+    :param interval: AdaptiveInterval for this platform.
+    :param stop_event: asyncio.Event shared by all platforms.
+    :param executor: Optional executor to run the cycle in.
+    """
+    loop = asyncio.get_running_loop()
+    failures = 0
+    while not stop_event.is_set():
+        try:
+            handled = await loop.run_in_executor(executor, cycle)
+        except Exception as e:
+            failures += 1
+            wait = min(interval.minimum * 2**failures, interval.maximum)
+            logger.exception(f"{name} cycle failed ({failures} in a row): {e}")
+        else:
+            failures = 0
+            wait = interval.update(handled)
+        logger.debug(f"Next {name} poll in {wait:.1f} seconds.")
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=wait)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_once(
+    cycles: Dict[str, Callable[[], int]], executor: Optional[Executor] = None
+) -> Dict[str, Optional[int]]:
+    """
+    Run a single cycle for every platform concurrently.
+
+    :param cycles: dict of platform or account name to cycle callable.
+    :param executor: Optional executor to run the cycles in.
+    :return: dict of platform or account name to mentions found, or None if its cycle failed.
+    """
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(
+        *(loop.run_in_executor(executor, cycle) for cycle in cycles.values()),
+        return_exceptions=True,
+    )
+    handled: Dict[str, Optional[int]] = {}
+    for name, result in zip(cycles, results):
+        if isinstance(result, BaseException):
+            logger.error(f"{name} cycle failed: {result}")
+            handled[name] = None
+        else:
+            handled[name] = result
+    return handled
+
+
+async def run_all(
+    cycles: Dict[str, Callable[[], int]],
+    stop_event: asyncio.Event,
+    minimum: float = 5,
+    maximum: float = 300,
+    executor: Optional[Executor] = None,
+) -> None:
+    """
+    Serve every platform concurrently, each on its own adaptive interval, until
+    the stop event is set.
+
+    :param cycles: dict of platform or account name to cycle callable.
+    :param stop_event: asyncio.Event to stop all platforms.
+    :param minimum: Shortest polling interval in seconds.
+    :param maximum: Longest polling interval in seconds.
+    :param executor: Optional executor to run the cycles in.
+    """
+    await asyncio.gather(
+        *(
+            run_platform(
+                name,
+                cycle,
+                AdaptiveInterval(minimum=minimum, maximum=maximum),
+                stop_event,
+                executor,
+            )
+            for name, cycle in cycles.items()
+        )
+    )
+
+
+def build_cycles(store: StateStore) -> Dict[str, Callable[[], int]]:
+    """
+    Create the API clients for every platform configured in the environment and
+    return a cycle callable for each, all sharing the same state store. Accounts
+    listed in the `EWBOT_ACCOUNTS` file get a cycle each too, with their clients
+    sharing one HTTP session.
+
+    :param store: The shared StateStore.
+    :return: dict of platform or account name to cycle callable.
+    """
+    cycles: Dict[str, Callable[[], int]] = {}
+    try:
+        twitter_api = twitter_bot.get_credentials_from_environ()
+    except twitter_bot.TwitterImproperlyConfigured:
+        logger.info("Twitter is not configured, skipping it.")
+    else:
+        cycles["twitter"] = lambda: twitter_bot.respond_to_tweets(
+            store=store, api=twitter_api
+        )
+    try:
+        mastodon_api = mastodon_bot.get_credentials_from_environ()
+    except mastodon_bot.MastodonConfigurationError:
+        logger.info("Mastodon is not configured, skipping it.")
+    else:
+        cycles["mastodon"] = lambda: mastodon_bot.respond_to_toots(
+            store=store, api=mastodon_api
+        )
+    filename = get_accounts_filename()
+    if filename is not None:
+        session = requests.Session()
+        for account in load_accounts(filename):
+            cycles[account.key] = functools.partial(account.respond, store, session)
+    return cycles
+
+
+async def _main(mode: str, minimum: float, maximum: float, workers: int = 8) -> None:
+    store = StateStore()
+    cycles = build_cycles(store)
+    locks = []
+    for name in list(cycles):
+        lock = acquire_run_lock(name)
+        if lock is None:
+            del cycles[name]
+        else:
+            locks.append(lock)
+    if not cycles:
+        logger.error("No platforms are configured, or they are all running already.")
+        store.close()
+        return
+    executor = ThreadPoolExecutor(max_workers=min(len(cycles), workers))
+    try:
+        if mode == "once":
+            await run_once(cycles, executor)
+        else:
+            stop_event = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(signum, stop_event.set)
+            await run_all(cycles, stop_event, minimum, maximum, executor)
+    finally:
+        executor.shutdown(wait=True)
+        store.close()
+        for lock in locks:
+            lock.release()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """
+    Command line entry point serving Twitter, Mastodon and any accounts in the
+    accounts file from a single process, with at most `--workers` cycles running
+    at once however many accounts there are. Metrics are exported while it runs,
+    see `exported_metrics`.
+
+    :param argv: Optional list of arguments, defaults to sys.argv.
+    """
+    parser = argparse.ArgumentParser(
+        description="Respond to mentions on every configured platform."
+    )
+    parser.add_argument("mode", nargs="?", choices=["once", "serve"], default="serve")
+    parser.add_argument("--min-interval", type=float, default=5)
+    parser.add_argument("--max-interval", type=float, default=300)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args(argv)
+    with exported_metrics(daemon=args.mode == "serve"):
+        asyncio.run(
+            _main(args.mode, args.min_interval, args.max_interval, args.workers)
+        )
+
+
+if __name__ == "__main__":  # pragma: nocover
+    configure_logging()
+    main()
@@ -0,0 +1,548 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from loguru import logger
+
+from ewtwitterbot.tracing import span
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS since_ids (
+    platform TEXT NOT NULL,
+    account TEXT NOT NULL,
+    last_id INTEGER NOT NULL,
+    PRIMARY KEY (platform, account)
+);
+CREATE TABLE IF NOT EXISTS replied (
+    platform TEXT NOT NULL,
+    account TEXT NOT NULL,
+    mention_id INTEGER NOT NULL,
+    PRIMARY KEY (platform, account, mention_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS retry_queue (
+    platform TEXT NOT NULL,
+    account TEXT NOT NULL,
+    mention_id INTEGER NOT NULL,
+    attempts INTEGER NOT NULL,
+    next_attempt REAL NOT NULL,
+    payload TEXT NOT NULL,
+    PRIMARY KEY (platform, account, mention_id)
+);
+CREATE TABLE IF NOT EXISTS work_queue (
+    platform TEXT NOT NULL,
+    account TEXT NOT NULL,
+    mention_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    lease_expires REAL NOT NULL DEFAULT 0,
+    deliveries INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (platform, account, mention_id)
+);
+CREATE TABLE IF NOT EXISTS cache_meta (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+"""
+
+
+def get_state_filename() -> str:
+    """
+    Fetch the path of the state database from the environment, or use the default.
+
+    :return: str
+    """
+    return os.environ.get("EWBOT_STATE_DB", default="ewbot_state.sqlite3")
+
+
+class StateStore:
+    """
+    Embedded SQLite store, in WAL mode, for everything the bots need to remember
+    between mentions and runs: since-ids, replied mention ids, the retry queue,
+    and cache metadata. Writes are grouped into transactions that are committed
+    every `commit_every` writes or `commit_interval` seconds, whichever comes first.
+
+    When other processes write to the same database, as the work queue's fetcher
+    and workers do, the store is opened as `shared` and each write is committed
+    straight away instead. An open transaction holds SQLite's write lock, and
+    keeping it across an upload or post would block the other processes' claims
+    and acks until they fail with "database is locked".
+    """
+
+    def __init__(
+        self,
+        filename: Optional[str] = None,
+        commit_every: int = 20,
+        commit_interval: float = 0.5,
+        shared: bool = False,
+    ) -> None:
+        """
+        :param filename: str path to the database. Defaults to `get_state_filename()`.
+        :param commit_every: Number of writes after which `maybe_commit` commits.
+        :param commit_interval: Seconds after which `maybe_commit` commits.
+        :param shared: bool, commit every write as it is made, for a database other
+            processes write to at the same time.
+        """
+        self.filename = filename if filename is not None else get_state_filename()
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.shared = shared
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(self.filename, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.pending_writes = 0
+        self.last_commit = time.monotonic()
+
+    def __enter__(self) -> "StateStore":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def _write(self, sql: str, params: tuple = ()) -> None:
+        with self.lock:
+            self.connection.execute(sql, params)
+            self.pending_writes += 1
+            if self.shared:
+                self.commit()
+
+    def _read(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def commit(self) -> None:
+        """
+        Commit any pending writes, traced as the checkpoint stage.
+        """
+        with self.lock, span("checkpoint"):
+            self.connection.commit()
+            self.pending_writes = 0
+            self.last_commit = time.monotonic()
+
+    def maybe_commit(self) -> bool:
+        """
+        Commit if enough writes are pending or enough time has passed since the
+        last commit.
+
+        :return: True if a commit happened.
+        """
+        with self.lock:
+            if self.pending_writes == 0:
+                return False
+            if (
+                self.pending_writes >= self.commit_every
+                or time.monotonic() - self.last_commit >= self.commit_interval
+            ):
+                self.commit()
+                return True
+        return False
+
+    def close(self) -> None:
+        """
+        Commit pending writes and close the connection.
+        """
+        with self.lock:
+            self.commit()
+            self.connection.close()
+
+    def get_since_id(self, platform: str, account: str = "default") -> Optional[int]:
+        """
+        Fetch the id of the last mention handled for the platform and account.
+
+        :param platform: str, e.g. 'twitter'
+        :param account: str name of the account.
+        :return: int or None if nothing has been stored yet.
+        """
+        rows = self._read(
+            "SELECT last_id FROM since_ids WHERE platform = ? AND account = ?",
+            (platform, account),
+        )
+        return rows[0][0] if rows else None
+
+    def set_since_id(
+        self, platform: str, last_id: int, account: str = "default"
+    ) -> None:
+        """
+        Store the id of the last mention handled for the platform and account. The
+        stored id never moves backwards, so mentions handled out of order by
+        different ingestion paths cannot rewind it.
+
+        :param platform: str, e.g. 'twitter'
+        :param last_id: int
+        :param account: str name of the account.
+        """
+        self._write(
+            "INSERT INTO since_ids (platform, account, last_id) VALUES (?, ?, ?) "
+            "ON CONFLICT (platform, account) "
+            "DO UPDATE SET last_id = max(last_id, excluded.last_id)",
+            (platform, account, last_id),
+        )
+
+    def mark_replied(
+        self, platform: str, mention_id: int, account: str = "default"
+    ) -> None:
+        """
+        Record that a mention has been handled.
+
+        :param platform: str
+        :param mention_id: int
+        :param account: str name of the account.
+        """
+        self._write(
+            "INSERT OR IGNORE INTO replied (platform, account, mention_id) VALUES (?, ?, ?)",
+            (platform, account, mention_id),
+        )
+
+    def has_replied(
+        self, platform: str, mention_id: int, account: str = "default"
+    ) -> bool:
+        """
+        Check whether a mention has already been handled.
+
+        :param platform: str
+        :param mention_id: int
+        :param account: str name of the account.
+        :return: bool
+        """
+        return bool(
+            self._read(
+                "SELECT 1 FROM replied WHERE platform = ? AND account = ? AND mention_id = ?",
+                (platform, account, mention_id),
+            )
+        )
+
+    def replied_ids(self, platform: str, account: str = "default") -> Iterator[int]:
+        """
+        Iterate over all handled mention ids for the platform and account in ascending order.
+
+        :param platform: str
+        :param account: str name of the account.
+        :return: iterator of int
+        """
+        for row in self._read(
+            "SELECT mention_id FROM replied WHERE platform = ? AND account = ? ORDER BY mention_id",
+            (platform, account),
+        ):
+            yield row[0]
+
+    def retry_put(
+        self,
+        platform: str,
+        mention_id: int,
+        attempts: int,
+        next_attempt: float,
+        payload: Dict[str, Any],
+        account: str = "default",
+    ) -> None:
+        """
+        Insert or update an item in the retry queue.
+        """
+        self._write(
+            "INSERT OR REPLACE INTO retry_queue "
+            "(platform, account, mention_id, attempts, next_attempt, payload) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                platform,
+                account,
+                mention_id,
+                attempts,
+                next_attempt,
+                json.dumps(payload),
+            ),
+        )
+
+    def retry_delete(
+        self, platform: str, mention_id: int, account: str = "default"
+    ) -> None:
+        """
+        Remove an item from the retry queue.
+        """
+        self._write(
+            "DELETE FROM retry_queue WHERE platform = ? AND account = ? AND mention_id = ?",
+            (platform, account, mention_id),
+        )
+
+    def retry_get(
+        self, platform: str, mention_id: int, account: str = "default"
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Fetch a single item from the retry queue.
+
+        :return: dict with mention_id, attempts, next_attempt and payload, or None.
+        """
+        rows = self._read(
+            "SELECT attempts, next_attempt, payload FROM retry_queue "
+            "WHERE platform = ? AND account = ? AND mention_id = ?",
+            (platform, account, mention_id),
+        )
+        if not rows:
+            return None
+        attempts, next_attempt, payload = rows[0]
+        return {
+            "mention_id": mention_id,
+            "attempts": attempts,
+            "next_attempt": next_attempt,
+            "payload": json.loads(payload),
+        }
+
+    def retry_items(
+        self, platform: str, account: str = "default", due_by: Optional[float] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Fetch retry queue items, optionally only those due by the given timestamp,
+        ordered by when they are scheduled.
+
+        :return: list of dict with mention_id, attempts, next_attempt and payload.
+        """
+        sql = (
+            "SELECT mention_id, attempts, next_attempt, payload FROM retry_queue "
+            "WHERE platform = ? AND account = ?"
+        )
+        params: tuple = (platform, account)
+        if due_by is not None:
+            sql += " AND next_attempt <= ?"
+            params += (due_by,)
+        return [
+            {
+                "mention_id": mention_id,
+                "attempts": attempts,
+                "next_attempt": next_attempt,
+                "payload": json.loads(payload),
+            }
+            for mention_id, attempts, next_attempt, payload in self._read(
+                sql + " ORDER BY next_attempt", params
+            )
+        ]
+
+    def work_put(
+        self,
+        platform: str,
+        items: List[Tuple[int, Dict[str, Any]]],
+        account: str = "default",
+    ) -> None:
+        """
+        Add mentions to the work queue, ignoring any that are already in it.
+
+        :param platform: str
+        :param items: list of tuples of mention id and payload.
+        :param account: str name of the account.
+        """
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO work_queue (platform, account, mention_id, payload) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (platform, account, mention_id, json.dumps(payload))
+                    for mention_id, payload in items
+                ],
+            )
+            self.pending_writes += len(items)
+
+    def work_claim(
+        self,
+        platform: str,
+        owner: str,
+        limit: int,
+        lease_expires: float,
+        now: float,
+        account: str = "default",
+    ) -> List[Dict[str, Any]]:
+        """
+        Lease the oldest work items that are not done and not leased, or whose lease
+        has expired. The items are picked and leased in a single immediate
+        transaction, so two processes sharing the database never claim the same one.
+
+        :param platform: str
+        :param owner: str name of the worker taking the lease.
+        :param limit: int most items to claim.
+        :param lease_expires: float timestamp at which the lease runs out.
+        :param now: float current timestamp.
+        :param account: str name of the account.
+        :return: list of dict with mention_id, deliveries and payload.
+        """
+        with self.lock:
+            self.commit()
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.connection.execute(
+                    "SELECT mention_id, deliveries, payload FROM work_queue "
+                    "WHERE platform = ? AND account = ? AND done = 0 AND lease_expires <= ? "
+                    "ORDER BY mention_id LIMIT ?",
+                    (platform, account, now, limit),
+                ).fetchall()
+                self.connection.executemany(
+                    "UPDATE work_queue SET owner = ?, lease_expires = ?, "
+                    "deliveries = deliveries + 1 "
+                    "WHERE platform = ? AND account = ? AND mention_id = ?",
+                    [
+                        (owner, lease_expires, platform, account, mention_id)
+                        for mention_id, _, _ in rows
+                    ],
+                )
+                self.connection.commit()
+            except BaseException:  # pragma: nocover
+                self.connection.rollback()
+                raise
+        return [
+            {
+                "mention_id": mention_id,
+                "deliveries": deliveries + 1,
+                "payload": json.loads(payload),
+            }
+            for mention_id, deliveries, payload in rows
+        ]
+
+    def work_ack(
+        self, platform: str, mention_id: int, owner: str, account: str = "default"
+    ) -> bool:
+        """
+        Mark a work item done, if the worker still holds its lease.
+
+        :param platform: str
+        :param mention_id: int
+        :param owner: str name of the worker that claimed it.
+        :param account: str name of the account.
+        :return: bool, False if the lease was lost to another worker.
+        """
+        with self.lock:
+            cursor = self.connection.execute(
+                "UPDATE work_queue SET done = 1, owner = NULL "
+                "WHERE platform = ? AND account = ? AND mention_id = ? AND owner = ?",
+                (platform, account, mention_id, owner),
+            )
+            self.commit()
+        return cursor.rowcount == 1
+
+    def work_checkpoint(self, platform: str, account: str = "default") -> Optional[int]:
+        """
+        Advance the since-id past the longest run of done work items, oldest first,
+        and remove them from the queue. Items after the first one still outstanding
+        stay in the queue, done or not, so a since-id never skips unfinished work.
+
+        :param platform: str
+        :param account: str name of the account.
+        :return: int new since-id, or None if it did not move.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT min(mention_id) FROM work_queue "
+                "WHERE platform = ? AND account = ? AND done = 0",
+                (platform, account),
+            ).fetchall()
+            sql = (
+                "SELECT max(mention_id) FROM work_queue "
+                "WHERE platform = ? AND account = ? AND done = 1"
+            )
+            params: tuple = (platform, account)
+            if rows[0][0] is not None:
+                sql += " AND mention_id < ?"
+                params += (rows[0][0],)
+            through = self.connection.execute(sql, params).fetchall()[0][0]
+            if through is None:
+                return None
+            self.set_since_id(platform, through, account)
+            self._write(
+                "DELETE FROM work_queue WHERE platform = ? AND account = ? AND mention_id <= ?",
+                (platform, account, through),
+            )
+            self.commit()
+        return through
+
+    def work_newest_id(self, platform: str, account: str = "default") -> Optional[int]:
+        """
+        Fetch the id of the newest mention in the work queue.
+
+        :param platform: str
+        :param account: str name of the account.
+        :return: int or None if the queue is empty.
+        """
+        return self._read(
+            "SELECT max(mention_id) FROM work_queue WHERE platform = ? AND account = ?",
+            (platform, account),
+        )[0][0]
+
+    def work_outstanding(self, platform: str, account: str = "default") -> int:
+        """
+        Count the work items that are not done yet.
+
+        :param platform: str
+        :param account: str name of the account.
+        :return: int
+        """
+        return self._read(
+            "SELECT count(*) FROM work_queue WHERE platform = ? AND account = ? AND done = 0",
+            (platform, account),
+        )[0][0]
+
+    def cache_get(
+        self, namespace: str, key: str, now: Optional[float] = None
+    ) -> Optional[str]:
+        """
+        Fetch an unexpired cache value.
+
+        :param namespace: str grouping for the cache, e.g. 'media:twitter:default'
+        :param key: str
+        :param now: Optional timestamp, mostly for testing.
+        :return: str value or None.
+        """
+        now = time.time() if now is None else now
+        rows = self._read(
+            "SELECT value FROM cache_meta WHERE namespace = ? AND key = ? AND expires_at > ?",
+            (namespace, key, now),
+        )
+        return rows[0][0] if rows else None
+
+    def cache_set(
+        self, namespace: str, key: str, value: str, expires_at: float
+    ) -> None:
+        """
+        Store a cache value until the given expiry timestamp.
+        """
+        self._write(
+            "INSERT OR REPLACE INTO cache_meta (namespace, key, value, expires_at) "
+            "VALUES (?, ?, ?, ?)",
+            (namespace, key, value, expires_at),
+        )
+
+    def cache_delete(self, namespace: str, key: str) -> None:
+        """
+        Remove a cache entry, e.g. one the platform no longer accepts.
+        """
+        self._write(
+            "DELETE FROM cache_meta WHERE namespace = ? AND key = ?", (namespace, key)
+        )
+
+    def cache_purge(self, now: Optional[float] = None) -> None:
+        """
+        Remove all expired cache entries.
+        """
+        now = time.time() if now is None else now
+        self._write("DELETE FROM cache_meta WHERE expires_at <= ?", (now,))
+
+    def migrate_since_id_file(
+        self, platform: str, filename: Optional[str], account: str = "default"
+    ) -> None:
+        """
+        Import a since-id from one of the old text files if the store has none yet.
+        The old file is renamed afterwards so it is not read again.
+
+        :param platform: str
+        :param filename: str path to the old last id file.
+        :param account: str name of the account.
+        """
+        if filename is None or not os.path.exists(filename):
+            return
+        if self.get_since_id(platform, account) is None:
+            with open(filename, "r") as f:
+                self.set_since_id(platform, int(f.read().strip()), account)
+            self.commit()
+            logger.info(f"Migrated {platform} since-id from {filename}.")
+        os.replace(filename, f"{filename}.migrated")
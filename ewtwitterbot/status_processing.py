@@ -2,7 +2,9 @@ from typing import Dict, Optional, Tuple
 
 from loguru import logger
 
+from ewtwitterbot.deadline import Deadline
 from ewtwitterbot.imagery import format_quote_for_image, format_sentence_for_image
+from ewtwitterbot.metrics import get_metrics
 from ewtwitterbot.quote_service import (
     fetch_and_select_random_character,
     generate_sentence,
@@ -10,8 +12,25 @@ from ewtwitterbot.quote_service import (
 )
 
 
+def request_kind(mention: str) -> Optional[str]:
+    """
+    Work out what the text of a mention asks for, the way `process_request` does.
+
+    :param mention: str
+    :return: str 'quote' or 'markov', or None if it asks for neither.
+    """
+    if "quote" in mention.lower():
+        return "quote"
+    if "markov" in mention.lower():
+        return "markov"
+    return None
+
+
 def process_request(
-    mention: str, service_name: str, character_to_use: Optional[Dict[str, str]] = None
+    mention: str,
+    service_name: str,
+    character_to_use: Optional[Dict[str, str]] = None,
+    deadline: Optional[Deadline] = None,
 ) -> Tuple[Optional[str], Optional[str]]:
     """
     Given the full text of a mention, and a service name, e.g. 'Twitter',
@@ -20,11 +39,19 @@ def process_request(
     :param mention: str
     :param service_name: str
     :param character_to_use: dict of character and slug. Mostly for testing.
+    :param deadline: Optional Deadline of the reply, bounding each quoteservice request.
+        Raises DeadlineExceeded if it has run out.
     :return: str or None for both image text to use and citation url.
     """
+
+    def timeout() -> Optional[float]:
+        return deadline.timeout("quote fetch") if deadline is not None else None
+
+    metrics = get_metrics()
     if "quote" in mention.lower():
         logger.info("They appear to be asking for a random quote.")
-        quote_result = get_random_quote()
+        metrics.inc("ewbot_requests_total", kind="quote")
+        quote_result = get_random_quote(timeout=timeout())
         if type(quote_result) == int:
             logger.error(
                 f"This quote request resulted in an error {quote_result} from QuoteServer."
@@ -33,13 +60,16 @@ def process_request(
         return format_quote_for_image(quote_result), quote_result["citation_url"]
     if "markov" in mention.lower():
         logger.info("They appear to be asking for a markov generated sentence.")
+        metrics.inc("ewbot_requests_total", kind="markov")
         if character_to_use is None:  # pragma: no cover
-            character_to_use = fetch_and_select_random_character()
+            character_to_use = fetch_and_select_random_character(timeout())
         if (
             character_to_use is None
         ):  # pragma: no cover This is already tested in other methods.
             return None, None
-        sentence_result = generate_sentence(character_to_use["slug"][3:])
+        sentence_result = generate_sentence(
+            character_to_use["slug"][3:], timeout=timeout()
+        )
         if type(sentence_result) == int:
             logger.error(
                 f"The sentence request to the QuoteServer responded with code {sentence_result}."
@@ -51,4 +81,27 @@ def process_request(
             ),
             "https://www.explorerswanted.fm",
         )
+    metrics.inc("ewbot_requests_total", kind="other")
     return None, None
+
+
+def format_text_reply(
+    prefix: str, text_to_use: str, link_to_quote: Optional[str], limit: int
+) -> str:
+    """
+    Format a reply that carries the quote or sentence as text instead of an image,
+    shortening the text to fit the platform's length limit. Links count as 23
+    characters on both Twitter and Mastodon.
+
+    :param prefix: str start of the reply, e.g. the mention of the user.
+    :param text_to_use: str text that would have been rendered onto the image.
+    :param link_to_quote: str citation url, or None.
+    :param limit: int maximum length of a post on the platform.
+    :return: str
+    """
+    text = " ".join(text_to_use.split())
+    budget = limit - len(prefix) - 1 - (24 if link_to_quote else 0)
+    if len(text) > budget:
+        text = text[: budget - 1].rstrip() + "\u2026"
+    reply = f"{prefix} {text}"
+    return f"{reply} {link_to_quote}" if link_to_quote else reply
@@ -0,0 +1,103 @@
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+from loguru import logger
+
+from ewtwitterbot.metrics import get_metrics
+
+
+@contextmanager
+def trace_mention(
+    platform: str, mention_id: Any, account: str = "default"
+) -> Iterator[str]:
+    """
+    Tag every log record made while replying to a mention, in this thread or any
+    task or thread started from it, with the mention's trace id. The id is derived
+    from the mention, so a retry of the reply shares the trace of the first try.
+
+    :param platform: str, e.g. 'twitter'
+    :param mention_id: id of the mention's post.
+    :param account: str name of the account.
+    :return: str trace id.
+    """
+    trace_id = f"{platform}:{account}:{mention_id}"
+    with logger.contextualize(trace_id=trace_id):
+        yield trace_id
+
+
+@contextmanager
+def span(stage: str, **labels: str) -> Iterator[None]:
+    """
+    Time a stage of the reply as a child span of the current trace. The span is
+    logged as a structured record once it ends, at DEBUG unless the stage failed,
+    and recorded in the stage metrics.
+
+    :param stage: str name of the stage, e.g. 'render'
+    :param labels: str label values, e.g. platform.
+    """
+    started = time.monotonic()
+    outcome = "error"
+    try:
+        with get_metrics().time(stage, **labels):
+            yield
+        outcome = "ok"
+    finally:
+        logger.log(
+            "DEBUG" if outcome == "ok" else "INFO",
+            "{span} {outcome} in {duration_ms}ms",
+            span=stage,
+            outcome=outcome,
+            duration_ms=round((time.monotonic() - started) * 1000, 1),
+            **labels,
+        )
+
+
+def write_json(message: Any) -> None:
+    """
+    Loguru sink writing each record to stderr as a line of JSON, with the bound
+    fields such as the trace id and span at the top level.
+
+    :param message: loguru message, formatted as just its exception, if any.
+    """
+    record = message.record
+    entry = {
+        "time": record["time"].isoformat(),
+        "level": record["level"].name,
+        "message": record["message"],
+        "logger": record["name"],
+        "function": record["function"],
+        "line": record["line"],
+    }
+    entry.update(record["extra"])
+    exception = str(message).strip()
+    if exception:
+        entry["exception"] = exception
+    sys.stderr.write(json.dumps(entry, default=str) + "\n")
+
+
+def configure_logging(
+    level: Optional[str] = None, json_logs: Optional[bool] = None
+) -> None:
+    """
+    Replace loguru's default handler with an enqueued one, so writing a log record
+    happens on loguru's worker thread instead of blocking a reply. Records are
+    written as JSON when `EWBOT_LOG_FORMAT` is `json`, or by default when stderr
+    isn't a terminal, e.g. under cron or systemd.
+
+    :param level: Optional str lowest level logged, defaults to `EWBOT_LOG_LEVEL` or INFO.
+    :param json_logs: Optional bool overriding the format.
+    """
+    if level is None:
+        level = os.environ.get("EWBOT_LOG_LEVEL", default="INFO")
+    if json_logs is None:
+        log_format = os.environ.get("EWBOT_LOG_FORMAT", default="")
+        json_logs = log_format == "json" if log_format else not sys.stderr.isatty()
+    logger.remove()
+    if json_logs:
+        logger.add(write_json, level=level, format="{exception}", enqueue=True)
+    else:
+        logger.add(sys.stderr, level=level, enqueue=True)
@@ -1,20 +1,75 @@
+import argparse
+import asyncio
 import os
-from typing import Any, Optional, Union
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple, Union
 
+import requests
 import tweepy
 from loguru import logger
+from requests.exceptions import Timeout
 
-from ewtwitterbot.imagery import get_quote_image
-from ewtwitterbot.status_processing import process_request
+from ewtwitterbot.daemon import AdaptiveInterval, install_signal_handlers, serve
+from ewtwitterbot.deadline import (
+    Deadline,
+    DeadlineExceeded,
+    deadline_of,
+    get_reply_budget,
+    with_timeout,
+)
+from ewtwitterbot.fairness import get_fair_scheduler
+from ewtwitterbot.imagery import get_quote_image, temporary_image_file
+from ewtwitterbot.ledger import ReplyLedger, get_ledger
+from ewtwitterbot.load_shedding import (
+    LoadLevel,
+    get_load_shedder,
+    mention_age,
+    recent_reply,
+    remember_reply,
+)
+from ewtwitterbot.media_cache import MediaCache, content_hash
+from ewtwitterbot.metrics import exported_metrics, get_metrics
+from ewtwitterbot.profiling import MODES, CycleProfiler, get_profiler, profiled
+from ewtwitterbot.rate_limit import account_of, get_rate_limiter, set_account
+from ewtwitterbot.retry_queue import RetryQueue
+from ewtwitterbot.run_lock import acquire_run_lock
+from ewtwitterbot.state import StateStore
+from ewtwitterbot.status_processing import (
+    format_text_reply,
+    process_request,
+    request_kind,
+)
+from ewtwitterbot.tracing import configure_logging, span, trace_mention
+from ewtwitterbot.work_queue import WorkQueue, get_worker_name
+
+# Reply stage each API call is traced and timed as, by endpoint. Other calls
+# are traced under their own name.
+STAGES = {
+    "mentions_timeline": "mention_fetch",
+    "media_upload": "upload",
+    "update_status": "post",
+}
+
+# Twitter's error code for "Status is a duplicate."
+DUPLICATE_STATUS = 187
+# Twitter's error codes for a media id that failed validation or was not found,
+# e.g. because it expired.
+MEDIA_ERRORS = (324, 325)
 
 
 class TwitterImproperlyConfigured(Exception):
     pass
 
 
-def get_credentials_from_environ() -> tweepy.API:
+def get_keys_from_environ() -> Tuple[str, str, str, str]:
     """
-    Sets our credentials from the environment variables.
+    Fetch the consumer key and secret and the access token and secret from the
+    environment variables.
+
+    :return: tuple of consumer key, consumer secret, access token, access token secret.
     """
     consumer_key: Union[str, Any] = os.environ.get("TWITTER_CONSUMER_KEY", default=None)
     consumer_secret: Union[str, Any] = os.environ.get(
@@ -32,38 +87,66 @@ def get_credentials_from_environ() -> tweepy.API:
         or access_token_secret is None
     ):
         raise TwitterImproperlyConfigured
+    return consumer_key, consumer_secret, access_token, access_token_secret
+
+
+def get_credentials(
+    consumer_key: str,
+    consumer_secret: str,
+    access_token: str,
+    access_token_secret: str,
+    account: str = "default",
+    session: Optional[requests.Session] = None,
+) -> tweepy.API:
+    """
+    Create an authenticated client for one account. The account name is kept on
+    the client so its calls are paced against that account's rate limits.
+
+    :param consumer_key: str
+    :param consumer_secret: str
+    :param access_token: str
+    :param access_token_secret: str
+    :param account: str name of the account.
+    :param session: Optional requests.Session to share between accounts' clients.
+    :return: tweepy.API
+    """
     auth = tweepy.OAuth1UserHandler(consumer_key, consumer_secret)
     auth.set_access_token(access_token, access_token_secret)
-    return tweepy.API(auth)
+    api = tweepy.API(auth)
+    if session is not None:
+        api.session = session
+    set_account(api, account)
+    return api
 
 
-def get_last_tweet_id(filename: str) -> int:
+def get_credentials_from_environ() -> tweepy.API:
     """
-    Get the stored last tweet id that we responded to.
-
-    :param filename: str representation of path to filename.
-    :return: int representation of tweet id.
+    Sets our credentials from the environment variables.
     """
-    if os.path.exists(filename):
-        with open(filename, "r") as f:
-            last_id = int(f.read().strip())
-            logger.debug(f"Fetched last tweet id as {last_id}.")
-        return last_id
-    logger.debug("No previous tweet id saved. Returning 1 as error code.")
-    return 1  # if no id checked yet, provide the earliest ever, and it becomes our error code.
+    return get_credentials(*get_keys_from_environ())
 
 
-def save_last_tweet_id(filename: str, tweet_id: int) -> None:
+def call_api(api: tweepy.API, endpoint: str, *args: Any, **kwargs: Any) -> Any:
     """
-    Save the last tweet id we replied to in a file.
+    Call a tweepy.API method once it fits in the endpoint's rate limit budget for
+    the client's account, then update the budget from the rate limit headers of the
+    response. A client bounded by a deadline gives up rather than wait past it.
 
-    :param filename: str representation of path to file
-    :param tweet_id: The int representation of the tweet id.
-    :return:
+    :param api: An instance of an authenticated tweepy.API
+    :param endpoint: str name of the tweepy.API method, e.g. 'update_status'
+    :return: whatever the method returns.
     """
-    with open(filename, "w") as f:
-        f.write(str(tweet_id))
-    logger.info(f"Saved last tweet responded to as {tweet_id}")
+    limiter = get_rate_limiter()
+    account = account_of(api)
+    limiter.wait("twitter", endpoint, account, deadline_of(api))
+    try:
+        with span(STAGES.get(endpoint, endpoint), platform="twitter"):
+            return getattr(api, endpoint)(*args, **kwargs)
+    finally:
+        response = getattr(api, "last_response", None)
+        limiter.update_from_headers(
+            "twitter", endpoint, getattr(response, "headers", None), account
+        )
 
 
 def upload_image_and_set_metadata(
@@ -78,55 +161,921 @@ def upload_image_and_set_metadata(
     :return: media_id, or None on a failure.
     """
     try:
-        media = api.media_upload(image_filename)
-        api.create_media_metadata(media.media_id, alt_text=alt_text)
+        media = call_api(api, "media_upload", image_filename)
+        call_api(api, "create_media_metadata", media.media_id, alt_text=alt_text)
     except tweepy.errors.TweepyException as e:  # pragma: no cover
         logger.error(f"Error trying to upload media to twitter. {e}")
         return None
     return media.media_id
 
 
-def respond_to_tweets(filename: Optional[str] = "last_tweet.txt") -> None:
+def iter_mentions(
+    api: tweepy.API,
+    since_id: int,
+    limit: Optional[int] = None,
+    page_size: int = 200,
+) -> Iterator[tweepy.models.Status]:
     """
-    Respond to recent mentions that include one of the command words.
+    Walk every page of mentions newer than `since_id` using `max_id` pagination and
+    yield them oldest-first, stopping after `limit` mentions so a large backlog is
+    drained across several cycles.
 
-    :param filename: str representation of path to filename for last tweet id
-    :return:
+    The timeline can only be paged backwards from the newest mention, so every page
+    has to be fetched before the oldest one can be yielded. Only the oldest pages
+    that can still be handed out are kept: newer ones are dropped once the older
+    pages hold `limit` mentions, and are fetched again on a later cycle. Each page
+    is released as soon as its mentions have been handed out.
+
+    :param api: An instance of an authenticated tweepy.API
+    :param since_id: int id of the last mention already handled.
+    :param limit: Optional int maximum number of mentions to yield.
+    :param page_size: int number of mentions to request per page.
+    :return: iterator of tweepy Status objects.
     """
-    api = get_credentials_from_environ()
-    last_id = get_last_tweet_id(filename)
-
-    mentions = api.mentions_timeline(since_id=last_id, tweet_mode="extended")
-
-    if len(mentions) == 0:  # pragma: nocover
-        logger.debug("No new mentions! Exiting...")
-        return
-    text_to_use: Optional[str]
-    logger.info("Someone mentioned me on Twitter.")
-    for mention in reversed(mentions):
-        logger.info(str(mention.id) + "-" + mention.full_text)
-        new_id = mention.id
-        text_to_use, link_to_quote = process_request(mention.full_text, "Twitter")
-        if text_to_use is not None:
-            logger.debug("Creating image for requested quote/sentence...")
-            get_quote_image(text_to_use)
-            media_id = upload_image_and_set_metadata(
+    pages: Deque[List[tweepy.models.Status]] = deque()
+    collected = 0
+    max_id = None
+    while True:
+        page = call_api(
+            api,
+            "mentions_timeline",
+            since_id=since_id,
+            max_id=max_id,
+            count=page_size,
+            tweet_mode="extended",
+        )
+        if len(page) == 0:
+            break
+        logger.debug(f"Fetched a page of {len(page)} mentions.")
+        pages.append(page)
+        collected += len(page)
+        while limit is not None and collected - len(pages[0]) >= limit:
+            collected -= len(pages.popleft())
+        max_id = min(mention.id for mention in page) - 1
+    yielded = 0
+    while pages:
+        for mention in reversed(pages.pop()):
+            if limit is not None and yielded >= limit:
+                logger.info(f"Reached {limit} mentions, leaving the rest for later.")
+                return
+            yield mention
+            yielded += 1
+
+
+def bootstrap_since_id(
+    api: tweepy.API, store: StateStore, account: str = "default"
+) -> int:
+    """
+    Start a fresh store from the newest mention instead of replying to the whole
+    mentions timeline, which on an account with a history would flood old threads
+    with replies.
+
+    :param api: An instance of an authenticated tweepy.API
+    :param store: The StateStore to seed.
+    :param account: str name of the account.
+    :return: int the since-id stored.
+    """
+    page = call_api(api, "mentions_timeline", count=1)
+    since_id = page[0].id if len(page) > 0 else 1
+    logger.info(f"No since-id stored yet, starting after mention {since_id}.")
+    store.set_since_id("twitter", since_id, account)
+    return since_id
+
+
+def is_duplicate(error: tweepy.errors.TweepyException) -> bool:
+    """
+    Check whether Twitter turned a reply down as a duplicate of one already posted,
+    e.g. by an earlier try whose response was lost to a timeout.
+
+    :param error: tweepy.errors.TweepyException raised by the post.
+    :return: bool
+    """
+    return (
+        isinstance(error, tweepy.errors.HTTPException)
+        and DUPLICATE_STATUS in error.api_codes
+    )
+
+
+def is_media_error(error: tweepy.errors.TweepyException) -> bool:
+    """
+    Check whether Twitter turned a reply down because of its media id.
+
+    :param error: tweepy.errors.TweepyException raised by the post.
+    :return: bool
+    """
+    return isinstance(error, tweepy.errors.HTTPException) and any(
+        code in error.api_codes for code in MEDIA_ERRORS
+    )
+
+
+def send_reply(
+    api: tweepy.API,
+    mention_id: int,
+    status: str,
+    deadline: Optional[Deadline] = None,
+    **kwargs: Any,
+) -> None:
+    """
+    Post a reply to the mention, treating a duplicate as already posted.
+
+    :param api: An instance of an authenticated tweepy.API
+    :param mention_id: int id of the tweet to reply to.
+    :param status: str text of the reply.
+    :param deadline: Optional Deadline bounding the post.
+    :param kwargs: Extra arguments for `update_status`, e.g. media_ids.
+    :raises tweepy.errors.TweepyException: if the post failed for another reason.
+    """
+    try:
+        call_api(
+            with_timeout(api, "timeout", deadline, "post"),
+            "update_status",
+            status=status,
+            in_reply_to_status_id=mention_id,
+            **kwargs,
+        )
+    except tweepy.errors.TweepyException as e:
+        if not is_duplicate(e):
+            raise
+        logger.info(f"Already replied to {mention_id}")
+
+
+def post_reply(
+    api: tweepy.API,
+    mention_id: int,
+    status: str,
+    deadline: Optional[Deadline] = None,
+    **kwargs: Any,
+) -> bool:
+    """
+    Post a reply to the mention.
+
+    :param api: An instance of an authenticated tweepy.API
+    :param mention_id: int id of the tweet to reply to.
+    :param status: str text of the reply.
+    :param deadline: Optional Deadline bounding the post.
+    :param kwargs: Extra arguments for `update_status`, e.g. media_ids.
+    :return: False if the post failed, e.g. timed out, and should be retried, else
+        True, including when it had already been posted.
+    """
+    try:
+        send_reply(api, mention_id, status, deadline, **kwargs)
+    except tweepy.errors.TweepyException as e:
+        logger.error(f"Error replying to {mention_id}. {e}")
+        return False
+    return True
+
+
+def reply_to_mention(
+    api: tweepy.API,
+    mention_id: int,
+    screen_name: str,
+    text_to_use: str,
+    link_to_quote: Optional[str],
+    image_filename: Optional[str] = None,
+    media_cache: Optional[MediaCache] = None,
+    text_only: bool = False,
+    deadline: Optional[Deadline] = None,
+) -> bool:
+    """
+    Render the quote image, upload it, and reply to the mention with it. If the
+    same image was uploaded recently its media id is reused instead, unless Twitter
+    turns that media id down, in which case the image is uploaded once more.
+
+    :param api: An instance of an authenticated tweepy.API
+    :param mention_id: int id of the tweet to reply to.
+    :param screen_name: str screen name of the user who mentioned us.
+    :param text_to_use: str text to render onto the image.
+    :param link_to_quote: str citation url to include in the reply.
+    :param image_filename: Optional str path to render the image to, defaults to a
+        temporary file of the reply's own that is removed afterwards.
+    :param media_cache: Optional MediaCache of recently uploaded images.
+    :param text_only: bool, reply with the text itself instead of an image, to shed load.
+    :param deadline: Optional Deadline bounding the upload and post.
+    :return: False if the media upload failed or the deadline ran out and the reply
+        should be retried, else True.
+    """
+    try:
+        if text_only:
+            return post_reply(
                 api,
-                "quote_image.png",
+                mention_id,
+                format_text_reply(f"@{screen_name}", text_to_use, link_to_quote, 280),
+                deadline,
+            )
+        if deadline is not None:
+            deadline.timeout("render")
+        logger.debug("Creating image for requested quote/sentence...")
+        status = f"@{screen_name} Here you go. Peaceful journeys. {link_to_quote}"
+        with ExitStack() as stack:
+            if image_filename is None:
+                image_filename = stack.enter_context(
+                    temporary_image_file(f"quote_image_{mention_id}_")
+                )
+            get_quote_image(text_to_use, filename=image_filename)
+            digest = None
+            if media_cache is not None:
+                digest = content_hash(image_filename)
+                media_id = media_cache.get(digest)
+                if media_id is not None:
+                    try:
+                        send_reply(
+                            api, mention_id, status, deadline, media_ids=[media_id]
+                        )
+                        return True
+                    except tweepy.errors.TweepyException as e:
+                        if not is_media_error(e):
+                            logger.error(f"Error replying to {mention_id}. {e}")
+                            return False
+                        logger.warning(
+                            f"Media {media_id} was turned down, uploading again. {e}"
+                        )
+                        media_cache.invalidate(digest)
+            uploaded = upload_image_and_set_metadata(
+                with_timeout(api, "timeout", deadline, "upload"),
+                image_filename,
                 alt_text=f"White text on purple background reads: {text_to_use}",
             )
-            if media_id is None:  # pragma: nocover
+            if uploaded is None:
+                return False
+            media_id = str(uploaded)
+            if media_cache is not None and digest is not None:
+                media_cache.put(digest, media_id)
+            return post_reply(api, mention_id, status, deadline, media_ids=[media_id])
+    except DeadlineExceeded as e:
+        logger.warning(f"Ran out of time replying to {mention_id}. {e}")
+        return False
+
+
+async def reply_to_mentions_async(
+    api: tweepy.API,
+    payloads: List[Dict[str, Any]],
+    concurrency: int = 4,
+    media_cache: Optional[MediaCache] = None,
+    text_only: bool = False,
+    deadlines: Optional[List[Optional[Deadline]]] = None,
+) -> List[bool]:
+    """
+    Reply to several mentions at once. Each reply renders, uploads, sets the alt
+    text and posts in a worker thread, with at most `concurrency` in flight, so the
+    network waits of a batch overlap instead of adding up.
+
+    tweepy's async client only covers the v2 API, which has no media upload, so the
+    blocking v1.1 calls are run with `asyncio.to_thread`.
+
+    :param api: An instance of an authenticated tweepy.API
+    :param payloads: list of dicts of `reply_to_mention` arguments.
+    :param concurrency: int maximum number of replies in flight.
+    :param media_cache: Optional MediaCache of recently uploaded images.
+    :param text_only: bool, reply with the text itself instead of images, to shed load.
+    :param deadlines: Optional list of each reply's Deadline, in the same order as `payloads`.
+    :return: list of bools in the same order as `payloads`, False where the reply should be retried.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def reply(payload: Dict[str, Any], deadline: Optional[Deadline]) -> bool:
+        with trace_mention("twitter", payload["mention_id"], account_of(api)):
+            async with semaphore:
+                try:
+                    return await asyncio.to_thread(
+                        reply_to_mention,
+                        api,
+                        media_cache=media_cache,
+                        text_only=text_only,
+                        deadline=deadline,
+                        **payload,
+                    )
+                except Exception as e:
+                    logger.error(f"Error replying to {payload['mention_id']}. {e}")
+                    return False
+
+    if deadlines is None:
+        deadlines = [None] * len(payloads)
+    return await asyncio.gather(
+        *(reply(payload, deadline) for payload, deadline in zip(payloads, deadlines))
+    )
+
+
+def retry_failed_replies(api: tweepy.API, queue: RetryQueue) -> None:
+    """
+    Attempt any queued replies whose backoff has elapsed. Replies that ran out of
+    time before their quote was fetched fetch it first.
+
+    :param api: An instance of an authenticated tweepy.API
+    :param queue: The RetryQueue holding failed replies.
+    """
+    media_cache = MediaCache(queue.store, "twitter", queue.account)
+    for item in queue.due():
+        with trace_mention("twitter", item["mention_id"], queue.account):
+            logger.info(f"Retrying reply to {item['mention_id']}...")
+            deadline = Deadline(get_reply_budget())
+            payload = dict(item["payload"])
+            request = payload.pop("request", None)
+            if request is not None:
+                try:
+                    text_to_use, link_to_quote = process_request(
+                        request, "Twitter", deadline=deadline
+                    )
+                except (DeadlineExceeded, Timeout) as e:
+                    logger.warning(f"Ran out of time fetching a quote again. {e}")
+                    queue.record_failure(item["mention_id"])
+                    continue
+                if text_to_use is None:
+                    queue.remove(item["mention_id"])
+                    continue
+                payload.update(text_to_use=text_to_use, link_to_quote=link_to_quote)
+            if reply_to_mention(
+                api, media_cache=media_cache, deadline=deadline, **payload
+            ):
+                queue.remove(item["mention_id"])
+            else:
+                queue.record_failure(item["mention_id"])
+
+
+def get_full_text(mention: tweepy.models.Status) -> str:
+    """
+    Get the untruncated text of a tweet, whether it came from the timeline in
+    extended mode or from the streaming API.
+
+    :param mention: tweepy Status
+    :return: str
+    """
+    if hasattr(mention, "extended_tweet"):
+        return mention.extended_tweet["full_text"]
+    return getattr(mention, "full_text", None) or mention.text
+
+
+def prepare_reply(
+    mention: tweepy.models.Status,
+    ledger: ReplyLedger,
+    store: Optional[StateStore] = None,
+    level: LoadLevel = LoadLevel.NORMAL,
+    deadline: Optional[Deadline] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Work out the reply to a mention, if it is new and asks for a quote or sentence.
+    Under load the last reply to the same kind of request is reused instead of
+    fetching a new quote.
+
+    If the deadline runs out while fetching the quote, the reply is returned with
+    no text and the mention's text as `request`, so it can be queued and the quote
+    fetched when it is retried.
+
+    :param mention: tweepy Status
+    :param ledger: The ReplyLedger of handled mentions.
+    :param store: Optional StateStore keeping the last reply for reuse under load.
+    :param level: LoadLevel of the current cycle.
+    :param deadline: Optional Deadline bounding the quote fetch.
+    :return: dict of `reply_to_mention` arguments, or None if there is nothing to reply.
+    """
+    full_text = get_full_text(mention)
+    logger.info("Mention {}: {}", mention.id, full_text)
+    if mention.id in ledger:
+        logger.info(f"Already replied to {mention.id}")
+        return None
+    reused = None
+    text_to_use: Optional[str] = None
+    link_to_quote: Optional[str] = None
+    kind = request_kind(full_text)
+    if store is not None and level >= LoadLevel.REUSE and kind is not None:
+        reused = recent_reply(store, "twitter", kind, ledger.account)
+    if reused is not None:
+        text_to_use, link_to_quote = reused
+    else:
+        try:
+            text_to_use, link_to_quote = process_request(
+                full_text, "Twitter", deadline=deadline
+            )
+        except (DeadlineExceeded, Timeout) as e:
+            logger.warning(f"Ran out of time fetching a quote for {mention.id}. {e}")
+            return {
+                "mention_id": mention.id,
+                "screen_name": mention.user.screen_name,
+                "text_to_use": None,
+                "link_to_quote": None,
+                "request": full_text,
+            }
+        if text_to_use is not None and store is not None and kind is not None:
+            remember_reply(
+                store, "twitter", kind, text_to_use, link_to_quote, ledger.account
+            )
+    if text_to_use is None:
+        return None
+    return {
+        "mention_id": mention.id,
+        "screen_name": mention.user.screen_name,
+        "text_to_use": text_to_use,
+        "link_to_quote": link_to_quote,
+    }
+
+
+def handle_mention(
+    api: tweepy.API,
+    mention: tweepy.models.Status,
+    store: StateStore,
+    ledger: ReplyLedger,
+    queue: RetryQueue,
+    advance_since_id: bool = True,
+    level: LoadLevel = LoadLevel.NORMAL,
+) -> None:
+    """
+    Handle a single mention: reply to it if it is new and asks for a quote or
+    sentence, then record it as handled and advance the since-id. The reply has
+    `EWBOT_REPLY_BUDGET` seconds from start to finish, and is queued for retry if
+    it runs out.
+
+    :param api: An instance of an authenticated tweepy.API
+    :param mention: tweepy Status
+    :param store: The StateStore.
+    :param ledger: The ReplyLedger of handled mentions.
+    :param queue: The RetryQueue for failed replies.
+    :param advance_since_id: False when mentions are handled out of order and the
+        caller advances the since-id once the whole batch is done.
+    :param level: LoadLevel of the current cycle.
+    """
+    with trace_mention("twitter", mention.id, queue.account):
+        deadline = Deadline(get_reply_budget())
+        payload = prepare_reply(mention, ledger, store, level, deadline)
+        if payload is not None and (
+            payload["text_to_use"] is None
+            or not reply_to_mention(
+                api,
+                media_cache=MediaCache(store, "twitter", queue.account),
+                text_only=level >= LoadLevel.TEXT_ONLY,
+                deadline=deadline,
+                **payload,
+            )
+        ):
+            queue.push(mention.id, payload)
+        ledger.add(mention.id)
+        if advance_since_id:
+            store.set_since_id("twitter", mention.id, queue.account)
+        store.maybe_commit()
+
+
+def handle_mentions_concurrently(
+    api: tweepy.API,
+    mentions: List[tweepy.models.Status],
+    store: StateStore,
+    ledger: ReplyLedger,
+    queue: RetryQueue,
+    concurrency: int = 4,
+    level: LoadLevel = LoadLevel.NORMAL,
+) -> None:
+    """
+    Handle a batch of mentions with their replies in flight concurrently. The
+    mentions are only recorded as handled, and the since-id advanced, once every
+    reply in the batch has finished.
+
+    :param api: An instance of an authenticated tweepy.API
+    :param mentions: list of tweepy Status.
+    :param store: The StateStore.
+    :param ledger: The ReplyLedger of handled mentions.
+    :param queue: The RetryQueue for failed replies.
+    :param concurrency: int maximum number of replies in flight.
+    :param level: LoadLevel of the current cycle.
+    """
+    payloads = []
+    deadlines: List[Optional[Deadline]] = []
+    for mention in mentions:
+        with trace_mention("twitter", mention.id, queue.account):
+            deadline = Deadline(get_reply_budget())
+            payload = prepare_reply(mention, ledger, store, level, deadline)
+            if payload is None:
+                continue
+            if payload["text_to_use"] is None:
+                queue.push(mention.id, payload)
+                continue
+            payloads.append(payload)
+            deadlines.append(deadline)
+    results = asyncio.run(
+        reply_to_mentions_async(
+            api,
+            payloads,
+            concurrency,
+            media_cache=MediaCache(store, "twitter", queue.account),
+            text_only=level >= LoadLevel.TEXT_ONLY,
+            deadlines=deadlines,
+        )
+    )
+    for payload, replied in zip(payloads, results):
+        if not replied:
+            queue.push(payload["mention_id"], payload)
+    for mention in mentions:
+        ledger.add(mention.id)
+        store.set_since_id("twitter", mention.id, queue.account)
+    store.maybe_commit()
+
+
+def respond_to_tweets(
+    filename: Optional[str] = "last_tweet.txt",
+    store: Optional[StateStore] = None,
+    api: Optional[tweepy.API] = None,
+    max_mentions: Optional[int] = 100,
+    concurrency: int = 1,
+    account: str = "default",
+) -> int:
+    """
+    Respond to recent mentions that include one of the command words. On a fresh
+    store the first cycle only records the newest mention to start from.
+
+    :param filename: str path to a legacy last tweet id file to migrate into the state store.
+    :param store: An optional StateStore. One is opened from the environment if not supplied.
+    :param api: An optional authenticated tweepy.API. One is created from the environment if not supplied.
+    :param max_mentions: Optional int cap on the mentions handled in this cycle.
+    :param concurrency: int number of replies to have in flight at once. Above 1 the
+        cycle's replies are sent concurrently and checkpointed together at the end.
+    :param account: str name of the account, which keeps its own since-id, ledger,
+        retry queue and caches in the store.
+    :return: int number of mentions found.
+    """
+    if api is None:
+        api = get_credentials_from_environ()
+    owns_store = store is None
+    if store is None:  # pragma: nocover
+        store = StateStore()
+    try:
+        store.migrate_since_id_file("twitter", filename, account)
+        last_id = store.get_since_id("twitter", account)
+        store.cache_purge()
+        queue = RetryQueue(store, "twitter", account)
+        ledger = get_ledger(store, "twitter", account)
+        retry_failed_replies(api, queue)
+        if last_id is None:
+            bootstrap_since_id(api, store, account)
+            return 0
+
+        mentions = list(iter_mentions(api, last_id, limit=max_mentions))
+        if not mentions:  # pragma: nocover
+            logger.debug("No new mentions! Exiting...")
+            return 0
+        logger.info("Someone mentioned me on Twitter.")
+        get_metrics().inc("ewbot_mentions_total", len(mentions), platform="twitter")
+        served, throttled = get_fair_scheduler("twitter", account, store).order(
+            mentions, lambda mention: mention.user.screen_name
+        )
+        for mention in throttled:
+            ledger.add(mention.id)
+        now = time.time()
+        shedder = get_load_shedder()
+        level = shedder.level(
+            len(served),
+            max(
+                (mention_age(mention.created_at, now) for mention in served), default=0
+            ),
+        )
+        if level >= LoadLevel.SHED:
+            served, dropped = shedder.shed(
+                served, lambda mention: mention_age(mention.created_at, now)
+            )
+            for mention in dropped:
+                logger.warning(f"Dropping mention {mention.id} to shed load.")
+                ledger.add(mention.id)
+        if level > LoadLevel.NORMAL:
+            logger.warning(
+                f"{len(served)} mentions waiting, replying in {level.name} mode."
+            )
+        if concurrency > 1:
+            handle_mentions_concurrently(
+                api, served, store, ledger, queue, concurrency, level
+            )
+        else:
+            for mention in served:
+                handle_mention(
+                    api,
+                    mention,
+                    store,
+                    ledger,
+                    queue,
+                    advance_since_id=False,
+                    level=level,
+                )
+        store.set_since_id("twitter", mentions[-1].id, account)
+        return len(mentions)
+    finally:
+        if owns_store:  # pragma: nocover
+            store.close()
+        else:
+            store.commit()
+
+
+def serve_tweets(
+    filename: Optional[str] = "last_tweet.txt",
+    interval: Optional[AdaptiveInterval] = None,
+    concurrency: int = 1,
+    profiler: Optional[CycleProfiler] = None,
+) -> None:
+    """
+    Keep one process alive that polls for mentions on an adaptive interval, reusing
+    the API client, state store and warm caches between cycles.
+
+    :param filename: str path to a legacy last tweet id file to migrate into the state store.
+    :param interval: Optional AdaptiveInterval controlling the polling rate.
+    :param concurrency: int number of replies to have in flight at once.
+    :param profiler: Optional CycleProfiler to profile every cycle with.
+    """
+    api = get_credentials_from_environ()
+    store = StateStore()
+    serve(
+        profiled(
+            lambda: respond_to_tweets(
+                filename, store=store, api=api, concurrency=concurrency
+            ),
+            profiler,
+        ),
+        interval=interval,
+        on_shutdown=store.close,
+    )
+
+
+def enqueue_mentions(
+    api: tweepy.API, store: StateStore, max_mentions: Optional[int] = 100
+) -> int:
+    """
+    Fetcher side of the work queue mode: retry failed replies, then queue any new
+    mentions for the workers, and advance the since-id past those they have done.
+    On a fresh store the first pass only records the newest mention to start from.
+
+    :param api: An instance of an authenticated tweepy.API
+    :param store: The StateStore shared with the workers.
+    :param max_mentions: Optional int cap on the mentions fetched in this pass.
+    :return: int number of mentions queued.
+    """
+    work = WorkQueue(store, "twitter")
+    retry_failed_replies(api, RetryQueue(store, "twitter"))
+    cursor = work.cursor()
+    if cursor is None:
+        bootstrap_since_id(api, store)
+        return 0
+    mentions = list(iter_mentions(api, cursor, limit=max_mentions))
+    if mentions:
+        work.enqueue([(mention.id, mention._json) for mention in mentions])
+    work.checkpoint()
+    return len(mentions)
+
+
+def work_on_mentions(
+    api: tweepy.API, store: StateStore, worker: str, batch_size: int = 5
+) -> int:
+    """
+    Worker side of the work queue mode: claim a batch of queued mentions, reply to
+    them, and ack each one once it is handled. A mention is looked up in the state
+    store before replying, since another worker may have replied to it after this
+    process's ledger was loaded, e.g. before its lease ran out.
+
+    :param api: An instance of an authenticated tweepy.API
+    :param store: The StateStore shared with the fetcher.
+    :param worker: str name of this worker.
+    :param batch_size: int most mentions to claim at once.
+    :return: int number of mentions handled.
+    """
+    work = WorkQueue(store, "twitter")
+    queue = RetryQueue(store, "twitter")
+    ledger = get_ledger(store, "twitter")
+    items = work.claim(worker, batch_size)
+    for item in items:
+        if store.has_replied("twitter", item["mention_id"], ledger.account):
+            logger.info(f"Already replied to {item['mention_id']}")
+        else:
+            mention = tweepy.models.Status.parse(api, item["payload"])
+            handle_mention(api, mention, store, ledger, queue, advance_since_id=False)
+        work.ack(worker, item["mention_id"])
+    work.checkpoint()
+    return len(items)
+
+
+def fetch_tweets(profiler: Optional[CycleProfiler] = None) -> None:
+    """
+    Queue new mentions for the workers once, using credentials and state from the
+    environment.
+
+    :param profiler: Optional CycleProfiler to profile the pass with.
+    """
+    api = get_credentials_from_environ()
+    with StateStore(shared=True) as store:
+        profiled(lambda: enqueue_mentions(api, store), profiler)()
+
+
+def work_tweets(
+    interval: Optional[AdaptiveInterval] = None,
+    batch_size: int = 5,
+    profiler: Optional[CycleProfiler] = None,
+) -> None:
+    """
+    Keep a worker process replying to queued mentions until SIGTERM or SIGINT.
+    Any number of workers can run at once on the host holding the state store.
+
+    :param interval: Optional AdaptiveInterval controlling how often the queue is checked.
+    :param batch_size: int most mentions to claim at once.
+    :param profiler: Optional CycleProfiler to profile every cycle with.
+    """
+    api = get_credentials_from_environ()
+    store = StateStore(shared=True)
+    worker = get_worker_name()
+    serve(
+        profiled(lambda: work_on_mentions(api, store, worker, batch_size), profiler),
+        interval=interval,
+        on_shutdown=store.close,
+    )
+
+
+class MentionStream(tweepy.Stream):
+    """
+    Filtered stream tracking mentions of the bot account. Every tweet pushed to
+    us goes to `on_mention`, and every time the stream (re)connects `on_backfill`
+    is called so gaps are filled in with a since-id poll. Once `stop_event` is set
+    the stream disconnects at the next tweet or keep-alive.
+    """
+
+    def __init__(
+        self,
+        consumer_key: str,
+        consumer_secret: str,
+        access_token: str,
+        access_token_secret: str,
+        screen_name: str,
+        on_mention: Callable[[tweepy.models.Status], None],
+        on_backfill: Callable[[], Any],
+        stop_event: threading.Event,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(
+            consumer_key, consumer_secret, access_token, access_token_secret, **kwargs
+        )
+        self.screen_name = screen_name
+        self.on_mention = on_mention
+        self.on_backfill = on_backfill
+        self.stop_event = stop_event
+
+    def _check_stop(self) -> bool:
+        if self.stop_event.is_set():
+            self.disconnect()
+            return True
+        return False
+
+    def on_connect(self) -> None:
+        logger.info(
+            "Connected to the Twitter stream, catching up on missed mentions..."
+        )
+        self.on_backfill()
+
+    def on_keep_alive(self) -> None:
+        self._check_stop()
+
+    def on_status(self, status: tweepy.models.Status) -> None:
+        if self._check_stop():
+            return
+        if hasattr(status, "retweeted_status"):
+            return
+        if status.user.screen_name.lower() == self.screen_name.lower():
+            return
+        self.on_mention(status)
+
+    def track(self) -> None:
+        """
+        Start tracking mentions of the bot account. Blocks until disconnected.
+        """
+        self.filter(track=[f"@{self.screen_name}"])
+
+
+class ReplayMentionStream(MentionStream):
+    """
+    Local stand-in for the streaming endpoint that replays recorded stream lines from
+    a file through the same message handling as a live connection. Blank lines are
+    treated as keep-alives.
+    """
+
+    def __init__(self, *args: Any, replay_filename: str, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.replay_filename = replay_filename
+
+    def _connect(self, method: str, endpoint: str, **kwargs: Any) -> None:
+        self.running = True
+        self.on_connect()
+        with open(self.replay_filename, "r") as f:
+            for line in f:
+                if not self.running:
+                    break
+                if line.strip():
+                    self.on_data(line)
+                else:
+                    self.on_keep_alive()
+        self.running = False
+        self.on_disconnect()
+
+
+def stream_tweets(
+    api: tweepy.API,
+    store: StateStore,
+    stop_event: threading.Event,
+    stream_class: type = MentionStream,
+    **stream_kwargs: Any,
+) -> None:
+    """
+    Handle mentions as they are pushed by the filtered stream. tweepy reconnects
+    with backoff by itself, and each reconnection triggers a since-id poll.
+
+    :param api: An instance of an authenticated tweepy.API
+    :param store: The StateStore.
+    :param stop_event: threading.Event that ends streaming when set.
+    :param stream_class: MentionStream or a stand-in such as ReplayMentionStream.
+    :param stream_kwargs: Extra keyword arguments for the stream class.
+    """
+    queue = RetryQueue(store, "twitter")
+    ledger = get_ledger(store, "twitter")
+
+    def on_mention(status: tweepy.models.Status) -> None:
+        handle_mention(api, status, store, ledger, queue)
+        store.commit()
+
+    stream = stream_class(
+        *get_keys_from_environ(),
+        screen_name=call_api(api, "verify_credentials").screen_name,
+        on_mention=on_mention,
+        on_backfill=lambda: respond_to_tweets(None, store=store, api=api),
+        stop_event=stop_event,
+        **stream_kwargs,
+    )
+    stream.track()
+    logger.info("Stopped streaming.")
+
+
+def stream_tweets_forever() -> None:
+    """
+    Stream mentions until SIGTERM or SIGINT, using credentials and state from the environment.
+    """
+    api = get_credentials_from_environ()
+    stop_event = threading.Event()
+    install_signal_handlers(stop_event)
+    with StateStore() as store:
+        stream_tweets(api, store, stop_event)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """
+    Command line entry point. Runs a single pass by default, `serve` to keep polling,
+    or `stream` to handle mentions as they are pushed by the filtered stream. In
+    work queue mode, `fetch` queues new mentions once and `work` runs a worker
+    replying to them.
+
+    Exits straight away if another Twitter run is still going, unless it is a worker.
+    Metrics are exported while it runs, see `exported_metrics`. Polling cycles
+    are profiled with `--profile` or `EWBOT_PROFILE`, see `get_profiler`.
+
+    :param argv: Optional list of arguments, defaults to sys.argv.
+    """
+    parser = argparse.ArgumentParser(description="Respond to mentions on Twitter.")
+    parser.add_argument(
+        "mode",
+        nargs="?",
+        choices=["once", "serve", "stream", "fetch", "work"],
+        default="once",
+    )
+    parser.add_argument("--min-interval", type=float, default=5)
+    parser.add_argument("--max-interval", type=float, default=300)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--profile", action="append", choices=MODES)
+    args = parser.parse_args(argv)
+    profiler = get_profiler(args.profile, "twitter")
+    try:
+        with exported_metrics(daemon=args.mode in ("serve", "stream", "work")):
+            if args.mode == "work":
+                work_tweets(
+                    AdaptiveInterval(
+                        minimum=args.min_interval, maximum=args.max_interval
+                    ),
+                    profiler=profiler,
+                )
+                return
+            lock = acquire_run_lock("twitter")
+            if lock is None:
                 return
             try:
-                api.update_status(
-                    status=f"@{mention.user.screen_name} Here you go. Peaceful journeys. {link_to_quote}",
-                    in_reply_to_status_id=mention.id,
-                    media_ids=[media_id],
-                )
-            except tweepy.errors.TweepyException:  # pragma: nocover
-                logger.info(f"Already replied to {mention.id}")
-        save_last_tweet_id(filename, new_id)
+                if args.mode == "stream":
+                    stream_tweets_forever()
+                elif args.mode == "fetch":
+                    fetch_tweets(profiler)
+                elif args.mode == "serve":
+                    serve_tweets(
+                        interval=AdaptiveInterval(
+                            minimum=args.min_interval, maximum=args.max_interval
+                        ),
+                        concurrency=args.concurrency,
+                        profiler=profiler,
+                    )
+                else:
+                    profiled(
+                        lambda: respond_to_tweets(
+                            "last_tweet.txt", concurrency=args.concurrency
+                        ),
+                        profiler,
+                    )()
+            finally:
+                lock.release()
+    finally:
+        if profiler is not None:
+            profiler.close()
 
 
 if __name__ == "__main__":  # pragma: nocover
-    respond_to_tweets("last_tweet.txt")
+    configure_logging()
+    main()
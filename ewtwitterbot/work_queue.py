@@ -0,0 +1,131 @@
+import os
+import socket
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from ewtwitterbot.state import StateStore
+
+
+def get_worker_name() -> str:
+    """
+    Name this process as a worker, unique across hosts sharing the queue.
+
+    :return: str
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    Mentions waiting to be replied to, shared through the state store by one
+    fetcher and any number of worker processes. The fetcher enqueues new mentions,
+    and each worker claims a few at a time under a lease, replies, and acks them.
+    A worker that dies holding a lease only delays its items until the lease runs
+    out, after which another worker is given them.
+
+    The since-id only moves past a contiguous run of done items, so whichever
+    worker finishes first, a restart never skips a mention that is still in
+    flight.
+    """
+
+    def __init__(
+        self,
+        store: StateStore,
+        platform: str,
+        account: str = "default",
+        lease: float = 120,
+        max_deliveries: int = 5,
+    ) -> None:
+        """
+        :param store: The StateStore holding the queue.
+        :param platform: str, e.g. 'twitter'
+        :param account: str name of the account.
+        :param lease: Seconds a worker has to finish an item before it is handed to another.
+        :param max_deliveries: Number of times an item is handed out before it is given up on.
+        """
+        self.store = store
+        self.platform = platform
+        self.account = account
+        self.lease = lease
+        self.max_deliveries = max_deliveries
+
+    def __len__(self) -> int:
+        return self.store.work_outstanding(self.platform, self.account)
+
+    def cursor(self) -> Optional[int]:
+        """
+        The id to fetch new mentions after: the newest one enqueued, or the since-id
+        if everything enqueued has been checkpointed.
+
+        :return: int or None if nothing has been fetched yet.
+        """
+        ids = [
+            mention_id
+            for mention_id in (
+                self.store.work_newest_id(self.platform, self.account),
+                self.store.get_since_id(self.platform, self.account),
+            )
+            if mention_id is not None
+        ]
+        return max(ids) if ids else None
+
+    def enqueue(self, items: List[Tuple[int, Dict[str, Any]]]) -> None:
+        """
+        Add new mentions to the queue. Mentions already in it are left alone.
+
+        :param items: list of tuples of mention id and the payload a worker needs.
+        """
+        self.store.work_put(self.platform, items, self.account)
+        self.store.commit()
+        logger.info(f"Queued {len(items)} {self.platform} mentions for the workers.")
+
+    def claim(
+        self, worker: str, limit: int = 1, now: Optional[float] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Lease the oldest available items. Items that have already been handed out
+        `max_deliveries` times are acked straight away and not returned, so one
+        mention that keeps killing its worker can't hold up the since-id.
+
+        :param worker: str name of the worker.
+        :param limit: int most items to claim.
+        :param now: Optional timestamp, mostly for testing.
+        :return: list of dict with mention_id, deliveries and payload.
+        """
+        now = time.time() if now is None else now
+        claimed = []
+        for item in self.store.work_claim(
+            self.platform, worker, limit, now + self.lease, now, self.account
+        ):
+            if item["deliveries"] > self.max_deliveries:
+                logger.error(
+                    f"Giving up on {item['mention_id']} after "
+                    f"{self.max_deliveries} deliveries."
+                )
+                self.ack(worker, item["mention_id"])
+            else:
+                claimed.append(item)
+        return claimed
+
+    def ack(self, worker: str, mention_id: int) -> bool:
+        """
+        Mark an item done.
+
+        :param worker: str name of the worker that claimed it.
+        :param mention_id: int
+        :return: bool, False if the lease had already been handed to another worker.
+        """
+        if not self.store.work_ack(self.platform, mention_id, worker, self.account):
+            logger.warning(f"Lost the lease on {mention_id} to another worker.")
+            return False
+        return True
+
+    def checkpoint(self) -> Optional[int]:
+        """
+        Advance the since-id past the contiguous done items and drop them.
+
+        :return: int new since-id, or None if it did not move.
+        """
+        return self.store.work_checkpoint(self.platform, self.account)
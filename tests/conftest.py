@@ -0,0 +1,31 @@
+import pytest
+
+from ewtwitterbot import fairness, hedging, metrics, rate_limit
+from ewtwitterbot.state import StateStore
+
+
+@pytest.fixture
+def state_store(tmp_path):
+    store = StateStore(str(tmp_path / "state.sqlite3"))
+    yield store
+    store.close()
+
+
+@pytest.fixture(autouse=True)
+def fresh_rate_limiter(monkeypatch):
+    monkeypatch.setattr(rate_limit, "_rate_limiter", None)
+
+
+@pytest.fixture(autouse=True)
+def fresh_fair_schedulers(monkeypatch):
+    monkeypatch.setattr(fairness, "_schedulers", {})
+
+
+@pytest.fixture(autouse=True)
+def fresh_hedger(monkeypatch):
+    monkeypatch.setattr(hedging, "_hedger", None)
+
+
+@pytest.fixture(autouse=True)
+def fresh_metrics(monkeypatch):
+    monkeypatch.setattr(metrics, "_metrics", None)
@@ -0,0 +1,146 @@
+import json
+from unittest import mock
+
+import pytest
+
+from ewtwitterbot import mastodon_bot, twitter_bot
+from ewtwitterbot.accounts import (
+    Account,
+    AccountConfigurationError,
+    get_accounts_filename,
+    load_accounts,
+)
+from ewtwitterbot.rate_limit import account_of
+
+TWITTER = {
+    "platform": "twitter",
+    "name": "ewbot",
+    "consumer_key": "key",
+    "consumer_secret": "secret",
+    "access_token": "token",
+    "access_token_secret": "token secret",
+}
+MASTODON = {
+    "platform": "mastodon",
+    "name": "ewbot@example.social",
+    "api_base_url": "https://example.social",
+    "access_token": "ewbot_usercred.secret",
+    "dismiss": True,
+    "concurrency": 4,
+}
+
+
+@pytest.fixture
+def accounts_file(tmp_path):
+    def write(*accounts):
+        filename = tmp_path / "accounts.json"
+        filename.write_text(json.dumps({"accounts": list(accounts)}))
+        return str(filename)
+
+    return write
+
+
+def test_load_accounts(accounts_file):
+    accounts = load_accounts(accounts_file(TWITTER, MASTODON))
+    assert [account.key for account in accounts] == [
+        "twitter-ewbot",
+        "mastodon-ewbot@example.social",
+    ]
+    assert accounts[1].settings["api_base_url"] == "https://example.social"
+    assert "platform" not in accounts[1].settings
+
+
+@pytest.mark.parametrize(
+    "entry,message",
+    [
+        (dict(TWITTER, platform="myspace"), "Unknown platform"),
+        (dict(TWITTER, name="../ewbot"), "Invalid account name"),
+        (dict(MASTODON, access_token=""), "missing access_token"),
+    ],
+)
+def test_invalid_accounts(accounts_file, entry, message):
+    with pytest.raises(AccountConfigurationError, match=message):
+        load_accounts(accounts_file(entry))
+
+
+def test_accounts_are_unique_per_platform(accounts_file):
+    load_accounts(accounts_file(TWITTER, dict(MASTODON, name="ewbot")))
+    with pytest.raises(AccountConfigurationError, match="configured twice"):
+        load_accounts(accounts_file(TWITTER, TWITTER))
+
+
+def test_unreadable_accounts_file(tmp_path):
+    filename = tmp_path / "accounts.json"
+    filename.write_text("[]")
+    with pytest.raises(AccountConfigurationError):
+        load_accounts(str(filename))
+
+
+def test_accounts_filename(monkeypatch):
+    monkeypatch.delenv("EWBOT_ACCOUNTS", raising=False)
+    assert get_accounts_filename() is None
+    monkeypatch.setenv("EWBOT_ACCOUNTS", "accounts.json")
+    assert get_accounts_filename() == "accounts.json"
+
+
+def test_twitter_account_responds_under_its_name(state_store):
+    account = Account("twitter", "ewbot", dict(TWITTER))
+    session = mock.MagicMock()
+    with mock.patch.object(twitter_bot, "respond_to_tweets", return_value=3) as respond:
+        assert account.respond(state_store, session) == 3
+        assert account.respond(state_store, session) == 3
+    api = respond.call_args[1]["api"]
+    assert account.connect() is api
+    assert api.session is session
+    assert account_of(api) == "ewbot"
+    assert respond.call_args[0] == (None,)
+    assert respond.call_args[1]["account"] == "ewbot"
+    assert respond.call_args[1]["store"] is state_store
+
+
+def test_mastodon_account_responds_under_its_name(state_store):
+    account = Account("mastodon", "ewbot@example.social", dict(MASTODON))
+    session = mock.MagicMock()
+    with mock.patch.object(mastodon_bot, "Mastodon") as client, mock.patch.object(
+        mastodon_bot, "respond_to_toots", return_value=2
+    ) as respond:
+        assert account.respond(state_store, session) == 2
+    client.assert_called_once_with(
+        access_token="ewbot_usercred.secret",
+        api_base_url="https://example.social",
+        session=session,
+    )
+    assert account_of(client.return_value) == "ewbot@example.social"
+    assert respond.call_args[1]["account"] == "ewbot@example.social"
+    assert respond.call_args[1]["dismiss"] is True
+    assert respond.call_args[1]["concurrency"] == 4
+
+
+def test_accounts_keep_separate_state(state_store):
+    apis = {}
+    for name in ("first", "second"):
+        apis[name] = mock.MagicMock()
+        apis[name].notifications.return_value = [
+            {
+                "id": mention_id,
+                "type": "mention",
+                "account": {"acct": "someone"},
+                "status": {
+                    "id": mention_id,
+                    "content": "@ewbot #quote",
+                    "account": {"acct": "someone"},
+                },
+            }
+            for mention_id in ((3, 2) if name == "first" else (7,))
+        ]
+        apis[name].fetch_previous.return_value = []
+    with mock.patch(
+        "ewtwitterbot.mastodon_bot.process_request", return_value=(None, None)
+    ):
+        for name, api in apis.items():
+            mastodon_bot.respond_to_toots(
+                None, store=state_store, api=api, dismiss=False, account=name
+            )
+    assert state_store.get_since_id("mastodon", "first") == 3
+    assert state_store.get_since_id("mastodon", "second") == 7
+    assert state_store.get_since_id("mastodon") is None
@@ -0,0 +1,74 @@
+import os
+import signal
+import threading
+
+import pytest
+
+from ewtwitterbot.daemon import AdaptiveInterval, install_signal_handlers, serve
+
+
+def test_interval_shrinks_while_busy_and_backs_off_when_idle():
+    interval = AdaptiveInterval(minimum=5, maximum=100, initial=40)
+    assert interval.update(3) == 20
+    assert interval.update(1) == 10
+    assert interval.update(1) == 5
+    assert interval.update(1) == 5
+    assert interval.update(0) == 7.5
+    for _ in range(20):
+        interval.update(0)
+    assert interval.current == 100
+
+
+def test_initial_interval_is_clamped():
+    assert AdaptiveInterval(minimum=5, maximum=10, initial=60).current == 10
+
+
+def test_serve_runs_until_stopped_and_survives_errors():
+    stop_event = threading.Event()
+    results = iter([2, RuntimeError("boom"), 0])
+    calls = []
+    shutdowns = []
+
+    def cycle():
+        calls.append(1)
+        result = next(results)
+        if isinstance(result, Exception):
+            raise result
+        if len(calls) == 3:
+            stop_event.set()
+        return result
+
+    serve(
+        cycle,
+        interval=AdaptiveInterval(minimum=0, maximum=0),
+        stop_event=stop_event,
+        on_shutdown=lambda: shutdowns.append(1),
+    )
+    assert len(calls) == 3
+    assert shutdowns == [1]
+
+
+@pytest.mark.parametrize("signum", [signal.SIGTERM, signal.SIGINT])
+def test_signal_sets_stop_event(signum):
+    previous = {s: signal.getsignal(s) for s in (signal.SIGTERM, signal.SIGINT)}
+    stop_event = threading.Event()
+    try:
+        install_signal_handlers(stop_event)
+        os.kill(os.getpid(), signum)
+        assert stop_event.wait(1)
+    finally:
+        for s, handler in previous.items():
+            signal.signal(s, handler)
+
+
+def test_serve_exits_immediately_when_already_stopped():
+    stop_event = threading.Event()
+    stop_event.set()
+    calls = []
+
+    def cycle():
+        calls.append(1)
+        return 0
+
+    serve(cycle, stop_event=stop_event)
+    assert calls == []
@@ -0,0 +1,40 @@
+from unittest import mock
+
+import pytest
+
+from ewtwitterbot.deadline import (
+    Deadline,
+    DeadlineExceeded,
+    deadline_of,
+    get_reply_budget,
+    with_timeout,
+)
+
+
+def test_deadline_counts_down():
+    deadline = Deadline(10, now=100)
+    assert deadline.remaining(now=104) == 6
+    assert deadline.timeout("upload", now=104) == 6
+    assert deadline.remaining(now=120) == 0
+    with pytest.raises(DeadlineExceeded):
+        deadline.timeout("upload", now=110)
+
+
+def test_reply_budget_from_environ(monkeypatch):
+    assert get_reply_budget() == 60
+    monkeypatch.setenv("EWBOT_REPLY_BUDGET", "12.5")
+    assert get_reply_budget() == 12.5
+
+
+def test_with_timeout_bounds_a_copy_of_the_client():
+    client = mock.MagicMock(timeout=60)
+    assert with_timeout(client, "timeout", None, "post") is client
+    deadline = Deadline(5)
+    bounded = with_timeout(client, "timeout", deadline, "post")
+    assert bounded is not client
+    assert 0 < bounded.timeout <= 5
+    assert client.timeout == 60
+    assert deadline_of(bounded) is deadline
+    assert deadline_of(client) is None
+    with pytest.raises(DeadlineExceeded):
+        with_timeout(client, "timeout", Deadline(0), "post")
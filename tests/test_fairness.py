@@ -0,0 +1,93 @@
+from ewtwitterbot.fairness import FairScheduler, SlidingWindowSketch, get_fair_scheduler
+from ewtwitterbot.state import StateStore
+
+
+def test_sketch_counts_within_window():
+    sketch = SlidingWindowSketch(window=60, slices=6)
+    for now in (0, 5, 15):
+        sketch.add("spammer", now=now)
+    sketch.add("someone", now=15)
+    assert sketch.estimate("spammer", now=15) == 3
+    assert sketch.estimate("someone", now=15) == 1
+    assert sketch.estimate("nobody", now=15) == 0
+    assert sketch.estimate("spammer", now=65) == 1
+    assert sketch.estimate("spammer", now=200) == 0
+
+
+def test_sketch_memory_is_fixed():
+    sketch = SlidingWindowSketch(width=64, depth=2, slices=3)
+    for author in range(10000):
+        sketch.add(f"user{author}", now=0)
+    assert sum(len(counters) for counters in sketch.counters) == 64 * 2 * 3
+    assert sketch.estimate("user1", now=0) >= 1
+
+
+def test_scheduler_round_robins_authors():
+    scheduler = FairScheduler(quota=10)
+    mentions = [("a", 1), ("a", 2), ("a", 3), ("b", 4), ("c", 5), ("B", 6)]
+    served, throttled = scheduler.order(mentions, lambda m: m[0], now=0)
+    assert [m[1] for m in served] == [1, 4, 5, 2, 6, 3]
+    assert throttled == []
+
+
+def test_scheduler_throttles_over_quota():
+    scheduler = FairScheduler(quota=2, sketch=SlidingWindowSketch(window=60))
+    served, throttled = scheduler.order(
+        [("a", 1), ("a", 2), ("a", 3), ("b", 4)], lambda m: m[0], now=0
+    )
+    assert [m[1] for m in served] == [1, 4, 2]
+    assert [m[1] for m in throttled] == [3]
+    served, throttled = scheduler.order([("a", 5)], lambda m: m[0], now=30)
+    assert throttled == [("a", 5)]
+    served, throttled = scheduler.order([("a", 6)], lambda m: m[0], now=90)
+    assert served == [("a", 6)]
+
+
+def test_get_fair_scheduler_reads_quota(monkeypatch):
+    monkeypatch.setenv("EWBOT_USER_QUOTA", "3")
+    scheduler = get_fair_scheduler("twitter")
+    assert scheduler.quota == 3
+    assert get_fair_scheduler("twitter") is scheduler
+    assert get_fair_scheduler("mastodon") is not scheduler
+
+
+def test_counts_persist_across_runs(state_store):
+    def scheduler():
+        return FairScheduler(
+            quota=2,
+            sketch=SlidingWindowSketch(window=60),
+            store=state_store,
+            namespace="fairness:twitter:default",
+        )
+
+    served, _ = scheduler().order([("a", 1), ("a", 2)], lambda m: m[0], now=0)
+    assert len(served) == 2
+    served, throttled = scheduler().order([("a", 3), ("b", 4)], lambda m: m[0], now=30)
+    assert served == [("b", 4)]
+    assert throttled == [("a", 3)]
+    served, _ = scheduler().order([("a", 5)], lambda m: m[0], now=90)
+    assert served == [("a", 5)]
+    resized = FairScheduler(
+        quota=1,
+        sketch=SlidingWindowSketch(window=60, width=64),
+        store=state_store,
+        namespace="fairness:twitter:default",
+    )
+    served, _ = resized.order([("a", 6)], lambda m: m[0], now=90)
+    assert served == [("a", 6)]
+
+
+def test_get_fair_scheduler_keeps_counts_in_store(state_store, tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_USER_QUOTA", "1")
+    scheduler = get_fair_scheduler("twitter", store=state_store)
+    assert get_fair_scheduler("twitter", store=state_store) is scheduler
+    scheduler.order(["a"], str)
+    state_store.commit()
+    with StateStore(str(tmp_path / "state.sqlite3")) as reopened:
+        _, throttled = get_fair_scheduler("twitter", store=reopened).order(["a"], str)
+    assert throttled == ["a"]
+    with StateStore(str(tmp_path / "fresh.sqlite3")) as fresh:
+        served, _ = get_fair_scheduler("twitter", store=fresh).order(["a"], str)
+    assert served == ["a"]
+    served, _ = get_fair_scheduler("twitter", "other", state_store).order(["a"], str)
+    assert served == ["a"]
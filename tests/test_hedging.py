@@ -0,0 +1,118 @@
+import threading
+from typing import Callable, List, Tuple
+from unittest import mock
+
+import pytest
+
+from ewtwitterbot.hedging import HedgedRequests, LatencyTracker, get_hedger
+from ewtwitterbot.metrics import get_metrics
+
+
+@pytest.fixture
+def tracker():
+    tracker = LatencyTracker(min_samples=1)
+    tracker.record(0.01)
+    return tracker
+
+
+def slow_first(
+    release, fail_first=False, fail_second=False
+) -> Tuple[Callable[[float], mock.MagicMock], List[mock.MagicMock], List[float]]:
+    """
+    Build a request whose first call hangs until released, and whose later calls
+    answer straight away. Also returns its responses and the timeout each call was
+    sent with.
+    """
+    calls: List[float] = []
+    responses = [mock.MagicMock(name="first"), mock.MagicMock(name="second")]
+
+    def request(timeout):
+        call = len(calls)
+        calls.append(timeout)
+        if call == 0:
+            release.wait(5)
+            if fail_first:
+                raise ConnectionError
+        elif fail_second:
+            raise ConnectionError
+        return responses[call]
+
+    return request, responses, calls
+
+
+def test_latency_percentiles():
+    tracker = LatencyTracker(size=100, min_samples=10)
+    assert tracker.percentile(0.95) is None
+    for latency in range(1, 101):
+        tracker.record(latency / 100)
+    assert tracker.percentile(0.95) == 0.96
+    assert tracker.percentile(1) == 1
+
+
+def test_fast_requests_are_not_hedged(tracker):
+    hedger = HedgedRequests(max_hedge_rate=1, tracker=tracker)
+    response = mock.MagicMock()
+    assert hedger.send(lambda timeout: response, 10) is response
+    assert hedger.metrics == {"requests": 1, "hedges_issued": 0, "hedges_won": 0}
+
+
+def test_slow_request_is_hedged(tracker):
+    hedger = HedgedRequests(max_hedge_rate=1, tracker=tracker)
+    release = threading.Event()
+    request, responses, calls = slow_first(release)
+    assert hedger.send(request, 10) is responses[1]
+    release.set()
+    hedger.executor.shutdown(wait=True)
+    responses[0].close.assert_called_once()
+    responses[1].close.assert_not_called()
+    assert hedger.metrics == {"requests": 1, "hedges_issued": 1, "hedges_won": 1}
+    assert calls[0] == 10
+    assert 0 < calls[1] <= 10 - 0.01
+    exported = get_metrics().render()
+    assert "ewbot_hedges_issued_total 1" in exported
+    assert "ewbot_hedges_won_total 1" in exported
+
+
+def test_no_hedge_once_the_timeout_has_passed(tracker):
+    hedger = HedgedRequests(max_hedge_rate=1, tracker=tracker)
+    release = threading.Event()
+    request, responses, calls = slow_first(release)
+    threading.Timer(0.1, release.set).start()
+    assert hedger.send(request, 0.005) is responses[0]
+    assert calls == [0.005]
+    assert hedger.metrics == {"requests": 1, "hedges_issued": 0, "hedges_won": 0}
+
+
+def test_hedge_rate_is_capped(tracker):
+    hedger = HedgedRequests(max_hedge_rate=0.5, tracker=tracker)
+    release = threading.Event()
+    request, responses, calls = slow_first(release)
+    threading.Timer(0.1, release.set).start()
+    assert hedger.send(request, 10) is responses[0]
+    assert hedger.metrics == {"requests": 1, "hedges_issued": 0, "hedges_won": 0}
+
+
+def test_failed_hedge_falls_back_on_the_original(tracker):
+    hedger = HedgedRequests(max_hedge_rate=1, tracker=tracker)
+    release = threading.Event()
+    request, responses, calls = slow_first(release, fail_second=True)
+    threading.Timer(0.1, release.set).start()
+    assert hedger.send(request, 10) is responses[0]
+    assert hedger.metrics == {"requests": 1, "hedges_issued": 1, "hedges_won": 0}
+
+
+def test_both_failing_raises(tracker):
+    hedger = HedgedRequests(max_hedge_rate=1, tracker=tracker)
+    release = threading.Event()
+    request, _, _ = slow_first(release, fail_first=True, fail_second=True)
+    threading.Timer(0.1, release.set).start()
+    with pytest.raises(ConnectionError):
+        hedger.send(request, 10)
+
+
+def test_hedging_is_off_by_default(monkeypatch):
+    assert get_hedger() is None
+    monkeypatch.setenv("EWBOT_HEDGE_QUOTES", "0.1")
+    hedger = get_hedger()
+    assert hedger is not None and hedger.max_hedge_rate == 0.1
+    assert get_hedger() is hedger
@@ -6,7 +6,9 @@ from ewtwitterbot.imagery import (
     format_quote_for_image,
     format_sentence_for_image,
     get_quote_image,
+    temporary_image_file,
 )
+from ewtwitterbot.metrics import get_metrics
 
 # I don't know how to reliably test this function besides ensuring the file gets created. Pull requests to improve
 # the reliability of this test with regard to the quality of the text layout would be very welcome.
@@ -25,6 +27,9 @@ def test_generate_image(quote_text):
     get_quote_image(quote_text)
     assert os.path.exists("quote_image.png")
     os.remove("quote_image.png")
+    rendered = get_metrics().render()
+    assert 'ewbot_stage_total{outcome="ok",stage="render"} 1' in rendered
+    assert 'ewbot_stage_total{outcome="ok",stage="encode"} 1' in rendered
 
 
 @pytest.mark.parametrize(
@@ -136,3 +141,24 @@ def test_sentence_formatting(
         format_sentence_for_image(sentence_to_test, character, service_name)
         == expected_result
     )
+
+
+def test_identical_images_are_rendered_once(tmp_path):
+    first, second = str(tmp_path / "first.png"), str(tmp_path / "second.png")
+    get_quote_image("Only once", filename=first)
+    get_quote_image("Only once", filename=second)
+    with open(first, "rb") as f, open(second, "rb") as g:
+        assert f.read() == g.read()
+    assert 'ewbot_stage_total{outcome="ok",stage="render"} 1' in get_metrics().render()
+
+
+def test_temporary_image_file():
+    with temporary_image_file("quote_image_7_") as first, temporary_image_file(
+        "quote_image_7_"
+    ) as second:
+        assert first != second
+        assert os.path.basename(first).startswith("quote_image_7_")
+        assert first.endswith(".png")
+        get_quote_image("Hi", filename=first)
+        os.remove(second)
+    assert not os.path.exists(first)
@@ -0,0 +1,36 @@
+import pytest
+
+from ewtwitterbot.import_time import (
+    check_budget,
+    main,
+    measure_imports,
+    startup_modules,
+)
+
+
+def test_entry_points_defer_pillow():
+    timings = measure_imports("ewtwitterbot.twitter_bot")
+    assert "ewtwitterbot.twitter_bot" in timings
+    assert "tweepy" in timings
+    assert "PIL" not in timings
+
+
+def test_startup_modules_are_not_reported(capsys):
+    assert "site" in startup_modules()
+    assert check_budget(["ewtwitterbot.twitter_bot"], budget_ms=10000, repeat=1)
+    assert "    site:" not in capsys.readouterr().out
+
+
+def test_check_budget(capsys):
+    assert check_budget(["ewtwitterbot.deadline"], budget_ms=10000, repeat=1)
+    assert "ewtwitterbot.deadline:" in capsys.readouterr().out
+    assert not check_budget(["ewtwitterbot.deadline"], budget_ms=0, repeat=1)
+    assert "over budget" in capsys.readouterr().out
+    assert not check_budget(["PIL.Image"], budget_ms=10000, repeat=1)
+    assert "imports PIL at startup" in capsys.readouterr().out
+
+
+def test_main_exits_when_over_budget():
+    main(["ewtwitterbot.deadline", "--repeat", "1", "--budget-ms", "10000"])
+    with pytest.raises(SystemExit):
+        main(["ewtwitterbot.deadline", "--repeat", "1", "--budget-ms", "0"])
@@ -0,0 +1,40 @@
+from ewtwitterbot.ledger import ReplyLedger
+
+
+def test_ledger_loads_from_store(state_store):
+    for mention_id in (5, 1, 3):
+        state_store.mark_replied("twitter", mention_id)
+    ledger = ReplyLedger(state_store, "twitter")
+    assert list(ledger.ids) == [1, 3, 5]
+    assert 3 in ledger
+    assert 4 not in ledger
+    assert 6 not in ledger
+    assert 0 not in ledger
+    assert len(ReplyLedger(state_store, "mastodon")) == 0
+
+
+def test_ledger_add_persists(state_store):
+    ledger = ReplyLedger(state_store, "mastodon")
+    ledger.add(10)
+    ledger.add(10)
+    assert 10 in ledger
+    assert "10" in ledger
+    assert len(ledger) == 1
+    assert ReplyLedger(state_store, "mastodon").ids.tolist() == [10]
+
+
+def test_ledger_merges_recent_additions(state_store):
+    state_store.mark_replied("twitter", 2)
+    ledger = ReplyLedger(state_store, "twitter", merge_threshold=3)
+    for mention_id in (9, 1, 5):
+        ledger.add(mention_id)
+    assert ledger.recent == set()
+    assert list(ledger.ids) == [1, 2, 5, 9]
+    assert all(mention_id in ledger for mention_id in (1, 2, 5, 9))
+
+
+def test_ledger_handles_large_ids(state_store):
+    ledger = ReplyLedger(state_store, "twitter", merge_threshold=1)
+    ledger.add(1496153829371703301)
+    assert 1496153829371703301 in ledger
+    assert 1496153829371703300 not in ledger
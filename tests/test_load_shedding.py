@@ -0,0 +1,84 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from ewtwitterbot.load_shedding import (
+    LoadLevel,
+    LoadShedder,
+    get_load_shedder,
+    mention_age,
+    recent_reply,
+    remember_reply,
+)
+
+
+@pytest.mark.parametrize(
+    "depth,oldest_age,expected",
+    [
+        (5, 0, LoadLevel.NORMAL),
+        (20, 0, LoadLevel.REUSE),
+        (50, 0, LoadLevel.TEXT_ONLY),
+        (80, 0, LoadLevel.TEXT_ONLY),
+        (81, 0, LoadLevel.SHED),
+        (1, 100000, LoadLevel.NORMAL),
+    ],
+)
+def test_level_by_depth(depth, oldest_age, expected):
+    assert LoadShedder(20, 50, 80).level(depth, oldest_age) is expected
+
+
+def test_no_thresholds_never_degrade():
+    shedder = LoadShedder()
+    assert shedder.level(10000, 100000) is LoadLevel.NORMAL
+    assert shedder.shed(["a", "b"], lambda item: 100000) == (["a", "b"], [])
+
+
+@pytest.mark.parametrize(
+    "oldest_age,expected",
+    [
+        (100, LoadLevel.NORMAL),
+        (250, LoadLevel.REUSE),
+        (500, LoadLevel.TEXT_ONLY),
+        (1000, LoadLevel.SHED),
+    ],
+)
+def test_level_by_age(oldest_age, expected):
+    assert LoadShedder(max_age=1000).level(1, oldest_age) is expected
+
+
+def test_shed_drops_stale_then_oldest():
+    shedder = LoadShedder(shed_depth=2, max_age=100)
+    ages = {"a": 150, "b": 10, "c": 50, "d": 20, "e": 99}
+    kept, dropped = shedder.shed(["a", "b", "c", "d", "e"], ages.__getitem__)
+    assert kept == ["b", "d"]
+    assert dropped == ["a", "e", "c"]
+
+
+def test_get_load_shedder(monkeypatch):
+    shedder = get_load_shedder()
+    assert shedder.level(10000, 0) is LoadLevel.NORMAL
+    assert shedder.max_age is None
+    monkeypatch.setenv("EWBOT_LOAD_THRESHOLDS", "1,2,3")
+    monkeypatch.setenv("EWBOT_MAX_MENTION_AGE", "60")
+    shedder = get_load_shedder()
+    assert (shedder.reuse_depth, shedder.text_only_depth, shedder.shed_depth) == (
+        1,
+        2,
+        3,
+    )
+    assert shedder.max_age == 60
+
+
+def test_mention_age():
+    posted = datetime(2022, 1, 1, tzinfo=timezone.utc)
+    assert mention_age(posted, now=posted.timestamp() + 30) == 30
+    assert mention_age(posted, now=0) == 0
+    assert mention_age(None) == 0
+
+
+def test_recent_reply(state_store):
+    assert recent_reply(state_store, "twitter", "quote") is None
+    remember_reply(state_store, "twitter", "quote", "Hi", "https://ew.fm/3")
+    assert recent_reply(state_store, "twitter", "quote") == ("Hi", "https://ew.fm/3")
+    assert recent_reply(state_store, "twitter", "markov") is None
+    assert recent_reply(state_store, "mastodon", "quote") is None
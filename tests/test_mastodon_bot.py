@@ -1,43 +1,51 @@
+import asyncio
+import glob
+import json
 import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
 from unittest import mock
 
 import pytest
 import requests_mock
+from mastodon import Mastodon, MastodonAPIError, MastodonError, MastodonNetworkError
+from requests.exceptions import ReadTimeout
 
+from ewtwitterbot.deadline import Deadline, DeadlineExceeded
 from ewtwitterbot.imagery import get_quote_image
+from ewtwitterbot.ledger import get_ledger
+from ewtwitterbot.load_shedding import remember_reply
 from ewtwitterbot.mastodon_bot import (
     MastodonConfigurationError,
     MastodonMediaError,
+    NotificationDismisser,
+    dismiss_enabled,
+    enqueue_notifications,
+    fetch_toots,
     get_credentials_from_environ,
-    get_last_toot_id,
+    handle_notification,
+    handle_notifications_concurrently,
+    iter_notifications,
+    main,
+    reply_to_mention,
+    reply_to_mentions_async,
     respond_to_toots,
-    save_last_toot_id,
+    retry_failed_replies,
+    serve_toots,
+    stream_toots,
+    stream_toots_forever,
     upload_image_and_description,
+    wait_for_media,
+    work_on_notifications,
+    work_toots,
 )
-
-
-@pytest.fixture
-def save_a_toot_id():
-    with open("test_last_toot.txt", "w") as f:
-        f.write(str(14))
-
-
-def test_retrieve_last_toot_id_saved(save_a_toot_id):
-    assert get_last_toot_id("test_last_toot.txt") == 14
-
-
-def test_save_toot_id():
-    if os.path.exists("test_last_toot.txt"):
-        os.remove("test_last_toot.txt")
-    save_last_toot_id(40, "test_last_toot.txt")
-    assert os.path.exists("test_last_toot.txt")
-    assert get_last_toot_id("test_last_toot.txt") == 40
-
-
-def test_retrieve_nonexistent_tweet_id():
-    if os.path.exists("test_last_toot.txt"):
-        os.remove("test_last_toot.txt")
-    assert get_last_toot_id("test_last_toot.txt") == 1
+from ewtwitterbot.retry_queue import RetryQueue
+from ewtwitterbot.run_lock import acquire_run_lock
+from ewtwitterbot.work_queue import WorkQueue
 
 
 def test_mastodon_configuration_checks():
@@ -145,7 +153,7 @@ def test_media_upload_error(mastodon_environ_patch):
                 )
 
 
-def test_mastodon_mention_cycle(mastodon_environ_patch):
+def test_mastodon_mention_cycle(mastodon_environ_patch, tmp_path, state_store):
     with mock.patch.dict(os.environ, mastodon_environ_patch, clear=False):
         with requests_mock.Mocker() as m:
             m.post(
@@ -416,5 +424,756 @@ def test_mastodon_mention_cycle(mastodon_environ_patch):
                 "https://quoteservice.andrlik.org/api/sources/ew-nix/generate_sentence/",
                 json={"sentence": "fear the snek"},
             )
-            respond_to_toots("test_last_toot.txt")
-            assert get_last_toot_id("test_last_toot.txt") == 4772149
+            legacy_file = tmp_path / "test_last_toot.txt"
+            legacy_file.write_text("14")
+            respond_to_toots(str(legacy_file), store=state_store)
+            assert state_store.get_since_id("mastodon") == 4772149
+            assert state_store.has_replied("mastodon", 4772149)
+            assert not legacy_file.exists()
+
+
+@pytest.fixture
+def reply_payload():
+    return {
+        "in_reply_to_id": 1,
+        "acct": "someone",
+        "text_to_use": "Hi",
+        "link_to_quote": None,
+    }
+
+
+def test_reply_fails_when_upload_fails(reply_payload):
+    with mock.patch(
+        "ewtwitterbot.mastodon_bot.upload_image_and_description", return_value=None
+    ):
+        assert not reply_to_mention(mock.MagicMock(), **reply_payload)
+
+
+def test_reply_fails_when_upload_errors(reply_payload):
+    with mock.patch(
+        "ewtwitterbot.mastodon_bot.upload_image_and_description",
+        side_effect=MastodonMediaError,
+    ):
+        assert not reply_to_mention(mock.MagicMock(), **reply_payload)
+
+
+def test_retry_failed_replies(state_store, reply_payload):
+    queue = RetryQueue(state_store, "mastodon")
+    queue.push(1, reply_payload, now=0)
+    queue.push(2, reply_payload, now=0)
+    with mock.patch(
+        "ewtwitterbot.mastodon_bot.reply_to_mention", side_effect=[True, False]
+    ) as reply:
+        retry_failed_replies(mock.MagicMock(), queue)
+    assert reply.call_count == 2
+    assert 1 not in queue
+    assert state_store.retry_get("mastodon", 2)["attempts"] == 2
+
+
+def test_already_handled_mentions_are_skipped(state_store):
+    state_store.set_since_id("mastodon", 1)
+    state_store.mark_replied("mastodon", 42)
+    api = mock.MagicMock()
+    api.notifications.return_value = [
+        {
+            "id": 42,
+            "type": "mention",
+            "account": {"acct": "someone"},
+            "status": {"id": 420, "content": "@ewbot #quote"},
+        }
+    ]
+    api.fetch_previous.return_value = None
+    with mock.patch(
+        "ewtwitterbot.mastodon_bot.get_credentials_from_environ", return_value=api
+    ), mock.patch("ewtwitterbot.mastodon_bot.process_request") as process:
+        respond_to_toots(None, store=state_store)
+    process.assert_not_called()
+    api.status_post.assert_not_called()
+    assert state_store.get_since_id("mastodon") == 42
+
+
+@pytest.mark.parametrize(
+    "argv,expected_call",
+    [
+        ([], "respond_to_toots"),
+        (["serve"], "serve_toots"),
+        (["stream"], "stream_toots_forever"),
+        (["fetch"], "fetch_toots"),
+        (["work"], "work_toots"),
+    ],
+)
+def test_main_modes(argv, expected_call, tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    with mock.patch(
+        "ewtwitterbot.mastodon_bot.respond_to_toots"
+    ) as respond, mock.patch(
+        "ewtwitterbot.mastodon_bot.serve_toots"
+    ) as serve, mock.patch(
+        "ewtwitterbot.mastodon_bot.stream_toots_forever"
+    ) as stream, mock.patch(
+        "ewtwitterbot.mastodon_bot.fetch_toots"
+    ) as fetch, mock.patch(
+        "ewtwitterbot.mastodon_bot.work_toots"
+    ) as work:
+        main(argv)
+    called = {
+        "respond_to_toots": respond,
+        "serve_toots": serve,
+        "stream_toots_forever": stream,
+        "fetch_toots": fetch,
+        "work_toots": work,
+    }
+    assert called.pop(expected_call).called
+    assert not any(other.called for other in called.values())
+
+
+def test_main_closes_the_profiler(tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    with mock.patch("ewtwitterbot.mastodon_bot.work_toots") as work, mock.patch(
+        "ewtwitterbot.profiling.CycleProfiler.close"
+    ) as close:
+        main(["work", "--profile", "tracemalloc"])
+    assert work.call_args[1]["profiler"].modes == ["tracemalloc"]
+    close.assert_called_once()
+
+
+def test_main_skips_overlapping_runs(tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    lock = acquire_run_lock("mastodon")
+    assert lock is not None
+    with mock.patch("ewtwitterbot.mastodon_bot.respond_to_toots") as respond:
+        main([])
+    respond.assert_not_called()
+    lock.release()
+    with mock.patch("ewtwitterbot.mastodon_bot.respond_to_toots") as respond:
+        main([])
+    respond.assert_called_once()
+
+
+def test_workers_run_alongside_a_held_lock(tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    lock = acquire_run_lock("mastodon")
+    assert lock is not None
+    with mock.patch("ewtwitterbot.mastodon_bot.work_toots") as work, mock.patch(
+        "ewtwitterbot.mastodon_bot.fetch_toots"
+    ) as fetch:
+        main(["work"])
+        main(["fetch"])
+    work.assert_called_once()
+    fetch.assert_not_called()
+    lock.release()
+
+
+def test_serve_reuses_client_and_store(tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    api = mock.MagicMock()
+    with mock.patch(
+        "ewtwitterbot.mastodon_bot.get_credentials_from_environ", return_value=api
+    ) as credentials, mock.patch(
+        "ewtwitterbot.mastodon_bot.serve"
+    ) as serve, mock.patch(
+        "ewtwitterbot.mastodon_bot.respond_to_toots", return_value=3
+    ) as respond:
+        serve_toots()
+        cycle = serve.call_args[0][0]
+        assert cycle() == 3
+        assert cycle() == 3
+    assert credentials.call_count == 1
+    assert respond.call_args_list[0] == respond.call_args_list[1]
+    assert respond.call_args[1]["api"] is api
+    serve.call_args[1]["on_shutdown"]()
+
+
+def make_notification(notification_id, notification_type="mention"):
+    return {
+        "id": notification_id,
+        "type": notification_type,
+        "account": {"acct": "someone"},
+        "status": {
+            "id": notification_id * 10,
+            "content": "@ewbot #quote",
+            "account": {"acct": "someone"},
+        },
+    }
+
+
+def test_fresh_store_starts_from_newest_notification(state_store):
+    api = mock.MagicMock()
+    api.notifications.return_value = [make_notification(42)]
+    with mock.patch("ewtwitterbot.mastodon_bot.handle_notification") as handle:
+        assert respond_to_toots(None, store=state_store, api=api) == 0
+    handle.assert_not_called()
+    assert api.notifications.call_args == mock.call(mentions_only=True, limit=1)
+    assert state_store.get_since_id("mastodon") == 42
+
+
+def test_fresh_fetcher_starts_from_newest_notification(state_store):
+    api = mock.MagicMock()
+    api.notifications.return_value = []
+    assert enqueue_notifications(api, state_store) == 0
+    assert len(WorkQueue(state_store, "mastodon")) == 0
+    assert state_store.get_since_id("mastodon") == 1
+
+
+@pytest.fixture
+def paged_api():
+    api = mock.MagicMock()
+    api.notifications.return_value = [make_notification(i) for i in (5, 4, 3)]
+    api.fetch_previous.side_effect = [
+        [make_notification(i) for i in (8, 7, 6)],
+        [],
+    ]
+    return api
+
+
+def test_iter_notifications_pages_forward_oldest_first(paged_api):
+    assert [n["id"] for n in iter_notifications(paged_api, 2, page_size=3)] == [
+        3,
+        4,
+        5,
+        6,
+        7,
+        8,
+    ]
+    paged_api.notifications.assert_called_once_with(
+        mentions_only=True, min_id=2, limit=3
+    )
+    assert paged_api.fetch_previous.call_count == 2
+
+
+def test_iter_notifications_is_lazy_and_capped(paged_api):
+    assert [n["id"] for n in iter_notifications(paged_api, 2, limit=2)] == [3, 4]
+    paged_api.fetch_previous.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "value,expected", [("", False), ("0", False), ("1", True), ("True", True)]
+)
+def test_dismiss_enabled(monkeypatch, value, expected):
+    monkeypatch.setenv("MASTODON_DISMISS_NOTIFICATIONS", value)
+    assert dismiss_enabled() is expected
+
+
+def test_dismisser_batches_after_commit(state_store):
+    api = mock.MagicMock()
+    api.notifications_dismiss.side_effect = [None, MastodonError("gone"), None]
+    dismisser = NotificationDismisser(api, state_store, batch_size=2)
+    state_store.set_since_id("mastodon", 1)
+    dismisser.add(1)
+    api.notifications_dismiss.assert_not_called()
+    dismisser.add(2)
+    assert state_store.pending_writes == 0
+    assert api.notifications_dismiss.call_count == 2
+    dismisser.add(3)
+    dismisser.flush()
+    dismisser.flush()
+    assert api.notifications_dismiss.call_count == 3
+
+
+def test_handle_notification_ignores_other_types(state_store):
+    with mock.patch("ewtwitterbot.mastodon_bot.process_request") as process:
+        handle_notification(
+            mock.MagicMock(),
+            make_notification(9, "favourite"),
+            state_store,
+            mock.MagicMock(),
+            mock.MagicMock(),
+        )
+    process.assert_not_called()
+
+
+def test_respond_dismisses_handled_notifications(state_store, paged_api):
+    state_store.set_since_id("mastodon", 1)
+    with mock.patch(
+        "ewtwitterbot.mastodon_bot.process_request", return_value=(None, None)
+    ):
+        assert (
+            respond_to_toots(
+                None,
+                store=state_store,
+                api=paged_api,
+                max_mentions=4,
+                dismiss=True,
+            )
+            == 4
+        )
+    assert [call[0][0] for call in paged_api.notifications_dismiss.call_args_list] == [
+        3,
+        4,
+        5,
+        6,
+    ]
+    assert state_store.get_since_id("mastodon") == 6
+
+
+def test_fetcher_queues_mentions_for_workers(state_store, paged_api):
+    state_store.set_since_id("mastodon", 1)
+    paged_api.notifications.return_value = [
+        dict(make_notification(i), created_at=datetime.now(timezone.utc))
+        for i in (5, 4, 3)
+    ]
+    assert enqueue_notifications(paged_api, state_store, max_mentions=4) == 4
+    assert paged_api.notifications.call_args[1]["min_id"] == 1
+    paged_api.notifications_dismiss.assert_not_called()
+    work = WorkQueue(state_store, "mastodon")
+    assert len(work) == 4
+    assert work.cursor() == 6
+    with mock.patch(
+        "ewtwitterbot.mastodon_bot.process_request", return_value=(None, None)
+    ) as process:
+        assert work_on_notifications(paged_api, state_store, "a", batch_size=3) == 3
+        assert state_store.get_since_id("mastodon") == 5
+        assert work_on_notifications(paged_api, state_store, "a", batch_size=3) == 1
+        assert work_on_notifications(paged_api, state_store, "a") == 0
+    assert [call[0][0] for call in process.call_args_list] == ["@ewbot #quote"] * 4
+    assert state_store.get_since_id("mastodon") == 6
+    assert len(work) == 0
+    assert work.cursor() == 6
+    assert all(i in get_ledger(state_store, "mastodon") for i in range(3, 7))
+    paged_api.notifications.reset_mock()
+    paged_api.notifications.return_value = []
+    assert enqueue_notifications(paged_api, state_store, dismiss=True) == 0
+    assert paged_api.notifications.call_args[1]["min_id"] == 6
+
+
+def test_fetcher_dismisses_queued_notifications(state_store, paged_api):
+    state_store.set_since_id("mastodon", 1)
+    assert enqueue_notifications(paged_api, state_store, dismiss=True) == 6
+    assert [call[0][0] for call in paged_api.notifications_dismiss.call_args_list] == [
+        3,
+        4,
+        5,
+        6,
+        7,
+        8,
+    ]
+
+
+def test_worker_skips_mentions_another_worker_replied_to(state_store):
+    WorkQueue(state_store, "mastodon").enqueue([(5, make_notification(5))])
+    ledger = get_ledger(state_store, "mastodon")
+    state_store.mark_replied("mastodon", 5)
+    assert 5 not in ledger
+    with mock.patch("ewtwitterbot.mastodon_bot.handle_notification") as handle:
+        assert work_on_notifications(mock.MagicMock(), state_store, "a") == 1
+    handle.assert_not_called()
+    assert state_store.get_since_id("mastodon") == 5
+
+
+def test_fetch_and_work_toots(tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    api = mock.MagicMock()
+    with mock.patch(
+        "ewtwitterbot.mastodon_bot.get_credentials_from_environ", return_value=api
+    ), mock.patch(
+        "ewtwitterbot.mastodon_bot.enqueue_notifications"
+    ) as enqueue, mock.patch(
+        "ewtwitterbot.mastodon_bot.serve"
+    ) as serve, mock.patch(
+        "ewtwitterbot.mastodon_bot.work_on_notifications", return_value=2
+    ) as work:
+        fetch_toots()
+        work_toots(batch_size=3)
+        assert serve.call_args[0][0]() == 2
+    assert enqueue.call_args[0][0] is api
+    assert work.call_args[0][3] == 3
+    assert work.call_args[0][1].shared
+    serve.call_args[1]["on_shutdown"]()
+
+
+class FakeStreamingHandler(BaseHTTPRequestHandler):
+    """
+    Minimal stand-in for a Mastodon instance's REST and streaming endpoints. Each
+    connection to the user stream sends the next scripted list of events; a
+    script ending in None keeps the connection open with heartbeats.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        assert isinstance(server, FakeStreamingServer)
+        if self.path.startswith("/api/v1/instance"):
+            self.send_json({"version": "3.0.0", "uri": "localhost", "urls": {}})
+        elif self.path.startswith("/api/v1/notifications"):
+            server.backfills.append(self.path)
+            self.send_json([])
+        elif self.path.startswith("/api/v1/streaming/user"):
+            script = server.scripts.pop(0) if server.scripts else [None]
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            self.wfile.write(b":)\n")
+            for event in script:
+                if event is None:
+                    while not server.stop_event.is_set():
+                        self.wfile.write(b":thump\n")
+                        self.wfile.flush()
+                        time.sleep(0.02)
+                    self.wfile.write(b":thump\n")
+                    break
+                data = json.dumps(event)
+                self.wfile.write(f"event: notification\ndata: {data}\n\n".encode())
+                self.wfile.flush()
+        else:
+            self.send_error(404)
+
+
+class FakeStreamingServer(ThreadingHTTPServer):
+    """
+    Server for FakeStreamingHandler, holding the scripted streams still to send, the
+    notification backfill requests received and the event that ends heartbeats.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeStreamingHandler)
+        self.scripts: List[List[Optional[Dict[str, Any]]]] = []
+        self.backfills: List[str] = []
+        self.stop_event = threading.Event()
+
+
+@pytest.fixture
+def fake_streaming_server():
+    server = FakeStreamingServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.stop_event.set()
+    server.shutdown()
+    server.server_close()
+
+
+def test_stream_handles_pushed_mentions_and_backfills_on_reconnect(
+    fake_streaming_server, state_store
+):
+    fake_streaming_server.scripts = [
+        [make_notification(100)],
+        [make_notification(101), None],
+    ]
+    api = Mastodon(
+        access_token="token",
+        api_base_url=f"http://127.0.0.1:{fake_streaming_server.server_port}",
+        version_check_mode="none",
+    )
+    stop_event = fake_streaming_server.stop_event
+
+    def process(content, service_name, deadline=None):
+        if len(process_calls) == 1:
+            stop_event.set()
+        process_calls.append(content)
+        return None, None
+
+    process_calls: List[str] = []
+    with mock.patch("ewtwitterbot.mastodon_bot.process_request", side_effect=process):
+        stream_toots(api, state_store, stop_event, min_backoff=0.01, timeout=5)
+    assert len(process_calls) == 2
+    assert state_store.get_since_id("mastodon") == 101
+    assert len(fake_streaming_server.backfills) == 2
+    assert "min_id=100" in fake_streaming_server.backfills[1]
+
+
+def test_stream_backs_off_after_connection_errors(state_store):
+    api = mock.MagicMock()
+    stop_event = threading.Event()
+    waits = []
+    api.stream_user.side_effect = [MastodonError("down"), MastodonError("down"), None]
+
+    def fake_wait(timeout):
+        waits.append(timeout)
+        if len(waits) == 3:
+            stop_event.set()
+        return stop_event.is_set()
+
+    with mock.patch.object(stop_event, "wait", side_effect=fake_wait):
+        stream_toots(api, state_store, stop_event, min_backoff=1, max_backoff=3)
+    assert waits == [2, 3, 1]
+
+
+def test_stream_toots_forever(tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    api = mock.MagicMock()
+    with mock.patch(
+        "ewtwitterbot.mastodon_bot.get_credentials_from_environ", return_value=api
+    ), mock.patch(
+        "ewtwitterbot.mastodon_bot.install_signal_handlers"
+    ) as install, mock.patch(
+        "ewtwitterbot.mastodon_bot.stream_toots"
+    ) as stream:
+        stream_toots_forever()
+    assert stream.call_args[0][0] is api
+    assert stream.call_args[0][2] is install.call_args[0][0]
+
+
+def processing_media(media_id, polls_left):
+    polls = {"left": polls_left}
+
+    def media_update(requested_id):
+        assert requested_id == media_id
+        polls["left"] -= 1
+        url = None if polls["left"] > 0 else "https://files.botsin.space/q.png"
+        return {"id": media_id, "type": "image", "url": url}
+
+    return media_update
+
+
+def test_wait_for_media_polls_until_processed():
+    api = mock.MagicMock()
+    api.media_update.side_effect = processing_media(7, 2)
+    media = wait_for_media(
+        api, {"id": 7, "type": "image", "url": None}, poll_interval=0
+    )
+    assert media["url"] is not None
+    assert api.media_update.call_count == 2
+
+
+def test_wait_for_media_gives_up():
+    api = mock.MagicMock()
+    api.media_update.return_value = {"id": 7, "type": "image", "url": None}
+    with pytest.raises(MastodonMediaError):
+        wait_for_media(
+            api, {"id": 7, "type": "image", "url": None}, poll_interval=0, timeout=0
+        )
+
+
+def test_wait_for_media_gives_up_with_the_deadline():
+    api = mock.MagicMock()
+    api.media_update.return_value = {"id": 7, "type": "image", "url": None}
+    with pytest.raises((MastodonMediaError, DeadlineExceeded)):
+        wait_for_media(
+            api,
+            {"id": 7, "type": "image", "url": None},
+            poll_interval=0,
+            deadline=Deadline(0.05),
+        )
+    assert api.media_update.called
+
+
+@pytest.mark.parametrize(
+    "error,posted",
+    [
+        (MastodonAPIError("API error", 422, "Unprocessable Entity", "Taken"), True),
+        (MastodonAPIError("API error", 403, "Forbidden", "Nope"), False),
+        (MastodonNetworkError("Could not complete request: Read timed out."), False),
+    ],
+)
+@pytest.mark.parametrize("text_only", [True, False])
+def test_only_duplicates_count_as_replied(reply_payload, error, posted, text_only):
+    api = mock.MagicMock(ratelimit_remaining=None)
+    api.status_post.side_effect = error
+    with mock.patch(
+        "ewtwitterbot.mastodon_bot.upload_image_and_description", return_value=7
+    ):
+        assert reply_to_mention(api, text_only=text_only, **reply_payload) is posted
+    assert api.status_post.call_args[1]["idempotency_key"] == "ewbot-reply-1"
+
+
+def test_reply_gives_up_when_deadline_runs_out(reply_payload):
+    api = mock.MagicMock()
+    with mock.patch("ewtwitterbot.mastodon_bot.get_quote_image") as render:
+        assert not reply_to_mention(api, deadline=Deadline(0), **reply_payload)
+        assert asyncio.run(
+            reply_to_mentions_async(api, [reply_payload], deadlines=[Deadline(0)])
+        ) == [False]
+    render.assert_not_called()
+    api.status_post.assert_not_called()
+
+
+def test_reply_calls_time_out_with_the_deadline(processing_api, reply_payload):
+    payloads = [dict(reply_payload, in_reply_to_id=i) for i in (10, 20)]
+    assert asyncio.run(
+        reply_to_mentions_async(
+            processing_api,
+            payloads,
+            poll_interval=0,
+            deadlines=[Deadline(30), Deadline(30)],
+        )
+    ) == [True, True]
+    assert processing_api.status_post.call_count == 2
+    with mock.patch("ewtwitterbot.mastodon_bot.call_api") as call:
+        assert reply_to_mention(
+            processing_api, text_only=True, deadline=Deadline(30), **reply_payload
+        )
+    bounded = call.call_args[0][0]
+    assert bounded is not processing_api
+    assert 0 < bounded.request_timeout <= 30
+
+
+def test_quote_fetch_timeout_is_queued_and_retried(state_store):
+    ledger = get_ledger(state_store, "mastodon")
+    queue = RetryQueue(state_store, "mastodon")
+    with mock.patch(
+        "ewtwitterbot.mastodon_bot.process_request", side_effect=ReadTimeout
+    ), mock.patch("ewtwitterbot.mastodon_bot.reply_to_mention") as reply:
+        handle_notification(
+            mock.MagicMock(), make_notification(1), state_store, ledger, queue
+        )
+        handle_notifications_concurrently(
+            mock.MagicMock(),
+            [make_notification(2), make_notification(3)],
+            state_store,
+            ledger,
+            queue,
+        )
+    reply.assert_not_called()
+    due = queue.due(now=time.time() + 3600)
+    assert [item["payload"]["request"] for item in due] == ["@ewbot #quote"] * 3
+    with mock.patch(
+        "ewtwitterbot.mastodon_bot.process_request",
+        side_effect=[("Hi", "https://ew.fm/1"), (None, None), ReadTimeout],
+    ), mock.patch(
+        "ewtwitterbot.mastodon_bot.reply_to_mention", return_value=True
+    ) as reply, mock.patch.object(
+        queue, "due", return_value=due
+    ):
+        retry_failed_replies(mock.MagicMock(), queue)
+    assert reply.call_args[1]["text_to_use"] == "Hi"
+    assert "request" not in reply.call_args[1]
+    assert 1 not in queue and 2 not in queue
+    assert state_store.retry_get("mastodon", 3)["attempts"] == 2
+
+
+@pytest.fixture
+def processing_api():
+    def media_post(media_file, description):
+        # Images are rendered to mastodon_quote_image_<status id>_<random>.png
+        media_id = int(os.path.basename(media_file).split("_")[3])
+        return {
+            "id": media_id,
+            "type": "video" if media_id == 30 else "image",
+            "url": None if media_id == 10 else "https://files.botsin.space/q.png",
+        }
+
+    api = mock.MagicMock()
+    api.media_post.side_effect = media_post
+    api.media_update.side_effect = processing_media(10, 3)
+    return api
+
+
+def test_reply_to_mentions_async_posts_as_media_is_ready(processing_api, reply_payload):
+    payloads = [dict(reply_payload, in_reply_to_id=i) for i in (10, 20, 30)]
+    results = asyncio.run(
+        reply_to_mentions_async(
+            processing_api, payloads, concurrency=2, poll_interval=0.01
+        )
+    )
+    assert results == [True, True, False]
+    assert [
+        call[1]["in_reply_to_id"] for call in processing_api.status_post.call_args_list
+    ] == [20, 10]
+    assert processing_api.media_update.call_count == 3
+    assert not glob.glob(
+        os.path.join(tempfile.gettempdir(), "mastodon_quote_image_[123]0_*.png")
+    )
+
+
+def test_reply_to_mentions_async_gives_up_on_processing(processing_api, reply_payload):
+    results = asyncio.run(
+        reply_to_mentions_async(
+            processing_api,
+            [dict(reply_payload, in_reply_to_id=10)],
+            poll_interval=0,
+            timeout=0,
+        )
+    )
+    assert results == [False]
+    processing_api.status_post.assert_not_called()
+
+
+def test_handle_notifications_concurrently(state_store):
+    ledger = mock.MagicMock()
+    ledger.__contains__.side_effect = lambda mention_id: mention_id == 3
+    queue = RetryQueue(state_store, "mastodon")
+    mentions = [make_notification(i) for i in (1, 2, 3)]
+    mentions.append(make_notification(4, "favourite"))
+    with mock.patch(
+        "ewtwitterbot.mastodon_bot.process_request", return_value=("Hi", None)
+    ), mock.patch(
+        "ewtwitterbot.mastodon_bot.reply_to_mentions_async",
+        new=mock.AsyncMock(return_value=[True, False]),
+    ) as reply:
+        handle_notifications_concurrently(
+            mock.MagicMock(), mentions, state_store, ledger, queue, concurrency=2
+        )
+    assert [payload["in_reply_to_id"] for payload in reply.call_args[0][1]] == [10, 20]
+    assert reply.call_args[1]["concurrency"] == 2
+    assert [item["mention_id"] for item in queue.due(now=time.time() + 3600)] == [2]
+    assert [call[0][0] for call in ledger.add.call_args_list] == [1, 2, 3]
+    assert state_store.get_since_id("mastodon") == 3
+
+
+def test_respond_concurrently_dismisses_batch(state_store, paged_api):
+    state_store.set_since_id("mastodon", 1)
+    with mock.patch(
+        "ewtwitterbot.mastodon_bot.handle_notifications_concurrently"
+    ) as handle_batch:
+        assert (
+            respond_to_toots(
+                None,
+                store=state_store,
+                api=paged_api,
+                dismiss=True,
+                concurrency=3,
+            )
+            == 6
+        )
+    assert [n["id"] for n in handle_batch.call_args[0][1]] == [3, 4, 5, 6, 7]
+    assert 8 in get_ledger(state_store, "mastodon")
+    assert state_store.get_since_id("mastodon") == 8
+    assert paged_api.notifications_dismiss.call_count == 6
+
+
+def test_text_only_replies(reply_payload):
+    api = mock.MagicMock()
+    with mock.patch("ewtwitterbot.mastodon_bot.get_quote_image") as render:
+        assert reply_to_mention(api, text_only=True, **reply_payload)
+        assert asyncio.run(
+            reply_to_mentions_async(
+                api, [dict(reply_payload, in_reply_to_id=2)], text_only=True
+            )
+        ) == [True]
+    render.assert_not_called()
+    api.media_post.assert_not_called()
+    assert [call[1]["in_reply_to_id"] for call in api.status_post.call_args_list] == [
+        1,
+        2,
+    ]
+    assert api.status_post.call_args[1]["status"] == "@someone Hi"
+
+
+def test_respond_sheds_load(state_store, monkeypatch):
+    state_store.set_since_id("mastodon", 1)
+    monkeypatch.setenv("EWBOT_LOAD_THRESHOLDS", "1,2,3")
+    monkeypatch.setenv("EWBOT_MAX_MENTION_AGE", "45")
+    remember_reply(state_store, "mastodon", "quote", "Hi", "https://ew.fm/3")
+    now = time.time()
+    notifications = [make_notification(i) for i in (1, 2, 3, 4, 5)]
+    for notification in notifications:
+        notification["account"]["acct"] = f"user{notification['id']}"
+        notification["created_at"] = datetime.fromtimestamp(
+            now - 10 * (6 - notification["id"]), timezone.utc
+        )
+    api = mock.MagicMock()
+    api.notifications.return_value = notifications
+    api.fetch_previous.return_value = None
+    with mock.patch("ewtwitterbot.mastodon_bot.process_request") as process:
+        assert respond_to_toots(None, store=state_store, api=api) == 5
+    process.assert_not_called()
+    assert [call[1]["in_reply_to_id"] for call in api.status_post.call_args_list] == [
+        30,
+        40,
+        50,
+    ]
+    api.media_post.assert_not_called()
+    assert all(i in get_ledger(state_store, "mastodon") for i in range(1, 6))
+    assert state_store.get_since_id("mastodon") == 5
@@ -0,0 +1,28 @@
+from ewtwitterbot.media_cache import MediaCache, content_hash
+
+
+def test_content_hash(tmp_path):
+    first = tmp_path / "first.png"
+    second = tmp_path / "second.png"
+    first.write_bytes(b"image")
+    second.write_bytes(b"image")
+    assert content_hash(str(first)) == content_hash(str(second))
+    second.write_bytes(b"other image")
+    assert content_hash(str(first)) != content_hash(str(second))
+
+
+def test_media_ids_expire_with_platform_lifetime(state_store):
+    cache = MediaCache(state_store, "twitter")
+    cache.put("abc", "123", now=0)
+    assert cache.get("abc", now=60) == "123"
+    assert cache.get("abc", now=23 * 60 * 60) is None
+    assert MediaCache(state_store, "twitter", "other").get("abc", now=60) is None
+    cache.invalidate("abc")
+    assert cache.get("abc", now=60) is None
+
+
+def test_mastodon_media_is_never_reused(state_store):
+    cache = MediaCache(state_store, "mastodon")
+    cache.put("abc", "123", now=0)
+    assert cache.get("abc", now=1) is None
+    assert MediaCache(state_store, "mastodon", lifetime=60).get("abc", now=1) is None
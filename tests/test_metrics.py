@@ -0,0 +1,90 @@
+import pytest
+import requests
+
+from ewtwitterbot.metrics import (
+    Histogram,
+    Metrics,
+    exported_metrics,
+    get_metrics,
+    start_metrics_server,
+    write_metrics,
+)
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram(buckets=(0.1, 1))
+    for seconds in (0.05, 0.1, 0.5, 3):
+        histogram.observe(seconds)
+    assert histogram.cumulative() == [("0.1", 2), ("1", 3), ("+Inf", 4)]
+    assert histogram.count == 4
+    assert histogram.sum == pytest.approx(3.65)
+
+
+def test_stages_are_timed_and_counted_by_outcome():
+    metrics = Metrics(buckets=(1,))
+    with metrics.time("render"):
+        pass
+    with pytest.raises(RuntimeError):
+        with metrics.time("post", platform="twitter"):
+            raise RuntimeError("down")
+    metrics.inc("ewbot_mentions_total", 3, platform='tw"it\\ter')
+    assert metrics.render().splitlines() == [
+        "# HELP ewbot_stage_seconds Time taken by each reply stage.",
+        "# TYPE ewbot_stage_seconds histogram",
+        'ewbot_stage_seconds_bucket{platform="twitter",stage="post",le="1"} 1',
+        'ewbot_stage_seconds_bucket{platform="twitter",stage="post",le="+Inf"} 1',
+        metrics.render().splitlines()[4],
+        'ewbot_stage_seconds_count{platform="twitter",stage="post"} 1',
+        'ewbot_stage_seconds_bucket{stage="render",le="1"} 1',
+        'ewbot_stage_seconds_bucket{stage="render",le="+Inf"} 1',
+        metrics.render().splitlines()[8],
+        'ewbot_stage_seconds_count{stage="render"} 1',
+        "# TYPE ewbot_mentions_total counter",
+        'ewbot_mentions_total{platform="tw\\"it\\\\ter"} 3',
+        "# TYPE ewbot_stage_total counter",
+        'ewbot_stage_total{outcome="error",platform="twitter",stage="post"} 1',
+        'ewbot_stage_total{outcome="ok",stage="render"} 1',
+    ]
+    assert (
+        metrics.render()
+        .splitlines()[4]
+        .startswith('ewbot_stage_seconds_sum{platform="twitter",stage="post"} ')
+    )
+
+
+def test_empty_metrics_render():
+    assert Metrics().render() == "\n"
+
+
+def test_metrics_server():
+    get_metrics().inc("ewbot_mentions_total", platform="mastodon")
+    server = start_metrics_server(0)
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        response = requests.get(f"{url}/metrics", timeout=5)
+        assert response.headers["Content-Type"].startswith("text/plain")
+        assert 'ewbot_mentions_total{platform="mastodon"} 1' in response.text
+        assert requests.get(f"{url}/", timeout=5).status_code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_write_metrics(tmp_path):
+    filename = tmp_path / "ewbot.prom"
+    get_metrics().inc("ewbot_mentions_total", platform="twitter")
+    write_metrics(str(filename))
+    assert 'ewbot_mentions_total{platform="twitter"} 1' in filename.read_text()
+    assert [path.name for path in tmp_path.iterdir()] == ["ewbot.prom"]
+
+
+def test_exported_metrics(tmp_path, monkeypatch):
+    filename = tmp_path / "ewbot.prom"
+    monkeypatch.setenv("EWBOT_METRICS_FILE", str(filename))
+    monkeypatch.setenv("EWBOT_METRICS_PORT", "0")
+    with exported_metrics(daemon=True):
+        get_metrics().inc("ewbot_mentions_total")
+    assert not filename.exists()
+    with exported_metrics(daemon=False):
+        get_metrics().inc("ewbot_mentions_total")
+    assert "ewbot_mentions_total 2" in filename.read_text()
@@ -0,0 +1,129 @@
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+import pytest
+from loguru import logger
+
+from ewtwitterbot.profiling import (
+    CycleProfiler,
+    WallClockSampler,
+    collapse_stack,
+    get_profiler,
+    profiled,
+)
+
+
+@pytest.fixture
+def messages():
+    collected = []
+    handler_id = logger.add(lambda message: collected.append(message.record["message"]))
+    yield collected
+    logger.remove(handler_id)
+
+
+def slow_cycle():
+    time.sleep(0.05)
+    return 42
+
+
+def test_profiling_is_off_by_default(monkeypatch):
+    monkeypatch.delenv("EWBOT_PROFILE", raising=False)
+    assert get_profiler() is None
+    assert profiled(slow_cycle, None) is slow_cycle
+
+
+def test_get_profiler_from_environ(monkeypatch, tmp_path):
+    monkeypatch.setenv("EWBOT_PROFILE", "cprofile, sample")
+    monkeypatch.setenv("EWBOT_PROFILE_DIR", str(tmp_path))
+    monkeypatch.setenv("EWBOT_PROFILE_TOP", "5")
+    profiler = get_profiler(name="mastodon")
+    assert profiler is not None
+    assert profiler.modes == ["cprofile", "sample"]
+    assert profiler.directory == str(tmp_path)
+    assert profiler.top == 5
+    profiler = get_profiler(["tracemalloc"])
+    assert profiler is not None and profiler.modes == ["tracemalloc"]
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        CycleProfiler(["cprofile", "perf"])
+
+
+def test_cprofile_dumps_each_cycle(tmp_path, messages):
+    profiler = CycleProfiler(["cprofile"], name="twitter", directory=str(tmp_path))
+    cycle = profiled(slow_cycle, profiler)
+    assert cycle() == 42
+    assert cycle() == 42
+    dumps = sorted(tmp_path.glob("ewbot-twitter-*.prof"))
+    assert [dump.name.rsplit("-", 1)[-1] for dump in dumps] == ["1.prof", "2.prof"]
+    stats = pstats.Stats(str(dumps[0]))
+    assert "slow_cycle" in stats.get_stats_profile().func_profiles
+    assert "slow_cycle" in messages[0]
+
+
+def test_tracemalloc_reports_changes_between_cycles(tmp_path, messages):
+    profiler = CycleProfiler(["tracemalloc"], directory=str(tmp_path), top=3)
+    kept = []
+    cycle = profiled(lambda: kept.append(bytearray(1_000_000)), profiler)
+    try:
+        cycle()
+        assert tracemalloc.is_tracing()
+        assert messages[-1].startswith("Top allocations:")
+        assert "Changes since the last cycle" not in messages[-1]
+        cycle()
+        assert "Changes since the last cycle:" in messages[-1]
+        assert "test_profiling.py" in messages[-1]
+    finally:
+        profiler.close()
+    assert not tracemalloc.is_tracing()
+    profiler.close()
+
+
+def test_sampling_sees_waiting_threads(tmp_path, messages):
+    profiler = CycleProfiler(
+        ["sample"], name="twitter", directory=str(tmp_path), interval=0.001
+    )
+    profiled(slow_cycle, profiler)()
+    (collapsed,) = tmp_path.glob("ewbot-twitter-*-1.collapsed")
+    stacks = collapsed.read_text().splitlines()
+    assert any(
+        line.startswith("MainThread;") and "test_profiling.py:slow_cycle" in line
+        for line in stacks
+    )
+    assert "test_profiling.py:slow_cycle" in messages[-1]
+
+
+def test_sampler_names_threads_and_counts_leaves():
+    started = threading.Event()
+    stop = threading.Event()
+
+    def waiting():
+        started.set()
+        stop.wait()
+
+    thread = threading.Thread(target=waiting, name="waiter")
+    thread.start()
+    started.wait()
+    sampler = WallClockSampler(interval=0.001)
+    sampler.start()
+    time.sleep(0.02)
+    sampler.stop()
+    stop.set()
+    thread.join()
+    assert sampler.samples > 0
+    assert any(stack.startswith("waiter;") for stack in sampler.stacks)
+    assert not any(stack.startswith("sampler;") for stack in sampler.stacks)
+    frame, count = sampler.top(1)[0]
+    assert count <= sampler.samples * (threading.active_count() + 1)
+    assert ";" not in frame
+
+
+def test_collapse_stack_is_root_first():
+    stack = collapse_stack(sys._getframe(), "t")
+    names = stack.split(";")
+    assert names[0] == "t"
+    assert names[-1] == "test_profiling.py:test_collapse_stack_is_root_first"
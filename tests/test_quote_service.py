@@ -4,6 +4,7 @@ from unittest import mock
 import pytest
 import requests_mock
 
+from ewtwitterbot.hedging import get_hedger
 from ewtwitterbot.quote_service import (
     QuoteServiceImproperlyConfigured,
     fetch_and_select_random_character,
@@ -237,3 +238,28 @@ def test_error_character_to_use():
             json={"error": "No characters found!"},
         )
         assert fetch_and_select_random_character() is None
+
+
+def test_requests_time_out():
+    with requests_mock.Mocker() as m:
+        m.get(
+            "https://quoteservice.andrlik.org/api/groups/ew/generate_sentence/",
+            json={"sentence": "Hi"},
+        )
+        assert generate_sentence() == "Hi"
+        assert m.last_request.timeout == 10
+        assert generate_sentence(timeout=2.5) == "Hi"
+        assert m.last_request.timeout == 2.5
+
+
+def test_requests_are_hedged_when_enabled(monkeypatch):
+    monkeypatch.setenv("EWBOT_HEDGE_QUOTES", "0.05")
+    with requests_mock.Mocker() as m:
+        m.get(
+            "https://quoteservice.andrlik.org/api/groups/ew/generate_sentence/",
+            json={"sentence": "Hi"},
+        )
+        assert generate_sentence() == "Hi"
+        assert m.last_request.timeout == 10
+    hedger = get_hedger()
+    assert hedger is not None and hedger.metrics["requests"] == 1
@@ -0,0 +1,137 @@
+import copy
+import time
+from unittest import mock
+
+import pytest
+
+from ewtwitterbot import mastodon_bot, twitter_bot
+from ewtwitterbot.deadline import Deadline, DeadlineExceeded, with_timeout
+from ewtwitterbot.rate_limit import (
+    RateLimiter,
+    TokenBucket,
+    account_of,
+    get_rate_limiter,
+    set_account,
+)
+
+
+def test_bucket_allows_a_burst_then_paces():
+    bucket = TokenBucket(limit=20, window=10, now=0)
+    assert [bucket.reserve(now=0) for _ in range(2)] == [0, 0]
+    assert bucket.reserve(now=0) == pytest.approx(0.5)
+    assert bucket.reserve(now=0) == pytest.approx(1.0)
+    assert bucket.reserve(now=10) == 0
+
+
+def test_seed_spreads_remaining_budget_until_reset():
+    bucket = TokenBucket(limit=300, window=300, now=0)
+    bucket.seed(remaining=10, reset_in=100, limit=300, now=0)
+    assert bucket.rate == pytest.approx(0.1)
+    for _ in range(10):
+        bucket.reserve(now=0)
+    assert bucket.reserve(now=0) == pytest.approx(10)
+    bucket.reserve(now=100)
+    assert bucket.rate == pytest.approx(1)
+
+
+def test_seed_with_exhausted_budget_waits_for_reset():
+    bucket = TokenBucket(limit=75, window=900, now=0)
+    bucket.seed(remaining=0, reset_in=60, now=0)
+    assert bucket.reserve(now=0) == pytest.approx(60)
+
+
+def test_limiter_keeps_a_bucket_per_endpoint_and_account():
+    limiter = RateLimiter()
+    assert limiter.bucket("twitter", "update_status") is limiter.bucket(
+        "twitter", "update_status"
+    )
+    assert limiter.bucket("twitter", "update_status") is not limiter.bucket(
+        "twitter", "update_status", "other"
+    )
+    assert limiter.bucket("twitter", "unknown").limit == 15
+    assert limiter.bucket("mastodon", "unknown").limit == 300
+    assert get_rate_limiter() is get_rate_limiter()
+
+
+def test_limiter_waits_when_budget_is_spent():
+    limiter = RateLimiter()
+    limiter.update("twitter", "update_status", 0, time.time() + 30)
+    with mock.patch("ewtwitterbot.rate_limit.time.sleep") as sleep:
+        assert limiter.wait("twitter", "update_status") > 0
+    sleep.assert_called_once()
+
+
+def test_limiter_gives_up_rather_than_wait_past_the_deadline():
+    limiter = RateLimiter()
+    limiter.update("twitter", "update_status", 0, time.time() + 30)
+    tokens = limiter.bucket("twitter", "update_status").tokens
+    with mock.patch("ewtwitterbot.rate_limit.time.sleep") as sleep:
+        with pytest.raises(DeadlineExceeded):
+            limiter.wait("twitter", "update_status", deadline=Deadline(5))
+        assert limiter.wait("twitter", "update_status", deadline=Deadline(60)) > 0
+    sleep.assert_called_once()
+    assert limiter.bucket("twitter", "update_status").tokens == pytest.approx(
+        tokens - 1, abs=0.01
+    )
+
+
+@pytest.mark.parametrize(
+    "headers",
+    [None, {}, {"x-rate-limit-remaining": "many", "x-rate-limit-reset": "1"}],
+)
+def test_unreadable_rate_limits_are_ignored(headers):
+    limiter = RateLimiter()
+    limiter.update_from_headers("twitter", "update_status", headers)
+    limiter.update("mastodon", "all", mock.MagicMock(), mock.MagicMock())
+    assert limiter.bucket("twitter", "update_status").reset_at is None
+    assert limiter.bucket("mastodon", "all").reset_at is None
+
+
+def test_twitter_calls_seed_from_headers():
+    api = mock.MagicMock()
+    api.last_response.headers = {
+        "x-rate-limit-limit": "300",
+        "x-rate-limit-remaining": "3",
+        "x-rate-limit-reset": str(int(time.time()) + 300),
+    }
+    twitter_bot.call_api(api, "update_status", status="Hi")
+    api.update_status.assert_called_once_with(status="Hi")
+    bucket = get_rate_limiter().bucket("twitter", "update_status")
+    assert bucket.tokens <= 3
+    assert bucket.rate == pytest.approx(0.01, rel=0.05)
+
+
+def test_mastodon_calls_seed_from_client():
+    api = mock.MagicMock(
+        ratelimit_limit=300, ratelimit_remaining=0, ratelimit_reset=time.time() + 60
+    )
+    mastodon_bot.call_api(api, "media_post", media_file="q.png")
+    api.media_post.assert_called_once_with(media_file="q.png")
+    limiter = get_rate_limiter()
+    assert limiter.bucket("mastodon", "media_post").tokens == 2
+    assert limiter.bucket("mastodon", "all").tokens == 0
+
+
+def test_calls_are_paced_per_account():
+    api = mock.MagicMock(
+        ratelimit_limit=300, ratelimit_remaining=0, ratelimit_reset=time.time() + 60
+    )
+    set_account(api, "other")
+    assert account_of(copy.copy(api)) == "other"
+    assert account_of(mock.MagicMock()) == "default"
+    mastodon_bot.call_api(api, "status_post", "Hi")
+    limiter = get_rate_limiter()
+    assert limiter.bucket("mastodon", "all", "other").tokens == 0
+    assert limiter.bucket("mastodon", "all").tokens > 0
+
+
+@pytest.mark.parametrize(
+    "bot,platform,endpoint",
+    [(twitter_bot, "twitter", "update_status"), (mastodon_bot, "mastodon", "all")],
+)
+def test_bounded_calls_give_up_at_the_deadline(bot, platform, endpoint):
+    get_rate_limiter().update(platform, endpoint, 0, time.time() + 60)
+    api = mock.MagicMock(ratelimit_remaining=None)
+    with pytest.raises(DeadlineExceeded):
+        bot.call_api(with_timeout(api, "timeout", Deadline(5), "post"), "update_status")
+    api.update_status.assert_not_called()
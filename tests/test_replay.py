@@ -0,0 +1,303 @@
+import json
+import time
+from datetime import datetime, timezone
+from unittest import mock
+
+import pytest
+import requests
+import tweepy
+
+from ewtwitterbot import quote_service
+from ewtwitterbot.replay import (
+    QUOTE_SERVICE,
+    FakeServices,
+    ReplayReport,
+    ReplayStalled,
+    latest_mentions,
+    latest_notifications,
+    load_fixture,
+    main,
+    percentile,
+    record_fixture,
+    replay,
+)
+
+QUOTE = {
+    "quote": "Peaceful journeys.",
+    "source": {"name": "Nix"},
+    "citation": "Explorers Wanted",
+    "citation_url": "https://www.explorerswanted.fm/3",
+}
+
+
+def tweet(mention_id, screen_name, text):
+    return {
+        "id": mention_id,
+        "id_str": str(mention_id),
+        "created_at": "Wed Oct 19 12:00:00 +0000 2022",
+        "full_text": text,
+        "user": {"id": mention_id, "screen_name": screen_name},
+    }
+
+
+def notification(notification_id, acct, content):
+    return {
+        "id": notification_id,
+        "type": "mention",
+        "created_at": "2022-10-19 12:00:00+00:00",
+        "account": {"id": notification_id, "acct": acct},
+        "status": {
+            "id": notification_id * 10,
+            "content": content,
+            "created_at": "2022-10-19 12:00:00+00:00",
+            "account": {"id": notification_id, "acct": acct},
+        },
+    }
+
+
+@pytest.fixture
+def entries():
+    return [
+        {
+            "kind": "mention",
+            "platform": "twitter",
+            "at": 0.0,
+            "payload": tweet(101, "anna", "@ewbot quote please"),
+        },
+        {
+            "kind": "mention",
+            "platform": "twitter",
+            "at": 1.0,
+            "payload": tweet(102, "bea", "@ewbot hello"),
+        },
+        {
+            "kind": "mention",
+            "platform": "twitter",
+            "at": 2.0,
+            "payload": tweet(103, "cy", "@ewbot another quote"),
+        },
+        {
+            "kind": "mention",
+            "platform": "mastodon",
+            "at": 0.0,
+            "payload": notification(5, "anna", "<p>@ewbot quote</p>"),
+        },
+        {
+            "kind": "mention",
+            "platform": "mastodon",
+            "at": 2.0,
+            "payload": notification(6, "bea", "<p>@ewbot quote again</p>"),
+        },
+        {
+            "kind": "quote",
+            "path": "/api/groups/ew/get_random_quote/",
+            "status": 200,
+            "latency": 0.1,
+            "body": QUOTE,
+        },
+    ]
+
+
+@pytest.fixture
+def qs_token(monkeypatch):
+    monkeypatch.setenv("QS_TOKEN", "replay")
+
+
+def test_percentile():
+    values = [float(value) for value in range(1, 101)]
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile([3.0], 99) == 3.0
+    assert percentile([], 50) == 0.0
+
+
+def test_report_summary():
+    report = ReplayReport("twitter", 4, [0.5, 1.0, 2.0], 2.0, 3)
+    assert report.throughput == 2.0
+    summary = report.summary()
+    assert "4 mentions, 3 replies in 2.00s over 3 cycles (2.00 mentions/sec)" in summary
+    assert "p50 1.000s, p95 2.000s, p99 2.000s" in summary
+    assert ReplayReport("twitter", 0, [], 0.0, 1).throughput == 0.0
+
+
+@pytest.mark.parametrize("platform,replies", [("twitter", 2), ("mastodon", 2)])
+def test_replay_replies_to_every_request(entries, qs_token, platform, replies):
+    report = replay(entries, platform, speedup=20, concurrency=2, interval=1)
+    assert report.mentions == len(
+        [entry for entry in entries if entry.get("platform") == platform]
+    )
+    assert len(report.latencies) == replies
+    assert all(latency >= 0 for latency in report.latencies)
+    assert report.cycles >= 2
+    assert QUOTE_SERVICE not in quote_service.get_session().adapters
+
+
+def test_replay_one_at_a_time(entries, qs_token):
+    report = replay(entries, "twitter", speedup=100, interval=1)
+    assert len(report.latencies) == 2
+
+
+@pytest.mark.parametrize("platform", ["twitter", "mastodon"])
+def test_replay_drains_a_burst_larger_than_a_cycle(qs_token, platform):
+    make = tweet if platform == "twitter" else notification
+    burst = [
+        {
+            "kind": "mention",
+            "platform": platform,
+            "at": 0.0,
+            "payload": make(i, f"user{i}", "@ewbot hello"),
+        }
+        for i in range(2, 252)
+    ]
+    report = replay(burst, platform, speedup=1000, interval=1)
+    assert report.mentions == 250
+    assert report.cycles >= 3
+
+
+def test_replay_fails_when_mentions_stop_arriving(entries, qs_token):
+    with mock.patch("ewtwitterbot.replay.respond"), pytest.raises(
+        ReplayStalled, match="No progress past mention 1 in 3 cycles, 0 of 3"
+    ):
+        replay(entries, "twitter", speedup=1000, interval=1, max_idle_cycles=3)
+
+
+def test_mentions_arrive_on_schedule(entries):
+    services = FakeServices(entries, "twitter", speedup=1)
+    assert services.arrived() == []
+    started = time.time() - 1.5
+    services.started = started
+    arrived = services.arrived()
+    assert [target for target, _, _ in arrived] == ["101", "102"]
+    assert arrived[0][2]["created_at"] != entries[0]["payload"]["created_at"]
+    services.deliver(arrived)
+    assert not services.done()
+    services.started = started - 1
+    services.deliver(services.arrived())
+    assert services.done()
+
+
+def test_fake_twitter_pages_newest_first(entries):
+    services = FakeServices(entries, "twitter", speedup=1000)
+    services.started = time.time() - 10
+    session = requests.Session()
+    session.mount("https://", services)
+    url = "https://api.twitter.com/1.1/statuses/mentions_timeline.json"
+    response = session.get(url, params={"since_id": 100, "count": 1})
+    assert [mention["id"] for mention in response.json()] == [103]
+    assert response.headers["x-rate-limit-remaining"] == "1000000"
+    response = session.get(url, params={"since_id": 101, "max_id": 102})
+    assert [mention["id"] for mention in response.json()] == [102]
+    assert session.get("https://api.twitter.com/1.1/nothing.json").status_code == 404
+
+
+def test_fake_mastodon(entries):
+    services = FakeServices(entries, "mastodon", speedup=1000)
+    services.started = time.time() - 10
+    session = requests.Session()
+    session.mount("https://", services)
+    base = "https://mastodon.replay.invalid/api"
+    response = session.get(f"{base}/v1/notifications", params={"min_id": 1, "limit": 1})
+    assert [n["id"] for n in response.json()] == [5]
+    assert "min_id=5" in response.headers["Link"]
+    assert session.get(f"{base}/v1/notifications", params={"min_id": 6}).json() == []
+    media = session.put(f"{base}/v1/media/7").json()
+    assert media["id"] == "7"
+    assert session.post(f"{base}/v1/notifications/5/dismiss").json() == {}
+    session.post(f"{base}/v1/statuses", data={"in_reply_to_id": 50, "status": "hi"})
+    session.post(f"{base}/v1/statuses", data={"in_reply_to_id": 50, "status": "hi"})
+    session.post(f"{base}/v1/statuses", data={"in_reply_to_id": 99, "status": "hi"})
+    assert len(services.latencies) == 1
+    assert session.get(f"{base}/v1/accounts").status_code == 404
+
+
+def test_fake_quote_service_falls_back_to_the_same_endpoint(entries):
+    entries.append(
+        {
+            "kind": "quote",
+            "path": "/api/sources/ew-nix/generate_sentence/",
+            "status": 200,
+            "latency": 0.0,
+            "body": {"sentence": "Hello."},
+        }
+    )
+    services = FakeServices(entries, "twitter", speedup=1000)
+    session = requests.Session()
+    session.mount("https://", services)
+    url = f"{QUOTE_SERVICE}api/sources/ew-tom/generate_sentence/"
+    assert session.get(url).json() == {"sentence": "Hello."}
+    assert session.get(f"{QUOTE_SERVICE}api/sources/").status_code == 404
+
+
+def status_of(mention_id):
+    return tweepy.models.Status.parse(
+        mock.MagicMock(parser=tweepy.parsers.ModelParser()),
+        tweet(mention_id, "anna", "@ewbot quote"),
+    )
+
+
+def toot_of(notification_id, seconds):
+    return dict(
+        notification(notification_id, "bea", "<p>@ewbot hi</p>"),
+        created_at=datetime(2022, 10, 19, 12, 0, seconds, tzinfo=timezone.utc),
+    )
+
+
+def test_latest_mentions_pages_back_from_the_newest():
+    api = mock.MagicMock(last_response=None)
+    api.mentions_timeline.side_effect = [[status_of(5), status_of(4)], [status_of(3)]]
+    assert [mention.id for mention in latest_mentions(api, 3)] == [3, 4, 5]
+    first, second = api.mentions_timeline.call_args_list
+    assert first[1]["max_id"] is None and first[1]["count"] == 3
+    assert second[1]["max_id"] == 3 and second[1]["count"] == 1
+    api.mentions_timeline.side_effect = [[status_of(5)], []]
+    assert [mention.id for mention in latest_mentions(api, 3)] == [5]
+
+
+def test_latest_notifications_pages_back_from_the_newest():
+    api = mock.MagicMock(ratelimit_remaining=None)
+    api.notifications.return_value = [toot_of(9, 0), toot_of(8, 0)]
+    api.fetch_next.side_effect = [[toot_of(7, 0), toot_of(6, 0)]]
+    assert [n["id"] for n in latest_notifications(api, 3)] == [7, 8, 9]
+    assert api.notifications.call_args[1]["limit"] == 3
+    api.fetch_next.side_effect = [None]
+    assert [n["id"] for n in latest_notifications(api, 3)] == [8, 9]
+
+
+def test_record_and_load_fixture(tmp_path, qs_token, requests_mock):
+    requests_mock.get(
+        "https://quoteservice.andrlik.org/api/groups/ew/get_random_quote/",
+        json=QUOTE,
+    )
+    filename = str(tmp_path / "fixture.jsonl")
+    with mock.patch(
+        "ewtwitterbot.replay.latest_mentions", return_value=[status_of(2)]
+    ), mock.patch(
+        "ewtwitterbot.replay.latest_notifications", return_value=[toot_of(7, 30)]
+    ):
+        assert record_fixture(filename, {"twitter": None, "mastodon": None}) == 2
+    entries = load_fixture(filename)
+    assert [entry["kind"] for entry in entries] == ["mention", "mention", "quote"]
+    assert entries[0]["payload"]["id"] == 2
+    assert [entry["at"] for entry in entries[:2]] == [0, 30]
+    assert entries[2]["path"] == "/api/groups/ew/get_random_quote/"
+    assert entries[2]["body"] == QUOTE
+    assert not quote_service.get_session().hooks["response"]
+
+
+def test_main(tmp_path, entries, qs_token, capsys):
+    filename = str(tmp_path / "fixture.jsonl")
+    with open(filename, "w") as f:
+        f.writelines(json.dumps(entry) + "\n" for entry in entries)
+    main(["run", filename, "--speedup", "50", "--interval", "1"])
+    assert "twitter: 3 mentions, 2 replies" in capsys.readouterr().out
+    with mock.patch(
+        "ewtwitterbot.replay.record_fixture", return_value=4
+    ) as record, mock.patch(
+        "ewtwitterbot.twitter_bot.get_credentials_from_environ"
+    ), mock.patch(
+        "ewtwitterbot.mastodon_bot.get_credentials_from_environ"
+    ):
+        main(["record", filename])
+    assert set(record.call_args[0][1]) == {"twitter", "mastodon"}
+    assert "Recorded 4 mentions" in capsys.readouterr().out
@@ -0,0 +1,48 @@
+import pytest
+
+from ewtwitterbot.retry_queue import RetryQueue
+
+
+@pytest.mark.parametrize(
+    "attempts,expected_delay",
+    [(1, 60), (2, 120), (3, 240), (10, 3600)],
+)
+def test_backoff_is_exponential_and_capped(state_store, attempts, expected_delay):
+    assert RetryQueue(state_store, "twitter").backoff(attempts) == expected_delay
+
+
+def test_push_persists_and_schedules(state_store):
+    queue = RetryQueue(state_store, "twitter")
+    queue.push(12, {"text_to_use": "Hi"}, now=1000)
+    assert 12 in queue
+    assert queue.due(now=1000) == []
+    assert len(RetryQueue(state_store, "mastodon")) == 0
+    reloaded = RetryQueue(state_store, "twitter")
+    assert len(reloaded) == 1
+    assert reloaded.due(now=1060)[0]["payload"] == {"text_to_use": "Hi"}
+
+
+def test_due_orders_by_schedule(state_store):
+    queue = RetryQueue(state_store, "twitter")
+    queue.push(2, {}, now=1010)
+    queue.push(1, {}, now=1000)
+    assert [item["mention_id"] for item in queue.due(now=2000)] == [1, 2]
+
+
+def test_record_failure_reschedules_then_drops(state_store):
+    queue = RetryQueue(state_store, "twitter", max_attempts=3)
+    queue.push(5, {}, now=0)
+    assert queue.record_failure(5, now=100)
+    assert queue.due(now=219) == []
+    assert len(queue.due(now=220)) == 1
+    assert not queue.record_failure(5, now=300)
+    assert 5 not in queue
+    assert not queue.record_failure(5, now=400)
+
+
+def test_remove(state_store):
+    queue = RetryQueue(state_store, "twitter")
+    queue.push(7, {}, now=0)
+    queue.remove(7)
+    queue.remove(7)
+    assert len(queue) == 0
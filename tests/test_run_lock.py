@@ -0,0 +1,70 @@
+import os
+import threading
+from unittest import mock
+
+import pytest
+
+from ewtwitterbot import run_lock
+from ewtwitterbot.run_lock import RunLock, acquire_run_lock, get_lock_filename
+
+
+@pytest.fixture
+def lock_file(tmp_path):
+    return str(tmp_path / "ewbot_test.lock")
+
+
+def test_second_run_is_locked_out(lock_file):
+    assert RunLock(lock_file).holder() is None
+    first = RunLock(lock_file)
+    assert first.acquire()
+    holder = first.holder()
+    assert holder is not None and holder["pid"] == os.getpid()
+    second = RunLock(lock_file)
+    assert not second.acquire()
+    first.release()
+    first.release()
+    assert first.holder() is None
+    assert second.acquire()
+    second.release()
+
+
+def test_waits_for_the_lock(lock_file):
+    first = RunLock(lock_file)
+    assert first.acquire()
+    threading.Timer(0.1, first.release).start()
+    second = RunLock(lock_file, wait=5, poll_interval=0.05)
+    assert second.acquire()
+    second.release()
+
+
+def test_reports_a_stuck_holder(lock_file):
+    first = RunLock(lock_file)
+    assert first.acquire()
+    second = RunLock(lock_file, stale_after=-1)
+    with mock.patch("ewtwitterbot.run_lock.logger") as logger:
+        assert not second.acquire()
+    logger.error.assert_called_once()
+    first.release()
+
+
+def test_lease_fallback(lock_file, monkeypatch):
+    monkeypatch.setattr(run_lock, "fcntl", None)
+    first = RunLock(lock_file)
+    assert first.acquire()
+    assert not RunLock(lock_file).acquire()
+    stale = RunLock(lock_file, stale_after=-1)
+    assert stale.acquire()
+    stale.release()
+    assert not os.path.exists(lock_file)
+
+
+def test_acquire_run_lock(tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    assert get_lock_filename("twitter") == str(tmp_path / "ewbot_twitter.lock")
+    lock = acquire_run_lock("twitter")
+    assert lock is not None
+    assert acquire_run_lock("twitter") is None
+    other = acquire_run_lock("mastodon")
+    assert other is not None
+    lock.release()
+    other.release()
@@ -0,0 +1,198 @@
+import asyncio
+import json
+import os
+import signal
+import threading
+import time
+from unittest import mock
+
+from ewtwitterbot.daemon import AdaptiveInterval
+from ewtwitterbot.run_lock import acquire_run_lock
+from ewtwitterbot.runner import build_cycles, main, run_all, run_once, run_platform
+
+
+def test_platforms_run_concurrently():
+    barrier = threading.Barrier(2, timeout=2)
+
+    def cycle():
+        barrier.wait()
+        return 1
+
+    result = asyncio.run(run_once({"twitter": cycle, "mastodon": cycle}))
+    assert result == {"twitter": 1, "mastodon": 1}
+
+
+def test_failing_platform_is_isolated():
+    def broken():
+        raise RuntimeError("rate limited")
+
+    result = asyncio.run(run_once({"twitter": broken, "mastodon": lambda: 2}))
+    assert result == {"twitter": None, "mastodon": 2}
+
+
+def test_slow_platform_does_not_block_the_other():
+    calls = {"twitter": 0, "mastodon": 0}
+
+    def slow():
+        calls["twitter"] += 1
+        time.sleep(0.3)
+        return 0
+
+    def fast():
+        calls["mastodon"] += 1
+        return 1
+
+    async def scenario():
+        stop_event = asyncio.Event()
+        task = asyncio.create_task(
+            run_all(
+                {"twitter": slow, "mastodon": fast},
+                stop_event,
+                minimum=0.01,
+                maximum=0.01,
+            )
+        )
+        await asyncio.sleep(0.2)
+        stop_event.set()
+        await task
+
+    asyncio.run(scenario())
+    assert calls["twitter"] == 1
+    assert calls["mastodon"] > 3
+
+
+def test_failures_back_off_exponentially():
+    waits = []
+
+    async def scenario():
+        stop_event = asyncio.Event()
+        attempts = []
+
+        def broken():
+            attempts.append(1)
+            if len(attempts) == 3:
+                stop_event.set()
+            raise RuntimeError("down")
+
+        async def fake_wait_for(awaitable, timeout):
+            waits.append(timeout)
+            awaitable.close()
+            raise asyncio.TimeoutError
+
+        with mock.patch("ewtwitterbot.runner.asyncio.wait_for", fake_wait_for):
+            await run_platform(
+                "twitter",
+                broken,
+                AdaptiveInterval(minimum=1, maximum=3),
+                stop_event,
+            )
+
+    asyncio.run(scenario())
+    assert waits == [2, 3, 3]
+
+
+def test_build_cycles_skips_unconfigured_platforms(state_store):
+    with mock.patch.dict(os.environ, {}, clear=True):
+        assert build_cycles(state_store) == {}
+
+
+def test_build_cycles_share_the_store(state_store):
+    with mock.patch(
+        "ewtwitterbot.runner.twitter_bot.get_credentials_from_environ"
+    ) as twitter_credentials, mock.patch(
+        "ewtwitterbot.runner.mastodon_bot.get_credentials_from_environ"
+    ), mock.patch(
+        "ewtwitterbot.runner.twitter_bot.respond_to_tweets", return_value=4
+    ) as respond_to_tweets, mock.patch(
+        "ewtwitterbot.runner.mastodon_bot.respond_to_toots", return_value=5
+    ) as respond_to_toots:
+        cycles = build_cycles(state_store)
+        assert cycles["twitter"]() == 4
+        assert cycles["mastodon"]() == 5
+    assert respond_to_tweets.call_args[1] == {
+        "store": state_store,
+        "api": twitter_credentials.return_value,
+    }
+    assert respond_to_toots.call_args[1]["store"] is state_store
+
+
+def test_build_cycles_for_configured_accounts(state_store, tmp_path, monkeypatch):
+    filename = tmp_path / "accounts.json"
+    filename.write_text(
+        json.dumps(
+            {
+                "accounts": [
+                    {
+                        "platform": "mastodon",
+                        "name": name,
+                        "api_base_url": f"https://{name}.example",
+                        "access_token": "token",
+                    }
+                    for name in ("first", "second")
+                ]
+            }
+        )
+    )
+    monkeypatch.setenv("EWBOT_ACCOUNTS", str(filename))
+    with mock.patch.dict(os.environ, {}, clear=True):
+        assert build_cycles(state_store) == {}
+    with mock.patch("ewtwitterbot.mastodon_bot.Mastodon") as client, mock.patch(
+        "ewtwitterbot.mastodon_bot.respond_to_toots", side_effect=[1, 2]
+    ) as respond:
+        cycles = build_cycles(state_store)
+        assert list(cycles) == ["mastodon-first", "mastodon-second"]
+        assert asyncio.run(run_once(cycles)) == {
+            "mastodon-first": 1,
+            "mastodon-second": 2,
+        }
+    sessions = {call[1]["session"] for call in client.call_args_list}
+    assert len(sessions) == 1
+    assert {call[1]["account"] for call in respond.call_args_list} == {
+        "first",
+        "second",
+    }
+
+
+def test_main_once(tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    with mock.patch(
+        "ewtwitterbot.runner.build_cycles", return_value={"twitter": lambda: 1}
+    ):
+        main(["once", "--workers", "1"])
+
+
+def test_main_skips_platforms_already_running(tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    lock = acquire_run_lock("twitter")
+    assert lock is not None
+    twitter, mastodon = mock.Mock(return_value=0), mock.Mock(return_value=0)
+    with mock.patch(
+        "ewtwitterbot.runner.build_cycles",
+        return_value={"twitter": twitter, "mastodon": mastodon},
+    ):
+        main(["once"])
+    twitter.assert_not_called()
+    mastodon.assert_called_once()
+    lock.release()
+
+
+def test_main_without_platforms(tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    with mock.patch("ewtwitterbot.runner.build_cycles", return_value={}):
+        main(["serve"])
+
+
+def test_main_serve_stops_on_sigterm(tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    calls = []
+
+    def cycle():
+        calls.append(1)
+        os.kill(os.getpid(), signal.SIGTERM)
+        return 0
+
+    with mock.patch(
+        "ewtwitterbot.runner.build_cycles", return_value={"twitter": cycle}
+    ):
+        main(["serve", "--min-interval", "0.01"])
+    assert calls == [1]
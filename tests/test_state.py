@@ -0,0 +1,114 @@
+import sqlite3
+
+from ewtwitterbot.state import StateStore, get_state_filename
+
+
+def test_default_state_filename(monkeypatch):
+    monkeypatch.delenv("EWBOT_STATE_DB", raising=False)
+    assert get_state_filename() == "ewbot_state.sqlite3"
+    monkeypatch.setenv("EWBOT_STATE_DB", "/tmp/elsewhere.sqlite3")
+    assert get_state_filename() == "/tmp/elsewhere.sqlite3"
+
+
+def test_store_uses_wal(state_store):
+    mode = state_store.connection.execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == "wal"
+
+
+def test_since_ids_are_per_platform_and_account(state_store):
+    assert state_store.get_since_id("twitter") is None
+    state_store.set_since_id("twitter", 10)
+    state_store.set_since_id("twitter", 12)
+    state_store.set_since_id("mastodon", 20, account="botsin.space")
+    assert state_store.get_since_id("twitter") == 12
+    assert state_store.get_since_id("mastodon") is None
+    assert state_store.get_since_id("mastodon", account="botsin.space") == 20
+
+
+def test_since_id_never_moves_backwards(state_store):
+    state_store.set_since_id("mastodon", 12)
+    state_store.set_since_id("mastodon", 11)
+    assert state_store.get_since_id("mastodon") == 12
+
+
+def test_replied_ids(state_store):
+    for mention_id in (30, 10, 20, 10):
+        state_store.mark_replied("twitter", mention_id)
+    assert state_store.has_replied("twitter", 20)
+    assert not state_store.has_replied("mastodon", 20)
+    assert list(state_store.replied_ids("twitter")) == [10, 20, 30]
+
+
+def test_writes_are_batched(tmp_path):
+    filename = str(tmp_path / "state.sqlite3")
+    store = StateStore(filename, commit_every=3, commit_interval=60)
+    store.set_since_id("twitter", 1)
+    assert not store.maybe_commit()
+    other = sqlite3.connect(filename)
+    assert other.execute("SELECT count(*) FROM since_ids").fetchone()[0] == 0
+    store.mark_replied("twitter", 1)
+    store.mark_replied("twitter", 2)
+    assert store.maybe_commit()
+    assert not store.maybe_commit()
+    assert other.execute("SELECT count(*) FROM since_ids").fetchone()[0] == 1
+    store.close()
+    other.close()
+
+
+def test_shared_store_commits_each_write(tmp_path):
+    filename = str(tmp_path / "state.sqlite3")
+    store = StateStore(filename, shared=True)
+    other = StateStore(filename)
+    other.connection.execute("PRAGMA busy_timeout = 0")
+    store.mark_replied("twitter", 1)
+    assert store.pending_writes == 0
+    assert other.has_replied("twitter", 1)
+    assert other.work_claim("twitter", "b", 1, lease_expires=10, now=0) == []
+    store.close()
+    other.close()
+
+
+def test_writes_are_committed_after_interval(tmp_path):
+    store = StateStore(str(tmp_path / "state.sqlite3"), commit_interval=0)
+    store.set_since_id("twitter", 1)
+    assert store.maybe_commit()
+    store.close()
+
+
+def test_state_survives_reopening(tmp_path):
+    filename = str(tmp_path / "state.sqlite3")
+    with StateStore(filename) as store:
+        store.set_since_id("twitter", 99)
+    with StateStore(filename) as store:
+        assert store.get_since_id("twitter") == 99
+
+
+def test_cache_expiry(state_store):
+    state_store.cache_set("media:twitter:default", "abc", "123", expires_at=100)
+    assert state_store.cache_get("media:twitter:default", "abc", now=50) == "123"
+    assert state_store.cache_get("media:twitter:default", "abc", now=100) is None
+    state_store.cache_purge(now=100)
+    assert state_store.cache_get("media:twitter:default", "abc", now=0) is None
+    state_store.cache_set("media:twitter:default", "abc", "123", expires_at=100)
+    state_store.cache_delete("media:twitter:default", "abc")
+    assert state_store.cache_get("media:twitter:default", "abc", now=0) is None
+
+
+def test_migrate_since_id_file(state_store, tmp_path):
+    legacy_file = tmp_path / "last_tweet.txt"
+    legacy_file.write_text("1234\n")
+    state_store.migrate_since_id_file("twitter", str(legacy_file))
+    assert state_store.get_since_id("twitter") == 1234
+    assert not legacy_file.exists()
+    assert (tmp_path / "last_tweet.txt.migrated").exists()
+    state_store.migrate_since_id_file("twitter", str(legacy_file))
+    state_store.migrate_since_id_file("twitter", None)
+
+
+def test_migrate_does_not_overwrite_newer_state(state_store, tmp_path):
+    legacy_file = tmp_path / "last_toot.txt"
+    legacy_file.write_text("5")
+    state_store.set_since_id("mastodon", 50)
+    state_store.migrate_since_id_file("mastodon", str(legacy_file))
+    assert state_store.get_since_id("mastodon") == 50
+    assert not legacy_file.exists()
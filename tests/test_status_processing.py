@@ -1,7 +1,11 @@
 import pytest
 import requests_mock
 
-from ewtwitterbot.status_processing import process_request
+from ewtwitterbot.status_processing import (
+    format_text_reply,
+    process_request,
+    request_kind,
+)
 
 
 @pytest.mark.parametrize(
@@ -83,3 +87,27 @@ def test_process_tweet(
         )
         assert result == expected_result
         assert link_url == expected_link_url
+
+
+@pytest.mark.parametrize(
+    "mention,expected",
+    [
+        ("@somebot #Quote", "quote"),
+        ("@somebot markov me", "markov"),
+        ("@somebot markov quote", "quote"),
+        ("@somebot hi", None),
+    ],
+)
+def test_request_kind(mention, expected):
+    assert request_kind(mention) == expected
+
+
+def test_format_text_reply():
+    assert (
+        format_text_reply("@someone", "\u201cHi\u201d\n\n \u2014Bob", None, 280)
+        == "@someone \u201cHi\u201d \u2014Bob"
+    )
+    reply = format_text_reply("@someone", "word " * 100, "https://ew.fm/3", 280)
+    assert reply.startswith("@someone word word")
+    assert reply.endswith("\u2026 https://ew.fm/3")
+    assert len(reply) - len("https://ew.fm/3") + 23 <= 280
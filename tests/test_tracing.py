@@ -0,0 +1,127 @@
+import asyncio
+import json
+import sys
+
+import pytest
+from loguru import logger
+
+from ewtwitterbot import mastodon_bot
+from ewtwitterbot.ledger import get_ledger
+from ewtwitterbot.metrics import get_metrics
+from ewtwitterbot.tracing import configure_logging, span, trace_mention, write_json
+
+
+@pytest.fixture
+def records():
+    captured = []
+    handler_id = logger.add(lambda message: captured.append(message.record))
+    yield captured
+    logger.remove(handler_id)
+
+
+@pytest.fixture
+def restore_logging():
+    yield
+    logger.remove()
+    logger.add(sys.stderr)
+
+
+def test_spans_are_children_of_the_mention_trace(records):
+    with trace_mention("mastodon", 42, "ewbot") as trace_id:
+        with span("render"):
+            pass
+        with pytest.raises(RuntimeError):
+            with span("post", platform="mastodon"):
+                raise RuntimeError("down")
+        asyncio.run(asyncio.to_thread(logger.info, "In a worker thread"))
+    logger.info("Outside the trace")
+    assert trace_id == "mastodon:ewbot:42"
+    assert [record["extra"].get("trace_id") for record in records] == [
+        trace_id,
+        trace_id,
+        trace_id,
+        None,
+    ]
+    render, post = records[0]["extra"], records[1]["extra"]
+    assert render["span"] == "render" and render["outcome"] == "ok"
+    assert records[0]["level"].name == "DEBUG"
+    assert records[1]["level"].name == "INFO"
+    assert post["span"] == "post" and post["outcome"] == "error"
+    assert post["platform"] == "mastodon"
+    assert isinstance(post["duration_ms"], float)
+    assert records[1]["message"].startswith("post error in ")
+    rendered = get_metrics().render()
+    assert 'ewbot_stage_total{outcome="ok",stage="render"} 1' in rendered
+    assert 'ewbot_stage_total{outcome="error",platform="mastodon",stage="post"} 1' in (
+        rendered
+    )
+
+
+class CountingMention(dict):
+    formatted = 0
+
+    def __format__(self, spec):
+        CountingMention.formatted += 1
+        return super().__format__(spec)
+
+
+def test_mention_logging_is_lazy(restore_logging, state_store):
+    mention = CountingMention(
+        id=1, type="mention", status={"id": 10, "content": "Hi"}, account={}
+    )
+    state_store.mark_replied("mastodon", 1)
+    ledger = get_ledger(state_store, "mastodon")
+    logger.remove()
+    handler_id = logger.add(lambda message: None, level="INFO")
+    mastodon_bot.prepare_reply(mention, ledger)
+    assert CountingMention.formatted == 0
+    logger.remove(handler_id)
+    logger.add(lambda message: None, level="DEBUG")
+    mastodon_bot.prepare_reply(mention, ledger)
+    assert CountingMention.formatted == 1
+
+
+def test_write_json(capsys):
+    handler_id = logger.add(write_json, format="{exception}")
+    with trace_mention("twitter", 7):
+        logger.info("Replying to {}", 7)
+        try:
+            raise ValueError("bad")
+        except ValueError:
+            logger.exception("Failed")
+    logger.remove(handler_id)
+    lines = [json.loads(line) for line in capsys.readouterr().err.splitlines()]
+    entries = [line for line in lines if line.get("trace_id") == "twitter:default:7"]
+    assert entries[0]["message"] == "Replying to 7"
+    assert entries[0]["level"] == "INFO"
+    assert "exception" not in entries[0]
+    assert "ValueError: bad" in entries[1]["exception"]
+
+
+@pytest.mark.parametrize(
+    "log_format,expected_json", [("json", True), ("text", False), ("", True)]
+)
+def test_configure_logging(
+    capsys, monkeypatch, restore_logging, log_format, expected_json
+):
+    monkeypatch.setenv("EWBOT_LOG_FORMAT", log_format)
+    monkeypatch.setenv("EWBOT_LOG_LEVEL", "INFO")
+    configure_logging()
+    logger.debug("Hidden")
+    logger.info("Shown")
+    logger.complete()
+    logger.remove()
+    err = capsys.readouterr().err
+    assert "Hidden" not in err
+    if expected_json:
+        assert json.loads(err.splitlines()[-1])["message"] == "Shown"
+    else:
+        assert err.rstrip().endswith("Shown")
+
+
+def test_configure_logging_overrides(capsys, restore_logging):
+    configure_logging("DEBUG", json_logs=False)
+    logger.debug("Shown")
+    logger.complete()
+    logger.remove()
+    assert "Shown" in capsys.readouterr().err
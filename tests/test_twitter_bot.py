@@ -1,42 +1,50 @@
+import asyncio
+import json
 import os
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
 from unittest import mock
 
 import pytest
 import requests_mock
+import tweepy
+from requests.exceptions import ReadTimeout
 
+from ewtwitterbot.deadline import Deadline
 from ewtwitterbot.imagery import get_quote_image
+from ewtwitterbot.ledger import get_ledger
+from ewtwitterbot.load_shedding import LoadLevel, recent_reply, remember_reply
+from ewtwitterbot.media_cache import MediaCache, content_hash
+from ewtwitterbot.rate_limit import get_rate_limiter
+from ewtwitterbot.retry_queue import RetryQueue
+from ewtwitterbot.run_lock import acquire_run_lock
 from ewtwitterbot.twitter_bot import (
+    MentionStream,
+    ReplayMentionStream,
     TwitterImproperlyConfigured,
+    enqueue_mentions,
+    fetch_tweets,
     get_credentials_from_environ,
-    get_last_tweet_id,
+    get_full_text,
+    handle_mention,
+    handle_mentions_concurrently,
+    iter_mentions,
+    main,
+    prepare_reply,
+    reply_to_mention,
+    reply_to_mentions_async,
     respond_to_tweets,
-    save_last_tweet_id,
+    retry_failed_replies,
+    serve_tweets,
+    stream_tweets,
+    stream_tweets_forever,
     upload_image_and_set_metadata,
+    work_on_mentions,
+    work_tweets,
 )
-
-
-@pytest.fixture
-def save_a_tweet_id():
-    with open("test_last_tweet.txt", "w") as f:
-        f.write(str(14))
-
-
-def test_retrieve_last_id_saved(save_a_tweet_id):
-    assert get_last_tweet_id("test_last_tweet.txt") == 14
-
-
-def test_save_tweet_id():
-    if os.path.exists("test_last_tweet.txt"):
-        os.remove("test_last_tweet.txt")
-    save_last_tweet_id("test_last_tweet.txt", 40)
-    assert os.path.exists("test_last_tweet.txt")
-    assert get_last_tweet_id("test_last_tweet.txt") == 40
-
-
-def test_retrieve_nonexistent_tweet_id():
-    if os.path.exists("test_last_tweet.txt"):
-        os.remove("test_last_tweet.txt")
-    assert get_last_tweet_id("test_last_tweet.txt") == 1
+from ewtwitterbot.work_queue import WorkQueue
 
 
 def test_configuration_checks():
@@ -90,9 +98,10 @@ def test_media_upload_success(twitter_environ_patch):
                 )
                 == 710511363345354753
             )
+    assert ("twitter", "default", "create_media_metadata") in get_rate_limiter().buckets
 
 
-def test_twitter_mention_cycle(twitter_environ_patch):
+def test_twitter_mention_cycle(twitter_environ_patch, tmp_path, state_store):
     with mock.patch.dict(os.environ, twitter_environ_patch, clear=False):
         with requests_mock.Mocker() as m:
             m.post(
@@ -113,198 +122,205 @@ def test_twitter_mention_cycle(twitter_environ_patch):
             )
             m.get(
                 "https://api.twitter.com/1.1/statuses/mentions_timeline.json",
-                status_code=200,
-                json=[
+                [
                     {
-                        "coordinates": None,
-                        "favorited": False,
-                        "truncated": False,
-                        "created_at": "Mon Sep 03 13:24:14 +0000 2012",
-                        "id_str": "242613977966850048",
-                        "entities": {
-                            "urls": [],
-                            "hashtags": [],
-                            "user_mentions": [
-                                {
-                                    "name": "Jason Costa",
-                                    "id_str": "14927800",
-                                    "id": 14927800,
-                                    "indices": [0, 11],
-                                    "screen_name": "jasoncosta",
+                        "status_code": 200,
+                        "json": [
+                            {
+                                "coordinates": None,
+                                "favorited": False,
+                                "truncated": False,
+                                "created_at": "Mon Sep 03 13:24:14 +0000 2012",
+                                "id_str": "242613977966850048",
+                                "entities": {
+                                    "urls": [],
+                                    "hashtags": [],
+                                    "user_mentions": [
+                                        {
+                                            "name": "Jason Costa",
+                                            "id_str": "14927800",
+                                            "id": 14927800,
+                                            "indices": [0, 11],
+                                            "screen_name": "jasoncosta",
+                                        },
+                                        {
+                                            "name": "Matt Harris",
+                                            "id_str": "777925",
+                                            "id": 777925,
+                                            "indices": [12, 26],
+                                            "screen_name": "themattharris",
+                                        },
+                                        {
+                                            "name": "ThinkWall",
+                                            "id_str": "117426578",
+                                            "id": 117426578,
+                                            "indices": [109, 119],
+                                            "screen_name": "thinkwall",
+                                        },
+                                    ],
                                 },
-                                {
-                                    "name": "Matt Harris",
-                                    "id_str": "777925",
-                                    "id": 777925,
-                                    "indices": [12, 26],
-                                    "screen_name": "themattharris",
+                                "in_reply_to_user_id_str": "14927800",
+                                "contributors": None,
+                                "full_text": "@somebot markov",
+                                "retweet_count": 0,
+                                "in_reply_to_status_id_str": None,
+                                "id": 242613977966850048,
+                                "geo": None,
+                                "retweeted": False,
+                                "in_reply_to_user_id": 14927800,
+                                "place": None,
+                                "user": {
+                                    "profile_sidebar_fill_color": "EEEEEE",
+                                    "profile_sidebar_border_color": "000000",
+                                    "profile_background_tile": False,
+                                    "name": "Andrew Spode Miller",
+                                    "profile_image_url": "http://a0.twimg.com/profile_images/1227466231/spode-balloon-medium_normal.jpg",  # noqa: E501
+                                    "created_at": "Mon Sep 22 13:12:01 +0000 2008",
+                                    "location": "London via Gravesend",
+                                    "follow_request_sent": False,
+                                    "profile_link_color": "F31B52",
+                                    "is_translator": False,
+                                    "id_str": "16402947",
+                                    "entities": {
+                                        "url": {
+                                            "urls": [
+                                                {
+                                                    "expanded_url": None,
+                                                    "url": "http://www.linkedin.com/in/spode",
+                                                    "indices": [0, 32],
+                                                }
+                                            ]
+                                        },
+                                        "description": {"urls": []},
+                                    },
+                                    "default_profile": False,
+                                    "contributors_enabled": False,
+                                    "favourites_count": 16,
+                                    "url": "http://www.linkedin.com/in/spode",
+                                    "profile_image_url_https": "https://si0.twimg.com/profile_images/1227466231/spode-balloon-medium_normal.jpg",  # noqa: E501
+                                    "utc_offset": 0,
+                                    "id": 16402947,
+                                    "profile_use_background_image": False,
+                                    "listed_count": 129,
+                                    "profile_text_color": "262626",
+                                    "lang": "en",
+                                    "followers_count": 2013,
+                                    "protected": False,
+                                    "notifications": None,
+                                    "profile_background_image_url_https": "https://si0.twimg.com/profile_background_images/16420220/twitter-background-final.png",  # noqa: E501
+                                    "profile_background_color": "FFFFFF",
+                                    "verified": None,
+                                    "geo_enabled": True,
+                                    "time_zone": "London",
+                                    "description": "Co-Founder/Dev (PHP/jQuery) @justFDI. Run @thinkbikes and @thinkwall for events. Ex tech journo, helps run @uktjpr. Passion for Linux and customises everything.",  # noqa: E501
+                                    "default_profile_image": False,
+                                    "profile_background_image_url": "http://a0.twimg.com/profile_background_images/16420220/twitter-background-final.png",  # noqa: E501
+                                    "statuses_count": 11550,
+                                    "friends_count": 770,
+                                    "following": None,
+                                    "show_all_inline_media": True,
+                                    "screen_name": "spode",
                                 },
-                                {
-                                    "name": "ThinkWall",
-                                    "id_str": "117426578",
-                                    "id": 117426578,
-                                    "indices": [109, 119],
-                                    "screen_name": "thinkwall",
+                                "in_reply_to_screen_name": "jasoncosta",
+                                "source": "JournoTwit",
+                                "in_reply_to_status_id": None,
+                            },
+                            {
+                                "coordinates": {
+                                    "coordinates": [121.0132101, 14.5191613],
+                                    "type": "Point",
                                 },
-                            ],
-                        },
-                        "in_reply_to_user_id_str": "14927800",
-                        "contributors": None,
-                        "full_text": "@somebot markov",
-                        "retweet_count": 0,
-                        "in_reply_to_status_id_str": None,
-                        "id": 242613977966850048,
-                        "geo": None,
-                        "retweeted": False,
-                        "in_reply_to_user_id": 14927800,
-                        "place": None,
-                        "user": {
-                            "profile_sidebar_fill_color": "EEEEEE",
-                            "profile_sidebar_border_color": "000000",
-                            "profile_background_tile": False,
-                            "name": "Andrew Spode Miller",
-                            "profile_image_url": "http://a0.twimg.com/profile_images/1227466231/spode-balloon-medium_normal.jpg",  # noqa: E501
-                            "created_at": "Mon Sep 22 13:12:01 +0000 2008",
-                            "location": "London via Gravesend",
-                            "follow_request_sent": False,
-                            "profile_link_color": "F31B52",
-                            "is_translator": False,
-                            "id_str": "16402947",
-                            "entities": {
-                                "url": {
-                                    "urls": [
+                                "favorited": False,
+                                "truncated": False,
+                                "created_at": "Mon Sep 03 08:08:02 +0000 2012",
+                                "id_str": "242534402280783873",
+                                "entities": {
+                                    "urls": [],
+                                    "hashtags": [
+                                        {"text": "twitter", "indices": [49, 57]}
+                                    ],
+                                    "user_mentions": [
                                         {
-                                            "expanded_url": None,
-                                            "url": "http://www.linkedin.com/in/spode",
-                                            "indices": [0, 32],
+                                            "name": "Jason Costa",
+                                            "id_str": "14927800",
+                                            "id": 14927800,
+                                            "indices": [14, 25],
+                                            "screen_name": "jasoncosta",
                                         }
-                                    ]
+                                    ],
                                 },
-                                "description": {"urls": []},
-                            },
-                            "default_profile": False,
-                            "contributors_enabled": False,
-                            "favourites_count": 16,
-                            "url": "http://www.linkedin.com/in/spode",
-                            "profile_image_url_https": "https://si0.twimg.com/profile_images/1227466231/spode-balloon-medium_normal.jpg",  # noqa: E501
-                            "utc_offset": 0,
-                            "id": 16402947,
-                            "profile_use_background_image": False,
-                            "listed_count": 129,
-                            "profile_text_color": "262626",
-                            "lang": "en",
-                            "followers_count": 2013,
-                            "protected": False,
-                            "notifications": None,
-                            "profile_background_image_url_https": "https://si0.twimg.com/profile_background_images/16420220/twitter-background-final.png",  # noqa: E501
-                            "profile_background_color": "FFFFFF",
-                            "verified": None,
-                            "geo_enabled": True,
-                            "time_zone": "London",
-                            "description": "Co-Founder/Dev (PHP/jQuery) @justFDI. Run @thinkbikes and @thinkwall for events. Ex tech journo, helps run @uktjpr. Passion for Linux and customises everything.",  # noqa: E501
-                            "default_profile_image": False,
-                            "profile_background_image_url": "http://a0.twimg.com/profile_background_images/16420220/twitter-background-final.png",  # noqa: E501
-                            "statuses_count": 11550,
-                            "friends_count": 770,
-                            "following": None,
-                            "show_all_inline_media": True,
-                            "screen_name": "spode",
-                        },
-                        "in_reply_to_screen_name": "jasoncosta",
-                        "source": "JournoTwit",
-                        "in_reply_to_status_id": None,
-                    },
-                    {
-                        "coordinates": {
-                            "coordinates": [121.0132101, 14.5191613],
-                            "type": "Point",
-                        },
-                        "favorited": False,
-                        "truncated": False,
-                        "created_at": "Mon Sep 03 08:08:02 +0000 2012",
-                        "id_str": "242534402280783873",
-                        "entities": {
-                            "urls": [],
-                            "hashtags": [{"text": "twitter", "indices": [49, 57]}],
-                            "user_mentions": [
-                                {
-                                    "name": "Jason Costa",
-                                    "id_str": "14927800",
-                                    "id": 14927800,
-                                    "indices": [14, 25],
-                                    "screen_name": "jasoncosta",
-                                }
-                            ],
-                        },
-                        "in_reply_to_user_id_str": None,
-                        "contributors": None,
-                        "full_text": "@somebot quote",
-                        "retweet_count": 0,
-                        "in_reply_to_status_id_str": None,
-                        "id": 242534402280783873,
-                        "geo": {
-                            "coordinates": [14.5191613, 121.0132101],
-                            "type": "Point",
-                        },
-                        "retweeted": False,
-                        "in_reply_to_user_id": None,
-                        "place": None,
-                        "user": {
-                            "profile_sidebar_fill_color": "EFEFEF",
-                            "profile_sidebar_border_color": "EEEEEE",
-                            "profile_background_tile": True,
-                            "name": "Mikey",
-                            "profile_image_url": "http://a0.twimg.com/profile_images/1305509670/chatMikeTwitter_normal.png",  # noqa: E501
-                            "created_at": "Fri Jun 20 15:57:08 +0000 2008",
-                            "location": "Singapore",
-                            "follow_request_sent": False,
-                            "profile_link_color": "009999",
-                            "is_translator": False,
-                            "id_str": "15181205",
-                            "entities": {
-                                "url": {
-                                    "urls": [
-                                        {
-                                            "expanded_url": None,
-                                            "url": "http://about.me/michaelangelo",
-                                            "indices": [0, 29],
-                                        }
-                                    ]
+                                "in_reply_to_user_id_str": None,
+                                "contributors": None,
+                                "full_text": "@somebot quote",
+                                "retweet_count": 0,
+                                "in_reply_to_status_id_str": None,
+                                "id": 242534402280783873,
+                                "geo": {
+                                    "coordinates": [14.5191613, 121.0132101],
+                                    "type": "Point",
+                                },
+                                "retweeted": False,
+                                "in_reply_to_user_id": None,
+                                "place": None,
+                                "user": {
+                                    "profile_sidebar_fill_color": "EFEFEF",
+                                    "profile_sidebar_border_color": "EEEEEE",
+                                    "profile_background_tile": True,
+                                    "name": "Mikey",
+                                    "profile_image_url": "http://a0.twimg.com/profile_images/1305509670/chatMikeTwitter_normal.png",  # noqa: E501
+                                    "created_at": "Fri Jun 20 15:57:08 +0000 2008",
+                                    "location": "Singapore",
+                                    "follow_request_sent": False,
+                                    "profile_link_color": "009999",
+                                    "is_translator": False,
+                                    "id_str": "15181205",
+                                    "entities": {
+                                        "url": {
+                                            "urls": [
+                                                {
+                                                    "expanded_url": None,
+                                                    "url": "http://about.me/michaelangelo",
+                                                    "indices": [0, 29],
+                                                }
+                                            ]
+                                        },
+                                        "description": {"urls": []},
+                                    },
+                                    "default_profile": False,
+                                    "contributors_enabled": False,
+                                    "favourites_count": 11,
+                                    "url": "http://about.me/michaelangelo",
+                                    "profile_image_url_https": "https://si0.twimg.com/profile_images/1305509670/chatMikeTwitter_normal.png",  # noqa: E501
+                                    "utc_offset": 28800,
+                                    "id": 15181205,
+                                    "profile_use_background_image": True,
+                                    "listed_count": 61,
+                                    "profile_text_color": "333333",
+                                    "lang": "en",
+                                    "followers_count": 577,
+                                    "protected": False,
+                                    "notifications": None,
+                                    "profile_background_image_url_https": "https://si0.twimg.com/images/themes/theme14/bg.gif",  # noqa: E501
+                                    "profile_background_color": "131516",
+                                    "verified": False,
+                                    "geo_enabled": False,
+                                    "time_zone": "Hong Kong",
+                                    "description": "Android Applications Developer,  Studying Martial Arts, Plays MTG, Food and movie junkie",  # noqa: E501
+                                    "default_profile_image": False,
+                                    "profile_background_image_url": "http://a0.twimg.com/images/themes/theme14/bg.gif",
+                                    "statuses_count": 11327,
+                                    "friends_count": 138,
+                                    "following": None,
+                                    "show_all_inline_media": True,
+                                    "screen_name": "mikedroid",
                                 },
-                                "description": {"urls": []},
+                                "in_reply_to_screen_name": None,
+                                "source": "Twitter for Android",
+                                "in_reply_to_status_id": None,
                             },
-                            "default_profile": False,
-                            "contributors_enabled": False,
-                            "favourites_count": 11,
-                            "url": "http://about.me/michaelangelo",
-                            "profile_image_url_https": "https://si0.twimg.com/profile_images/1305509670/chatMikeTwitter_normal.png",  # noqa: E501
-                            "utc_offset": 28800,
-                            "id": 15181205,
-                            "profile_use_background_image": True,
-                            "listed_count": 61,
-                            "profile_text_color": "333333",
-                            "lang": "en",
-                            "followers_count": 577,
-                            "protected": False,
-                            "notifications": None,
-                            "profile_background_image_url_https": "https://si0.twimg.com/images/themes/theme14/bg.gif",
-                            "profile_background_color": "131516",
-                            "verified": False,
-                            "geo_enabled": False,
-                            "time_zone": "Hong Kong",
-                            "description": "Android Applications Developer,  Studying Martial Arts, Plays MTG, Food and movie junkie",  # noqa: E501
-                            "default_profile_image": False,
-                            "profile_background_image_url": "http://a0.twimg.com/images/themes/theme14/bg.gif",
-                            "statuses_count": 11327,
-                            "friends_count": 138,
-                            "following": None,
-                            "show_all_inline_media": True,
-                            "screen_name": "mikedroid",
-                        },
-                        "in_reply_to_screen_name": None,
-                        "source": "Twitter for Android",
-                        "in_reply_to_status_id": None,
+                        ],
                     },
+                    {"json": []},
                 ],
             )
             # TODO: Add tweet reply mock here so that test can be wrapped up.
@@ -455,5 +471,752 @@ def test_twitter_mention_cycle(twitter_environ_patch):
                 "https://quoteservice.andrlik.org/api/sources/ew-nix/generate_sentence/",
                 json={"sentence": "fear the snek"},
             )
-            respond_to_tweets("test_last_tweet.txt")
-            assert get_last_tweet_id("test_last_tweet.txt") == 242613977966850048
+            legacy_file = tmp_path / "test_last_tweet.txt"
+            legacy_file.write_text("14")
+            respond_to_tweets(str(legacy_file), store=state_store)
+            assert state_store.get_since_id("twitter") == 242613977966850048
+            assert state_store.has_replied("twitter", 242613977966850048)
+            assert not legacy_file.exists()
+
+
+@pytest.fixture
+def reply_payload():
+    return {
+        "mention_id": 1,
+        "screen_name": "someone",
+        "text_to_use": "Hi",
+        "link_to_quote": None,
+    }
+
+
+def test_reply_fails_when_upload_fails(reply_payload):
+    with mock.patch(
+        "ewtwitterbot.twitter_bot.upload_image_and_set_metadata", return_value=None
+    ):
+        assert not reply_to_mention(mock.MagicMock(), **reply_payload)
+
+
+def test_reply_renders_to_its_own_temporary_file(reply_payload):
+    uploaded = []
+
+    def upload(api, image_filename, alt_text):
+        assert os.path.getsize(image_filename) > 0
+        uploaded.append(image_filename)
+        return 99
+
+    with mock.patch(
+        "ewtwitterbot.twitter_bot.upload_image_and_set_metadata", side_effect=upload
+    ):
+        assert reply_to_mention(mock.MagicMock(), **reply_payload)
+        assert reply_to_mention(mock.MagicMock(), **reply_payload)
+    assert uploaded[0] != uploaded[1]
+    assert os.path.basename(uploaded[0]).startswith("quote_image_1_")
+    assert not any(os.path.exists(filename) for filename in uploaded)
+
+
+def test_reply_reuses_media_for_identical_images(state_store, reply_payload, tmp_path):
+    api = mock.MagicMock()
+    media_cache = MediaCache(state_store, "twitter")
+    image_filename = str(tmp_path / "quote.png")
+    with mock.patch(
+        "ewtwitterbot.twitter_bot.upload_image_and_set_metadata", return_value=99
+    ) as upload:
+        assert reply_to_mention(
+            api, image_filename=image_filename, media_cache=media_cache, **reply_payload
+        )
+        assert reply_to_mention(
+            api,
+            image_filename=image_filename,
+            media_cache=media_cache,
+            **dict(reply_payload, mention_id=2),
+        )
+        assert reply_to_mention(
+            api,
+            image_filename=image_filename,
+            media_cache=media_cache,
+            **dict(reply_payload, text_to_use="Something else"),
+        )
+    assert upload.call_count == 2
+    assert api.update_status.call_args_list[1][1]["media_ids"] == ["99"]
+
+
+def test_reply_uploads_again_when_cached_media_is_turned_down(
+    state_store, reply_payload, tmp_path
+):
+    api = mock.MagicMock()
+    response = mock.MagicMock(status_code=400, reason="Bad Request")
+    response.json.return_value = {
+        "errors": [{"code": 324, "message": "The validation of media ids failed."}]
+    }
+    api.update_status.side_effect = [tweepy.errors.BadRequest(response), None]
+    media_cache = MediaCache(state_store, "twitter")
+    image_filename = str(tmp_path / "quote.png")
+    get_quote_image(reply_payload["text_to_use"], filename=image_filename)
+    media_cache.put(content_hash(image_filename), "98")
+    with mock.patch(
+        "ewtwitterbot.twitter_bot.upload_image_and_set_metadata", return_value=99
+    ) as upload:
+        assert reply_to_mention(
+            api, image_filename=image_filename, media_cache=media_cache, **reply_payload
+        )
+    assert upload.call_count == 1
+    assert [call[1]["media_ids"] for call in api.update_status.call_args_list] == [
+        ["98"],
+        ["99"],
+    ]
+    assert media_cache.get(content_hash(image_filename)) == "99"
+
+
+def test_reply_fails_when_cached_media_post_fails(state_store, reply_payload, tmp_path):
+    api = mock.MagicMock()
+    api.update_status.side_effect = tweepy.errors.TweepyException("Oops")
+    media_cache = MediaCache(state_store, "twitter")
+    image_filename = str(tmp_path / "quote.png")
+    get_quote_image(reply_payload["text_to_use"], filename=image_filename)
+    media_cache.put(content_hash(image_filename), "98")
+    with mock.patch("ewtwitterbot.twitter_bot.upload_image_and_set_metadata") as upload:
+        assert not reply_to_mention(
+            api, image_filename=image_filename, media_cache=media_cache, **reply_payload
+        )
+    upload.assert_not_called()
+    assert media_cache.get(content_hash(image_filename)) == "98"
+
+
+def test_retry_failed_replies(state_store, reply_payload):
+    queue = RetryQueue(state_store, "twitter")
+    queue.push(1, reply_payload, now=0)
+    queue.push(2, reply_payload, now=0)
+    with mock.patch(
+        "ewtwitterbot.twitter_bot.reply_to_mention", side_effect=[True, False]
+    ) as reply:
+        retry_failed_replies(mock.MagicMock(), queue)
+    assert reply.call_count == 2
+    assert 1 not in queue
+    assert state_store.retry_get("twitter", 2)["attempts"] == 2
+
+
+def test_reply_calls_time_out_with_the_deadline(reply_payload):
+    api = mock.MagicMock()
+    with mock.patch("ewtwitterbot.twitter_bot.call_api") as call:
+        assert reply_to_mention(
+            api, text_only=True, deadline=Deadline(30), **reply_payload
+        )
+    bounded = call.call_args[0][0]
+    assert bounded is not api
+    assert 0 < bounded.timeout <= 30
+
+
+def twitter_error(code):
+    response = mock.MagicMock(status_code=403, reason="Forbidden")
+    response.json.return_value = {"errors": [{"code": code, "message": "Nope."}]}
+    return tweepy.errors.Forbidden(response)
+
+
+@pytest.mark.parametrize(
+    "error,posted",
+    [
+        (twitter_error(187), True),
+        (twitter_error(186), False),
+        (
+            tweepy.errors.TweepyException("Failed to send request: Read timed out."),
+            False,
+        ),
+    ],
+)
+@pytest.mark.parametrize("text_only", [True, False])
+def test_only_duplicates_count_as_replied(reply_payload, error, posted, text_only):
+    api = mock.MagicMock()
+    api.update_status.side_effect = error
+    with mock.patch(
+        "ewtwitterbot.twitter_bot.upload_image_and_set_metadata", return_value=99
+    ):
+        assert reply_to_mention(api, text_only=text_only, **reply_payload) is posted
+    api.update_status.assert_called_once()
+
+
+def test_reply_gives_up_when_deadline_runs_out(reply_payload):
+    api = mock.MagicMock()
+    with mock.patch("ewtwitterbot.twitter_bot.get_quote_image") as render:
+        assert not reply_to_mention(api, deadline=Deadline(0), **reply_payload)
+    render.assert_not_called()
+    api.update_status.assert_not_called()
+
+
+def test_quote_fetch_timeout_is_queued_and_retried(state_store):
+    ledger = get_ledger(state_store, "twitter")
+    queue = RetryQueue(state_store, "twitter")
+    mentions = [
+        mock.MagicMock(spec=["id", "full_text", "user"], id=i, full_text="#quote")
+        for i in (1, 2, 3)
+    ]
+    for mention in mentions:
+        mention.user.screen_name = "someone"
+    with mock.patch(
+        "ewtwitterbot.twitter_bot.process_request", side_effect=ReadTimeout
+    ), mock.patch("ewtwitterbot.twitter_bot.reply_to_mention") as reply:
+        handle_mention(mock.MagicMock(), mentions[0], state_store, ledger, queue)
+        handle_mentions_concurrently(
+            mock.MagicMock(), mentions[1:], state_store, ledger, queue
+        )
+    reply.assert_not_called()
+    due = queue.due(now=time.time() + 3600)
+    assert [item["payload"]["request"] for item in due] == ["#quote"] * 3
+    with mock.patch(
+        "ewtwitterbot.twitter_bot.process_request",
+        side_effect=[("Hi", "https://ew.fm/1"), (None, None), ReadTimeout],
+    ), mock.patch(
+        "ewtwitterbot.twitter_bot.reply_to_mention", return_value=True
+    ) as reply, mock.patch.object(
+        queue, "due", return_value=due
+    ):
+        retry_failed_replies(mock.MagicMock(), queue)
+    assert reply.call_args[1]["text_to_use"] == "Hi"
+    assert "request" not in reply.call_args[1]
+    assert 1 not in queue and 2 not in queue
+    assert state_store.retry_get("twitter", 3)["attempts"] == 2
+
+
+def test_already_handled_mentions_are_skipped(state_store):
+    state_store.set_since_id("twitter", 1)
+    state_store.mark_replied("twitter", 42)
+    api = mock.MagicMock()
+    api.mentions_timeline.side_effect = [
+        [mock.MagicMock(id=42, full_text="@ewbot #quote")],
+        [],
+    ]
+    with mock.patch(
+        "ewtwitterbot.twitter_bot.get_credentials_from_environ", return_value=api
+    ), mock.patch("ewtwitterbot.twitter_bot.process_request") as process:
+        respond_to_tweets(None, store=state_store)
+    process.assert_not_called()
+    api.update_status.assert_not_called()
+    assert state_store.get_since_id("twitter") == 42
+
+
+def test_fresh_store_starts_from_newest_mention(state_store):
+    api = mock.MagicMock()
+    api.mentions_timeline.return_value = [mock.MagicMock(id=42, full_text="#quote")]
+    with mock.patch("ewtwitterbot.twitter_bot.handle_mention") as handle:
+        assert respond_to_tweets(None, store=state_store, api=api) == 0
+    handle.assert_not_called()
+    assert api.mentions_timeline.call_args == mock.call(count=1)
+    assert state_store.get_since_id("twitter") == 42
+    api.mentions_timeline.return_value = []
+    assert enqueue_mentions(api, state_store) == 0
+    assert api.mentions_timeline.call_args[1]["since_id"] == 42
+
+
+def test_fresh_fetcher_starts_from_newest_mention(state_store):
+    api = mock.MagicMock()
+    api.mentions_timeline.return_value = []
+    assert enqueue_mentions(api, state_store) == 0
+    assert len(WorkQueue(state_store, "twitter")) == 0
+    assert state_store.get_since_id("twitter") == 1
+
+
+@pytest.mark.parametrize(
+    "argv,expected_call",
+    [
+        ([], "respond_to_tweets"),
+        (["serve"], "serve_tweets"),
+        (["stream"], "stream_tweets_forever"),
+        (["fetch"], "fetch_tweets"),
+        (["work"], "work_tweets"),
+    ],
+)
+def test_main_modes(argv, expected_call, tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    with mock.patch(
+        "ewtwitterbot.twitter_bot.respond_to_tweets"
+    ) as respond, mock.patch(
+        "ewtwitterbot.twitter_bot.serve_tweets"
+    ) as serve, mock.patch(
+        "ewtwitterbot.twitter_bot.stream_tweets_forever"
+    ) as stream, mock.patch(
+        "ewtwitterbot.twitter_bot.fetch_tweets"
+    ) as fetch, mock.patch(
+        "ewtwitterbot.twitter_bot.work_tweets"
+    ) as work:
+        main(argv)
+    called = {
+        "respond_to_tweets": respond,
+        "serve_tweets": serve,
+        "stream_tweets_forever": stream,
+        "fetch_tweets": fetch,
+        "work_tweets": work,
+    }
+    assert called.pop(expected_call).called
+    assert not any(other.called for other in called.values())
+
+
+def test_main_writes_metrics_after_one_pass(tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    monkeypatch.setenv("EWBOT_METRICS_FILE", str(tmp_path / "ewbot.prom"))
+    api = mock.MagicMock()
+    api.mentions_timeline.return_value = []
+    with mock.patch(
+        "ewtwitterbot.twitter_bot.get_credentials_from_environ", return_value=api
+    ):
+        main([])
+    metrics = (tmp_path / "ewbot.prom").read_text()
+    assert (
+        'ewbot_stage_total{outcome="ok",platform="twitter",stage="mention_fetch"} 1'
+        in metrics
+    )
+    assert 'ewbot_stage_total{outcome="ok",stage="checkpoint"}' in metrics
+
+
+def test_main_skips_overlapping_runs(tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    lock = acquire_run_lock("twitter")
+    assert lock is not None
+    with mock.patch("ewtwitterbot.twitter_bot.respond_to_tweets") as respond:
+        main([])
+    respond.assert_not_called()
+    lock.release()
+    with mock.patch("ewtwitterbot.twitter_bot.respond_to_tweets") as respond:
+        main([])
+    respond.assert_called_once()
+
+
+def test_workers_run_alongside_a_held_lock(tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    lock = acquire_run_lock("twitter")
+    assert lock is not None
+    with mock.patch("ewtwitterbot.twitter_bot.work_tweets") as work, mock.patch(
+        "ewtwitterbot.twitter_bot.fetch_tweets"
+    ) as fetch:
+        main(["work"])
+        main(["fetch"])
+    work.assert_called_once()
+    fetch.assert_not_called()
+    lock.release()
+
+
+def tweet(api, tweet_id, screen_name="someone", text="@ewbot #quote"):
+    return tweepy.models.Status.parse(
+        api,
+        {
+            "id": tweet_id,
+            "id_str": str(tweet_id),
+            "full_text": text,
+            "created_at": "Wed Oct 19 12:00:00 +0000 2022",
+            "user": {"id": 1, "screen_name": screen_name},
+        },
+    )
+
+
+def test_fetcher_queues_mentions_for_workers(state_store):
+    state_store.set_since_id("twitter", 1)
+    api = mock.MagicMock(parser=tweepy.parsers.ModelParser())
+    api.mentions_timeline.side_effect = [[tweet(api, i) for i in (4, 3, 2)], []]
+    assert enqueue_mentions(api, state_store) == 3
+    assert api.mentions_timeline.call_args[1]["since_id"] == 1
+    work = WorkQueue(state_store, "twitter")
+    assert work.cursor() == 4
+    with mock.patch(
+        "ewtwitterbot.twitter_bot.process_request", return_value=("Hi", None)
+    ) as process, mock.patch(
+        "ewtwitterbot.twitter_bot.reply_to_mention", return_value=True
+    ) as reply:
+        assert work_on_mentions(api, state_store, "a", batch_size=2) == 2
+        assert state_store.get_since_id("twitter") == 3
+        assert work_on_mentions(api, state_store, "a", batch_size=2) == 1
+    assert [call[0][0] for call in process.call_args_list] == ["@ewbot #quote"] * 3
+    assert [call[1]["mention_id"] for call in reply.call_args_list] == [2, 3, 4]
+    assert [call[1]["screen_name"] for call in reply.call_args_list] == ["someone"] * 3
+    assert state_store.get_since_id("twitter") == 4
+    assert len(work) == 0
+    api.mentions_timeline.side_effect = [[]]
+    assert enqueue_mentions(api, state_store) == 0
+    assert api.mentions_timeline.call_args[1]["since_id"] == 4
+
+
+def test_worker_skips_mentions_another_worker_replied_to(state_store):
+    api = mock.MagicMock(parser=tweepy.parsers.ModelParser())
+    WorkQueue(state_store, "twitter").enqueue([(5, tweet(api, 5)._json)])
+    ledger = get_ledger(state_store, "twitter")
+    state_store.mark_replied("twitter", 5)
+    assert 5 not in ledger
+    with mock.patch("ewtwitterbot.twitter_bot.reply_to_mention") as reply:
+        assert work_on_mentions(api, state_store, "a") == 1
+    reply.assert_not_called()
+    assert state_store.get_since_id("twitter") == 5
+
+
+def test_fetch_and_work_tweets(tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    api = mock.MagicMock()
+    with mock.patch(
+        "ewtwitterbot.twitter_bot.get_credentials_from_environ", return_value=api
+    ), mock.patch("ewtwitterbot.twitter_bot.enqueue_mentions") as enqueue, mock.patch(
+        "ewtwitterbot.twitter_bot.serve"
+    ) as serve, mock.patch(
+        "ewtwitterbot.twitter_bot.work_on_mentions", return_value=2
+    ) as work:
+        fetch_tweets()
+        work_tweets(batch_size=3)
+        assert serve.call_args[0][0]() == 2
+    assert enqueue.call_args[0][0] is api
+    assert work.call_args[0][3] == 3
+    assert work.call_args[0][1].shared
+    serve.call_args[1]["on_shutdown"]()
+
+
+def test_serve_reuses_client_and_store(tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    api = mock.MagicMock()
+    with mock.patch(
+        "ewtwitterbot.twitter_bot.get_credentials_from_environ", return_value=api
+    ) as credentials, mock.patch("ewtwitterbot.twitter_bot.serve") as serve, mock.patch(
+        "ewtwitterbot.twitter_bot.respond_to_tweets", return_value=3
+    ) as respond:
+        serve_tweets()
+        cycle = serve.call_args[0][0]
+        assert cycle() == 3
+        assert cycle() == 3
+    assert credentials.call_count == 1
+    assert respond.call_args_list[0] == respond.call_args_list[1]
+    assert respond.call_args[1]["api"] is api
+    serve.call_args[1]["on_shutdown"]()
+
+
+@pytest.fixture
+def paged_api():
+    api = mock.MagicMock()
+    api.mentions_timeline.side_effect = [
+        [mock.MagicMock(id=i) for i in (9, 8, 7)],
+        [mock.MagicMock(id=i) for i in (6, 5, 4)],
+        [mock.MagicMock(id=3)],
+        [],
+    ]
+    return api
+
+
+def test_iter_mentions_walks_backlog_oldest_first(paged_api):
+    assert [mention.id for mention in iter_mentions(paged_api, 2)] == [
+        3,
+        4,
+        5,
+        6,
+        7,
+        8,
+        9,
+    ]
+    max_ids = [call[1]["max_id"] for call in paged_api.mentions_timeline.call_args_list]
+    assert max_ids == [None, 6, 3, 2]
+    assert all(
+        call[1]["since_id"] == 2 for call in paged_api.mentions_timeline.call_args_list
+    )
+
+
+def test_iter_mentions_caps_mentions_per_cycle(paged_api):
+    assert [mention.id for mention in iter_mentions(paged_api, 2, limit=4)] == [
+        3,
+        4,
+        5,
+        6,
+    ]
+    assert paged_api.mentions_timeline.call_count == 4
+
+
+def test_respond_caps_mentions_per_cycle(state_store, paged_api):
+    state_store.set_since_id("twitter", 1)
+    with mock.patch(
+        "ewtwitterbot.twitter_bot.get_credentials_from_environ", return_value=paged_api
+    ), mock.patch(
+        "ewtwitterbot.twitter_bot.process_request", return_value=(None, None)
+    ):
+        assert respond_to_tweets(None, store=state_store, max_mentions=2) == 2
+    assert state_store.get_since_id("twitter") == 4
+
+
+def test_backlog_drains_across_cycles(state_store):
+    def mentions_timeline(since_id, max_id, count, **kwargs):
+        newest = 250 if max_id is None else max_id
+        return [mock.MagicMock(id=i) for i in range(newest, since_id, -1)][:count]
+
+    api = mock.MagicMock()
+    api.mentions_timeline.side_effect = mentions_timeline
+    state_store.set_since_id("twitter", 0)
+    with mock.patch("ewtwitterbot.twitter_bot.handle_mention") as handle:
+        while respond_to_tweets(None, store=state_store, api=api) == 100:
+            pass
+    assert [call[0][1].id for call in handle.call_args_list] == list(range(1, 251))
+    assert state_store.get_since_id("twitter") == 250
+
+
+def test_respond_throttles_authors_over_quota(state_store, monkeypatch):
+    state_store.set_since_id("twitter", 1)
+    monkeypatch.setenv("EWBOT_USER_QUOTA", "2")
+    api = mock.MagicMock()
+    mentions = [mock.MagicMock(id=i) for i in (6, 5, 4, 3, 2)]
+    for mention in mentions:
+        mention.user.screen_name = "Spammer" if mention.id % 2 == 0 else "someone"
+    api.mentions_timeline.side_effect = [mentions, []]
+    with mock.patch("ewtwitterbot.twitter_bot.handle_mention") as handle:
+        assert respond_to_tweets(None, store=state_store, api=api) == 5
+    assert [call[0][1].id for call in handle.call_args_list] == [2, 3, 4, 5]
+    assert 6 in get_ledger(state_store, "twitter")
+    assert state_store.get_since_id("twitter") == 6
+
+
+def test_text_only_reply_skips_image(reply_payload):
+    api = mock.MagicMock()
+    with mock.patch("ewtwitterbot.twitter_bot.get_quote_image") as render:
+        assert reply_to_mention(api, text_only=True, **reply_payload)
+    render.assert_not_called()
+    api.media_upload.assert_not_called()
+    assert api.update_status.call_args[1]["status"] == "@someone Hi"
+    assert "media_ids" not in api.update_status.call_args[1]
+
+
+def test_respond_sheds_load(state_store, monkeypatch):
+    state_store.set_since_id("twitter", 1)
+    monkeypatch.setenv("EWBOT_LOAD_THRESHOLDS", "1,2,3")
+    remember_reply(state_store, "twitter", "quote", "Hi", "https://ew.fm/3")
+    now = time.time()
+    api = mock.MagicMock()
+    mentions = [
+        mock.MagicMock(
+            spec=["id", "full_text", "created_at", "user"],
+            id=i,
+            full_text="@ewbot #quote",
+            created_at=datetime.fromtimestamp(now - 10 * (6 - i), timezone.utc),
+        )
+        for i in (5, 4, 3, 2, 1)
+    ]
+    for mention in mentions:
+        mention.user.screen_name = f"user{mention.id}"
+    api.mentions_timeline.side_effect = [mentions, []]
+    with mock.patch("ewtwitterbot.twitter_bot.process_request") as process:
+        assert respond_to_tweets(None, store=state_store, api=api) == 5
+    process.assert_not_called()
+    assert [
+        call[1]["in_reply_to_status_id"] for call in api.update_status.call_args_list
+    ] == [3, 4, 5]
+    assert all("media_ids" not in call[1] for call in api.update_status.call_args_list)
+    assert all(i in get_ledger(state_store, "twitter") for i in range(1, 6))
+    assert state_store.get_since_id("twitter") == 5
+
+
+def test_reuse_only_answers_the_same_kind_of_request(state_store):
+    remember_reply(state_store, "twitter", "quote", "Hi", "https://ew.fm/3")
+    ledger = get_ledger(state_store, "twitter")
+    mentions = [
+        mock.MagicMock(spec=["id", "full_text", "user"], id=i, full_text=text)
+        for i, text in ((1, "@ewbot #quote"), (2, "@ewbot markov"))
+    ]
+    with mock.patch(
+        "ewtwitterbot.twitter_bot.process_request", return_value=("Hello.", None)
+    ) as process:
+        quote, sentence = (
+            prepare_reply(mention, ledger, state_store, LoadLevel.REUSE)
+            for mention in mentions
+        )
+    assert quote is not None and quote["text_to_use"] == "Hi"
+    assert sentence is not None and sentence["text_to_use"] == "Hello."
+    process.assert_called_once()
+    assert recent_reply(state_store, "twitter", "markov") == ("Hello.", None)
+
+
+def stream_line(tweet_id, screen_name="someone", text="@ewbot #quote", **extra):
+    return json.dumps(
+        {
+            "id": tweet_id,
+            "text": text,
+            "in_reply_to_status_id": None,
+            "user": {"id": tweet_id + 1000, "screen_name": screen_name},
+            **extra,
+        }
+    )
+
+
+@pytest.fixture
+def replay_file(tmp_path):
+    path = tmp_path / "stream.jsonl"
+    path.write_text(
+        "\n".join(
+            [
+                stream_line(
+                    500,
+                    text="@ewbot #quo…",
+                    extended_tweet={"full_text": "@ewbot #quote please"},
+                ),
+                "",
+                stream_line(501, retweeted_status={"id": 1}),
+                stream_line(502, screen_name="EWBot"),
+                json.dumps({"delete": {"status": {"id": 3, "user_id": 4}}}),
+                stream_line(503, text="@ewbot #markov"),
+            ]
+        )
+    )
+    return str(path)
+
+
+def test_get_full_text():
+    assert get_full_text(mock.Mock(spec=["text"], text="short")) == "short"
+    assert (
+        get_full_text(mock.Mock(spec=["text", "full_text"], text="a", full_text="b"))
+        == "b"
+    )
+
+
+def test_stream_replays_mentions_through_pipeline(
+    twitter_environ_patch, state_store, replay_file
+):
+    api = mock.MagicMock()
+    api.verify_credentials.return_value.screen_name = "ewbot"
+    with mock.patch.dict(os.environ, twitter_environ_patch, clear=False), mock.patch(
+        "ewtwitterbot.twitter_bot.respond_to_tweets"
+    ) as backfill, mock.patch(
+        "ewtwitterbot.twitter_bot.process_request", return_value=(None, None)
+    ) as process:
+        stream_tweets(
+            api,
+            state_store,
+            threading.Event(),
+            stream_class=ReplayMentionStream,
+            replay_filename=replay_file,
+        )
+    assert backfill.call_count == 1
+    assert [call[0][0] for call in process.call_args_list] == [
+        "@ewbot #quote please",
+        "@ewbot #markov",
+    ]
+    assert state_store.get_since_id("twitter") == 503
+
+
+def test_stream_stops_when_asked(twitter_environ_patch, state_store, replay_file):
+    api = mock.MagicMock()
+    api.verify_credentials.return_value.screen_name = "ewbot"
+    stop_event = threading.Event()
+
+    def process(text, service_name, deadline=None):
+        stop_event.set()
+        return None, None
+
+    with mock.patch.dict(os.environ, twitter_environ_patch, clear=False), mock.patch(
+        "ewtwitterbot.twitter_bot.respond_to_tweets"
+    ), mock.patch(
+        "ewtwitterbot.twitter_bot.process_request", side_effect=process
+    ) as processed:
+        stream_tweets(
+            api,
+            state_store,
+            stop_event,
+            stream_class=ReplayMentionStream,
+            replay_filename=replay_file,
+        )
+    assert processed.call_count == 1
+    assert state_store.get_since_id("twitter") == 500
+
+
+def test_stream_tweets_forever(tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    api = mock.MagicMock()
+    with mock.patch(
+        "ewtwitterbot.twitter_bot.get_credentials_from_environ", return_value=api
+    ), mock.patch(
+        "ewtwitterbot.twitter_bot.install_signal_handlers"
+    ) as install, mock.patch(
+        "ewtwitterbot.twitter_bot.stream_tweets"
+    ) as stream:
+        stream_tweets_forever()
+    assert stream.call_args[0][0] is api
+    assert stream.call_args[0][2] is install.call_args[0][0]
+
+
+def test_live_stream_tracks_bot_mentions(twitter_environ_patch, state_store):
+    api = mock.MagicMock()
+    api.verify_credentials.return_value.screen_name = "ewbot"
+    with mock.patch.dict(os.environ, twitter_environ_patch, clear=False), mock.patch(
+        "ewtwitterbot.twitter_bot.MentionStream.filter"
+    ) as stream_filter:
+        stream_tweets(api, state_store, threading.Event())
+    stream_filter.assert_called_once_with(track=["@ewbot"])
+
+
+def test_stream_disconnects_on_status_after_stop():
+    stop_event = threading.Event()
+    stop_event.set()
+    on_mention = mock.MagicMock()
+    stream = MentionStream(
+        "a", "b", "c", "d", "ewbot", on_mention, mock.MagicMock(), stop_event
+    )
+    stream.running = True
+    stream.on_status(mock.MagicMock())
+    assert not stream.running
+    on_mention.assert_not_called()
+
+
+def test_reply_to_mentions_async_bounds_concurrency(reply_payload):
+    lock = threading.Lock()
+    in_flight = []
+    peak = []
+
+    def slow_reply(api, mention_id, **kwargs):
+        with lock:
+            in_flight.append(mention_id)
+            peak.append(len(in_flight))
+        time.sleep(0.05)
+        with lock:
+            in_flight.remove(mention_id)
+        if mention_id == 3:
+            raise RuntimeError("boom")
+        return mention_id != 4
+
+    payloads = [dict(reply_payload, mention_id=i) for i in range(1, 6)]
+    with mock.patch("ewtwitterbot.twitter_bot.reply_to_mention", new=slow_reply):
+        results = asyncio.run(
+            reply_to_mentions_async(mock.MagicMock(), payloads, concurrency=2)
+        )
+    assert results == [True, True, False, False, True]
+    assert max(peak) == 2
+
+
+def test_handle_mentions_concurrently(state_store):
+    ledger = mock.MagicMock()
+    ledger.__contains__.side_effect = lambda mention_id: mention_id == 3
+    queue = RetryQueue(state_store, "twitter")
+    mentions = [mock.MagicMock(id=i, full_text=f"@ewbot #quote {i}") for i in (1, 2, 3)]
+    for mention in mentions:
+        mention.user.screen_name = "someone"
+    with mock.patch(
+        "ewtwitterbot.twitter_bot.process_request", return_value=("Hi", None)
+    ), mock.patch(
+        "ewtwitterbot.twitter_bot.reply_to_mention",
+        side_effect=lambda api, mention_id, **kwargs: mention_id == 1,
+    ) as reply:
+        handle_mentions_concurrently(
+            mock.MagicMock(), mentions, state_store, ledger, queue, concurrency=2
+        )
+    assert reply.call_count == 2
+    assert [item["mention_id"] for item in queue.due(now=time.time() + 3600)] == [2]
+    assert [call[0][0] for call in ledger.add.call_args_list] == [1, 2, 3]
+    assert state_store.get_since_id("twitter") == 3
+
+
+def test_respond_concurrently(state_store, paged_api):
+    state_store.set_since_id("twitter", 1)
+    with mock.patch(
+        "ewtwitterbot.twitter_bot.handle_mentions_concurrently"
+    ) as handle_batch:
+        assert (
+            respond_to_tweets(None, store=state_store, api=paged_api, concurrency=3)
+            == 7
+        )
+    assert [mention.id for mention in handle_batch.call_args[0][1]] == list(
+        range(3, 10)
+    )
+    assert handle_batch.call_args[0][5] == 3
+
+
+def test_main_profiles_one_pass(tmp_path, monkeypatch):
+    monkeypatch.setenv("EWBOT_STATE_DB", str(tmp_path / "state.sqlite3"))
+    monkeypatch.setenv("EWBOT_PROFILE_DIR", str(tmp_path))
+    with mock.patch("ewtwitterbot.twitter_bot.respond_to_tweets") as respond:
+        main(["--profile", "cprofile", "--profile", "tracemalloc"])
+    respond.assert_called_once_with("last_tweet.txt", concurrency=1)
+    assert len(list(tmp_path.glob("ewbot-twitter-*-1.prof"))) == 1
+    assert not tracemalloc.is_tracing()
@@ -0,0 +1,91 @@
+import os
+import socket
+from typing import List
+
+import pytest
+
+from ewtwitterbot.state import StateStore
+from ewtwitterbot.work_queue import WorkQueue, get_worker_name
+
+
+@pytest.fixture
+def work(state_store):
+    queue = WorkQueue(state_store, "twitter", lease=60, max_deliveries=2)
+    queue.enqueue([(i, {"id": i}) for i in (3, 1, 2)])
+    return queue
+
+
+def test_worker_name():
+    assert get_worker_name() == f"{socket.gethostname()}:{os.getpid()}"
+
+
+def test_enqueue_ignores_duplicates(work):
+    work.enqueue([(1, {"id": "again"}), (4, {"id": 4})])
+    assert len(work) == 4
+    assert len(WorkQueue(work.store, "mastodon")) == 0
+    assert work.cursor() == 4
+
+
+def test_claims_are_leased_oldest_first(work):
+    first = work.claim("a", limit=2, now=1000)
+    assert [item["mention_id"] for item in first] == [1, 2]
+    assert first[0]["payload"] == {"id": 1}
+    assert first[0]["deliveries"] == 1
+    assert [item["mention_id"] for item in work.claim("b", limit=2, now=1000)] == [3]
+    assert work.claim("c", now=1000) == []
+
+
+def test_expired_lease_is_redelivered(work):
+    work.claim("a", now=1000)
+    assert work.claim("b", now=1059)[0]["mention_id"] == 2
+    redelivered = work.claim("b", now=1061)
+    assert redelivered[0]["mention_id"] == 1
+    assert redelivered[0]["deliveries"] == 2
+    assert not work.ack("a", 1)
+    assert work.ack("b", 1)
+    assert len(work) == 2
+
+
+def test_gives_up_after_max_deliveries(work):
+    for now in (1000, 1100):
+        assert work.claim("a", now=now)[0]["mention_id"] == 1
+    assert work.claim("a", now=1200) == []
+    assert len(work) == 2
+    assert work.claim("a", now=1200)[0]["mention_id"] == 2
+
+
+def test_checkpoint_only_advances_past_contiguous_done(work):
+    assert work.checkpoint() is None
+    work.claim("a", limit=3, now=1000)
+    work.ack("a", 2)
+    assert work.checkpoint() is None
+    assert work.store.get_since_id("twitter") is None
+    work.ack("a", 1)
+    assert work.checkpoint() == 2
+    assert work.store.get_since_id("twitter") == 2
+    assert work.cursor() == 3
+    work.ack("a", 3)
+    assert work.checkpoint() == 3
+    assert len(work) == 0
+    assert work.store.work_newest_id("twitter") is None
+    assert work.cursor() == 3
+
+
+def test_cursor_without_anything_fetched(state_store):
+    assert WorkQueue(state_store, "twitter").cursor() is None
+
+
+def test_workers_in_separate_connections_never_share_items(tmp_path):
+    filename = str(tmp_path / "state.sqlite3")
+    stores = [StateStore(filename) for _ in range(2)]
+    queues = [WorkQueue(store, "twitter") for store in stores]
+    queues[0].enqueue([(i, {}) for i in range(1, 11)])
+    claimed: List[int] = []
+    for _ in range(5):
+        for worker, queue in enumerate(queues):
+            claimed.extend(
+                item["mention_id"] for item in queue.claim(str(worker), now=1000)
+            )
+    assert sorted(claimed) == list(range(1, 11))
+    for store in stores:
+        store.close()